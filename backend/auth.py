@@ -1,95 +1,202 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request, Response
 from fastapi.security import OAuth2PasswordRequestForm
-from passlib.context import CryptContext
-from sqlalchemy.orm import Session
-from jose import JWTError, jwt
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import timedelta
 from typing import Optional
-import secrets
-import requests
+import functools
 import os
+import secrets
+import time
+import uuid
 
 from backend.database import get_db
-from backend.models import User, Group, SSOProvider
+from backend.invalidation import generations
+from backend.models import User, Group, SSOProvider, TokenSession
+from backend.oidc import OIDCError, oidc_client
+from backend.passwords import PasswordHasherBusy, password_hasher
+from backend.principals import Principal, load_principal, principal_cache
+from backend.revocation import revocation_list
+from backend.tokens import JWT_LEEWAY, token_service
 
 router = APIRouter(prefix="/api/auth", tags=["auth"])
 
-# Password hashing utils
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-# Constants for JWT
-SECRET_KEY = os.environ.get("SECRET_KEY", "supersecretkey")
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
-
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-def hash_password(password):
-    return pwd_context.hash(password)
+# Signing keys and algorithm are configured in backend/tokens.py. Access
+# tokens are short-lived; clients renew them with their refresh token,
+# without logging in again.
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.environ.get("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+
+def hasher_busy():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many logins at once, retry shortly",
+        headers={"Retry-After": "1"},
+    )
 
 def create_access_token(data: dict, expires_delta: Optional[int] = None):
-    from datetime import datetime, timedelta
-    to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=expires_delta or ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+    claims = {"jti": uuid.uuid4().hex, "typ": "access", **data}
+    return token_service.issue(claims, timedelta(minutes=expires_delta or ACCESS_TOKEN_EXPIRE_MINUTES))
 
-async def get_user(db: Session, username: str):
-    return db.query(User).filter(User.username == username).first()
+def session_tokens(username: str, sid: str, refresh_jti: str) -> dict:
+    return {
+        "access_token": create_access_token({"sub": username, "sid": sid}),
+        "refresh_token": token_service.issue(
+            {"sub": username, "sid": sid, "jti": refresh_jti, "typ": "refresh"},
+            timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+        ),
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    }
 
-async def authenticate_user(db: Session, username: str, password: str):
+async def open_session(db: AsyncSession, username: str) -> dict:
+    """
+    Record a new login and return its access and refresh tokens.
+    """
+    now = int(time.time())
+    session = TokenSession(
+        id=uuid.uuid4().hex,
+        username=username,
+        refresh_jti=uuid.uuid4().hex,
+        expires_at=now + REFRESH_TOKEN_EXPIRE_DAYS * 86400,
+    )
+    db.add(session)
+    # Logins are rare: a good time to forget expired sessions
+    await db.execute(delete(TokenSession).where(TokenSession.expires_at <= now))
+    await db.commit()
+    return session_tokens(username, session.id, session.refresh_jti)
+
+def access_revocation_expiry() -> int:
+    # Access tokens issued until now have all expired by then
+    return int(time.time()) + ACCESS_TOKEN_EXPIRE_MINUTES * 60 + JWT_LEEWAY
+
+async def get_user(db: AsyncSession, username: str):
+    # Only the password is checked: groups are loaded with the principal
+    result = await db.execute(select(User).where(User.username == username))
+    return result.scalars().first()
+
+async def authenticate_user(db: AsyncSession, username: str, password: str):
     user = await get_user(db, username)
     if not user:
         return False
-    if not verify_password(password, user.password_hash):
+    valid, new_hash = await password_hasher.verify_and_update(password, user.password_hash)
+    if not valid:
         return False
+    if new_hash:
+        # Stored with another cost factor: upgrade it while the password is known
+        user.password_hash = new_hash
+        await db.commit()
     return user
 
 # Dependency to get current user
 from fastapi.security import OAuth2PasswordBearer
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/token")
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def principal_from_token(token: str, db: AsyncSession) -> Optional[Principal]:
+    """
+    The user an access token was issued to, or None if the token is invalid.
+    """
+    payload = token_service.verify(token)
+    if payload is None or payload.get("typ") == "refresh":
+        return None
+    await revocation_list.ensure_fresh()
+    if revocation_list.is_revoked(payload.get("jti"), payload.get("sid")):
+        return None
+    username: str = payload.get("sub")
+    if username is None:
+        return None
+    # The session only connects on a cache miss
+    return await principal_cache.get(username, functools.partial(load_principal, db, username))
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    user = await get_user(db, username=username)
+    user = await principal_from_token(token, db)
     if user is None:
         raise credentials_exception
     return user
 
-async def get_current_active_user(current_user: User = Depends(get_current_user)):
+async def get_current_active_user(current_user: Principal = Depends(get_current_user)):
     # Add checks like is_active if needed
     return current_user
 
-async def admin_required(current_user: User = Depends(get_current_active_user)):
-    admin_group = next((g for g in current_user.groups if g.name == "admin"), None)
-    if not admin_group:
+async def admin_required(current_user: Principal = Depends(get_current_active_user)):
+    if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Not enough permissions")
     return current_user
 
 # LOGIN LOCAL - token generation
 @router.post("/token")
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = await authenticate_user(db, form_data.username, form_data.password)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+    try:
+        user = await authenticate_user(db, form_data.username, form_data.password)
+    except PasswordHasherBusy:
+        raise hasher_busy()
     if not user:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
-    access_token = create_access_token(data={"sub": user.username})
-    return {"access_token": access_token, "token_type": "bearer"}
+    return await open_session(db, user.username)
+
+@router.post("/refresh")
+async def refresh_access_token(body: dict, db: AsyncSession = Depends(get_db)):
+    """
+    New access and refresh tokens for a refresh token, which can't be used
+    again. Presenting a used one ends the session: it may have leaked.
+    """
+    invalid = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid refresh token",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    claims = token_service.verify(body.get("refresh_token") or "")
+    if claims is None or claims.get("typ") != "refresh":
+        raise invalid
+    username, sid, jti = claims.get("sub"), claims.get("sid"), claims.get("jti")
+    await revocation_list.ensure_fresh()
+    if revocation_list.is_revoked(jti, sid):
+        raise invalid
+    if await principal_cache.get(username, functools.partial(load_principal, db, username)) is None:
+        raise invalid
+
+    now = int(time.time())
+    new_jti = uuid.uuid4().hex
+    # Compare-and-set: of two refreshes with the same token, one wins
+    rotated = await db.execute(
+        update(TokenSession)
+        .where(TokenSession.id == sid, TokenSession.refresh_jti == jti, TokenSession.expires_at > now)
+        .values(refresh_jti=new_jti, expires_at=now + REFRESH_TOKEN_EXPIRE_DAYS * 86400)
+    )
+    if rotated.rowcount != 1:
+        if await db.get(TokenSession, sid) is not None:
+            await db.execute(delete(TokenSession).where(TokenSession.id == sid))
+            await revocation_list.revoke(db, sid, access_revocation_expiry())
+        raise invalid
+    await db.commit()
+    return session_tokens(username, sid, new_jti)
+
+@router.post("/logout")
+async def logout(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    """
+    End the session of an access token: its refresh token stops working,
+    and so do its access tokens, in every worker.
+    """
+    claims = token_service.verify(token)
+    if claims is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials",
+                            headers={"WWW-Authenticate": "Bearer"})
+    sid, jti = claims.get("sid"), claims.get("jti")
+    if sid:
+        await db.execute(delete(TokenSession).where(TokenSession.id == sid))
+        await revocation_list.revoke(db, sid, access_revocation_expiry())
+    elif jti:
+        await revocation_list.revoke(db, jti, int(claims.get("exp", 0)) + JWT_LEEWAY)
+    return {"message": "Logged out"}
 
 # USER INFO
 @router.get("/me")
-async def read_users_me(current_user: User = Depends(get_current_active_user)):
+async def read_users_me(current_user: Principal = Depends(get_current_active_user)):
     return {
         "id": current_user.id,
         "username": current_user.username,
@@ -99,31 +206,35 @@ async def read_users_me(current_user: User = Depends(get_current_active_user)):
 
 # REGISTER (admin only)
 @router.post("/register")
-async def register_user(user_data: dict, current_user: User = Depends(admin_required), db: Session = Depends(get_db)):
+async def register_user(user_data: dict, current_user: Principal = Depends(admin_required), db: AsyncSession = Depends(get_db)):
     username = user_data.get("username")
     email = user_data.get("email")
     password = user_data.get("password")
     if not username or not password:
         raise HTTPException(status_code=400, detail="Username and password required")
-    user_exist = await db.query(User).filter(User.username == username).first()
+    user_exist = (await db.execute(select(User).where(User.username == username))).scalars().first()
     if user_exist:
         raise HTTPException(status_code=400, detail="User already exists")
 
-    hashed_password = hash_password(password)
+    try:
+        hashed_password = await password_hasher.hash(password)
+    except PasswordHasherBusy:
+        raise hasher_busy()
     new_user = User(username=username, email=email, password_hash=hashed_password)
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    generations.bump("users")
+    await db.refresh(new_user)
     return {"message": "User created", "id": new_user.id}
 
-# LOGOUT - JWT strategy doesn’t require server logout but can be implemented with token blacklist if needed
-
 # --- SSO ROUTES (OAuth/OpenID Connect) ---
 from fastapi.responses import RedirectResponse
 
 @router.get("/login_sso/{provider_name}")
-async def login_sso(provider_name: str, request: Request, db: Session = Depends(get_db)):
-    provider = db.query(SSOProvider).filter(SSOProvider.name == provider_name, SSOProvider.enabled == True).first()
+async def login_sso(provider_name: str, request: Request, db: AsyncSession = Depends(get_db)):
+    provider = (await db.execute(
+        select(SSOProvider).where(SSOProvider.name == provider_name, SSOProvider.enabled == True)
+    )).scalars().first()
     if not provider:
         raise HTTPException(status_code=404, detail="SSO Provider not found")
 
@@ -132,66 +243,54 @@ async def login_sso(provider_name: str, request: Request, db: Session = Depends(
     # Here you need to save state in a place accessible to verify later (session, redis...)
     # For this example, skipping implementing session storage, but must be done in production
 
-    redirect_uri = request.url_for("auth.sso_callback", provider_name=provider_name)
+    try:
+        auth_url = await oidc_client.authorization_url(provider)
+    except OIDCError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    redirect_uri = request.url_for("sso_callback", provider_name=provider_name)
     params = {
         "response_type": "code",
         "client_id": provider.client_id,
-        "redirect_uri": redirect_uri,
+        "redirect_uri": str(redirect_uri),
         "scope": provider.scope,
         "state": state
     }
     from urllib.parse import urlencode
-    redirect_url = f"{provider.auth_url}?{urlencode(params)}"
+    redirect_url = f"{auth_url}?{urlencode(params)}"
     return RedirectResponse(redirect_url)
 
 @router.get("/sso/callback/{provider_name}")
-async def sso_callback(provider_name: str, request: Request, db: Session = Depends(get_db)):
+async def sso_callback(provider_name: str, request: Request, db: AsyncSession = Depends(get_db)):
     code = request.query_params.get("code")
     state = request.query_params.get("state")
 
     # Here verify state that was saved earlier
 
-    provider = db.query(SSOProvider).filter(SSOProvider.name == provider_name, SSOProvider.enabled == True).first()
+    provider = (await db.execute(
+        select(SSOProvider).where(SSOProvider.name == provider_name, SSOProvider.enabled == True)
+    )).scalars().first()
     if not provider:
         raise HTTPException(status_code=404, detail="SSO Provider not found")
 
-    token_response = requests.post(
-        provider.token_url,
-        data={
-            "grant_type": "authorization_code",
-            "code": code,
-            "redirect_uri": str(request.url_for("auth.sso_callback", provider_name=provider_name)),
-            "client_id": provider.client_id,
-            "client_secret": provider.client_secret,
-        },
-    )
-
-    if token_response.status_code != 200:
-        raise HTTPException(status_code=400, detail="Failed to get token from provider")
-
-    tokens = token_response.json()
-    access_token = tokens.get("access_token")
-
-    userinfo_response = requests.get(provider.userinfo_url, headers={"Authorization": f"Bearer {access_token}"})
-    if userinfo_response.status_code != 200:
-        raise HTTPException(status_code=400, detail="Failed to fetch user info")
-
-    userinfo = userinfo_response.json()
+    # Code exchange, then the ID token checked locally; userinfo only if it lacks the email
+    try:
+        userinfo = await oidc_client.identity(provider, code, str(request.url_for("sso_callback", provider_name=provider_name)))
+    except OIDCError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     email = userinfo.get("email")
     username = userinfo.get("preferred_username") or userinfo.get("email")
 
     # lookup user or create
-    user = db.query(User).filter(User.email == email).first()
+    user = (await db.execute(select(User).where(User.email == email))).scalars().first()
     if not user:
         user = User(username=username, email=email)
         db.add(user)
-        db.commit()
-        db.refresh(user)
-
-    # Create JWT token for user (or alternatively set session cookie)
-    access_token = create_access_token({"sub": user.username})
+        await db.commit()
+        generations.bump("users")
+        await db.refresh(user)
 
-    # return token or redirect with cookie
+    # Create JWT tokens for user (or alternatively set session cookie)
+    # return tokens or redirect with cookie
     # Here a redirect to frontend with token in query param or cookie is common
-    return {"access_token": access_token, "token_type": "bearer"}
\ No newline at end of file
+    return await open_session(db, user.username)
\ No newline at end of file
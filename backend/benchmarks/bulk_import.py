@@ -0,0 +1,90 @@
+"""
+Time to provision users with their group memberships on a fresh SQLite
+database: one ORM insert and commit per row (what a client calling the CRUD
+API once per entity costs the database, before HTTP round trips) against
+backend/bulk.py importing the same rows as NDJSON.
+
+Run from the repository root:
+
+    python -m backend.benchmarks.bulk_import --users 50000
+"""
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+
+from backend.bulk import BulkTransfer, parse_rows
+from backend.database import Base, make_async_engine
+from backend.invalidation import GenerationBus
+from backend.models import Group, User
+
+GROUPS = 20
+
+
+def rows(users: int):
+    return (
+        [{"username": f"user{i}", "email": f"user{i}@example.com"} for i in range(users)],
+        [{"user": f"user{i}", "group": f"group{i % GROUPS}"} for i in range(users)],
+    )
+
+def fresh_database(directory: str, name: str) -> str:
+    url = f"sqlite:///{directory}/{name}.db"
+    engine = create_engine(url)
+    Base.metadata.create_all(bind=engine)
+    with sessionmaker(bind=engine)() as session:
+        session.add_all(Group(name=f"group{i}") for i in range(GROUPS))
+        session.commit()
+    engine.dispose()
+    return url
+
+def one_by_one(url: str, users, memberships) -> float:
+    engine = create_engine(url)
+    start = time.perf_counter()
+    with sessionmaker(bind=engine)() as session:
+        for row in users:
+            session.add(User(**row))
+            session.commit()
+        groups = {group.name: group for group in session.scalars(select(Group))}
+        for row in memberships:
+            user = session.scalar(select(User).where(User.username == row["user"]))
+            user.groups.append(groups[row["group"]])
+            session.commit()
+    engine.dispose()
+    return time.perf_counter() - start
+
+async def bulk(url: str, directory: str, users, memberships) -> float:
+    engine = make_async_engine(url)
+    transfer = BulkTransfer(async_sessionmaker(engine, expire_on_commit=False), GenerationBus(f"{directory}/generations"))
+
+    async def body(records):
+        yield "".join(json.dumps(record) + "\n" for record in records).encode()
+
+    start = time.perf_counter()
+    for kind, records in (("users", users), ("user_groups", memberships)):
+        report = await transfer.import_rows(kind, parse_rows("ndjson", body(records)))
+        assert not report["failed"], report["errors"]
+    elapsed = time.perf_counter() - start
+    await engine.dispose()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--one-by-one-users", type=int, default=2000,
+                        help="rows imported one by one, the total is extrapolated")
+    args = parser.parse_args()
+    users, memberships = rows(args.users)
+    with tempfile.TemporaryDirectory() as directory:
+        sample = min(args.users, args.one_by_one_users)
+        elapsed = one_by_one(fresh_database(directory, "one_by_one"), users[:sample], memberships[:sample])
+        print(f"one by one: {elapsed * args.users / sample:8.1f} s (extrapolated from {sample} users)")
+        elapsed = asyncio.run(bulk(fresh_database(directory, "bulk"), directory, users, memberships))
+        print(f"bulk:       {elapsed:8.1f} s")
+
+if __name__ == "__main__":
+    main()
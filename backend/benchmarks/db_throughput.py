@@ -0,0 +1,125 @@
+"""
+Concurrent login + proxy-lookup throughput on SQLite, with the default
+SQLite settings and with the storage profile of backend/database.py.
+
+Run from the repository root:
+
+    python -m backend.benchmarks.db_throughput --seconds 5 --workers 4
+
+Each worker process (like uvicorn workers) runs concurrent readers doing
+the queries of a login (user by name with its groups) and of a proxied
+request resolved from the database (service by name), while a writer
+process keeps committing service updates like an admin would. Each
+profile runs against a fresh database file.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import selectinload, sessionmaker
+
+from backend.database import SQLITE_PRAGMAS, Base, make_async_engine
+from backend.models import Group, ProxyService, User
+
+USERS = 1000
+SERVICES = 50
+
+PROFILES = {
+    # SQLite defaults: rollback journal, FULL sync
+    "default": ({}, {"pool_size": 5, "max_overflow": 10}),
+    "tuned": (SQLITE_PRAGMAS, {}),
+}
+
+
+def seed(path: str):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    groups = [Group(name=f"group{i}") for i in range(10)]
+    with sessionmaker(bind=engine)() as session:
+        for i in range(USERS):
+            user = User(username=f"user{i}", email=f"user{i}@example.com", password_hash="x")
+            user.groups.append(groups[i % len(groups)])
+            session.add(user)
+        for i in range(SERVICES):
+            session.add(ProxyService(name=f"service{i}", base_url=f"http://service{i}.lan", enabled=True))
+        session.commit()
+    engine.dispose()
+
+async def reader(Session, deadline: float, counters: dict):
+    while time.monotonic() < deadline:
+        try:
+            async with Session() as db:
+                user = (await db.execute(
+                    select(User).options(selectinload(User.groups)).where(User.username == f"user{random.randrange(USERS)}")
+                )).scalars().first()
+                assert user.groups
+                service = (await db.execute(
+                    select(ProxyService).where(ProxyService.name == f"service{random.randrange(SERVICES)}")
+                )).scalars().first()
+                assert service.enabled
+            counters["reads"] += 1
+        except OperationalError:
+            counters["errors"] += 1
+
+async def writer(Session, deadline: float, counters: dict):
+    while time.monotonic() < deadline:
+        try:
+            async with Session() as db:
+                await db.execute(
+                    update(ProxyService)
+                    .where(ProxyService.name == f"service{random.randrange(SERVICES)}")
+                    .values(description=str(time.time()))
+                )
+                await db.commit()
+            counters["writes"] += 1
+        except OperationalError:
+            counters["errors"] += 1
+        await asyncio.sleep(0.01)
+
+async def run_worker(path: str, name: str, seconds: float, concurrency: int, write: bool) -> dict:
+    pragmas, pool = PROFILES[name]
+    engine = make_async_engine(f"sqlite+aiosqlite:///{path}", pragmas, **pool)
+    Session = async_sessionmaker(engine, expire_on_commit=False)
+    counters = {"reads": 0, "writes": 0, "errors": 0}
+    deadline = time.monotonic() + seconds
+    if write:
+        await writer(Session, deadline, counters)
+    else:
+        await asyncio.gather(*(reader(Session, deadline, counters) for _ in range(concurrency)))
+    await engine.dispose()
+    return counters
+
+def worker(args) -> dict:
+    return asyncio.run(run_worker(*args))
+
+def run_profile(name: str, seconds: float, workers: int, concurrency: int) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "centralarr.db")
+        seed(path)
+        jobs = [(path, name, seconds, concurrency, False)] * workers + [(path, name, seconds, concurrency, True)]
+        with multiprocessing.get_context("spawn").Pool(len(jobs)) as pool:
+            results = pool.map(worker, jobs)
+    totals = {key: sum(result[key] for result in results) for key in ("reads", "writes", "errors")}
+    totals["reads_per_second"] = totals["reads"] / seconds
+    return totals
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--workers", type=int, default=4, help="reader processes")
+    parser.add_argument("--concurrency", type=int, default=20, help="concurrent readers per worker")
+    args = parser.parse_args()
+    print(f"{'profile':<10}{'reads/s':>10}{'writes':>10}{'errors':>10}")
+    for name in PROFILES:
+        result = run_profile(name, args.seconds, args.workers, args.concurrency)
+        print(f"{name:<10}{result['reads_per_second']:>10.0f}{result['writes']:>10}{result['errors']:>10}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Access token verifications per second on one core: the former path
+(python-jose with the secret as a string, key rebuilt on every call) and
+backend/tokens.py with prepared HS256 / ES256 keys, with and without the
+memo of recent verifications.
+
+Run from the repository root:
+
+    python -m backend.benchmarks.token_verify --seconds 2
+"""
+import argparse
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from jose import jwt
+
+from backend.tokens import Keyring, TokenService
+
+SECRET_KEY = "supersecretkey"
+USERS = 1000
+
+
+def former_path():
+    # What auth.py did before backend/tokens.py
+    def issue(username):
+        return jwt.encode({"sub": username, "exp": datetime.utcnow() + timedelta(minutes=30)}, SECRET_KEY, algorithm="HS256")
+
+    def verify(token):
+        return jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+
+    return issue, verify
+
+def service_path(keyring: Keyring, cache_size: int):
+    tokens = TokenService(keyring, cache_size=cache_size, cache_ttl=60 if cache_size else 0)
+    return lambda username: tokens.issue({"sub": username}, timedelta(minutes=30)), tokens.verify
+
+def measure(issue, verify, seconds: float) -> float:
+    tokens = [issue(f"user{i}") for i in range(USERS)]
+    count = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for token in tokens[count % USERS:count % USERS + 100]:
+            assert verify(token)["sub"]
+        count += 100
+    return count / seconds
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=2)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as keys_dir:
+        es256 = Keyring.from_directory(keys_dir, "")
+        paths = {
+            "former (HS256)": former_path(),
+            "HS256 prepared": service_path(Keyring.from_secret(SECRET_KEY), 0),
+            "ES256 prepared": service_path(es256, 0),
+            "HS256 memoized": service_path(Keyring.from_secret(SECRET_KEY), 4096),
+            "ES256 memoized": service_path(es256, 4096),
+        }
+        print(f"{'path':<18}{'verifications/s':>18}")
+        for name, (issue, verify) in paths.items():
+            print(f"{name:<18}{measure(issue, verify, args.seconds):>18.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Load test of the websocket relay: opens thousands of proxied sockets
+against a local echo upstream and reports the server's memory per
+connection.
+
+Run from the repository root:
+
+    python -m backend.benchmarks.ws_relay_load --connections 2000
+
+uvicorn options go after "--", e.g. "-- --ws-per-message-deflate false"
+(clients negotiate permessage-deflate by default, which dominates the
+memory per socket).
+
+The app runs in a uvicorn subprocess on a throwaway database; the echo
+upstream and the clients run in this process, so the reported RSS is the
+relay's alone.
+"""
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from websockets.asyncio.client import connect
+from websockets.asyncio.server import serve
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def rss_kib(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    raise RuntimeError("VmRSS not found")
+
+def prepare_database(directory: str, echo_port: int):
+    from backend.database import Base
+    from backend.models import ProxyService
+
+    engine = create_engine(f"sqlite:///{directory}/centralarr.db")
+    Base.metadata.create_all(bind=engine)
+    with sessionmaker(bind=engine)() as session:
+        session.add(ProxyService(name="echo", base_url=f"http://127.0.0.1:{echo_port}", enabled=True))
+        session.commit()
+    engine.dispose()
+
+async def echo(connection):
+    async for message in connection:
+        await connection.send(message)
+
+async def open_socket(url: str, sockets: list, semaphore: asyncio.Semaphore):
+    async with semaphore:
+        ws = await connect(url, ping_interval=None, open_timeout=30)
+        await ws.send("hello")
+        assert await ws.recv() == "hello"
+        await ws.send(b"\x00" * 64)
+        assert await ws.recv() == b"\x00" * 64
+        sockets.append(ws)
+
+async def run(connections: int, concurrency: int, server_args: list):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if hard < connections * 2 + 100:
+        print(f"warning: open file limit {hard} is too low for {connections} connections")
+
+    async with serve(echo, "127.0.0.1", 0, compression=None) as echo_server:
+        echo_port = echo_server.sockets[0].getsockname()[1]
+        with tempfile.TemporaryDirectory() as directory:
+            prepare_database(directory, echo_port)
+            port = free_port()
+            env = dict(
+                os.environ,
+                PYTHONPATH=ROOT,
+                FLASK_ENV="dev",
+                CACHE_GENERATIONS_PATH=os.path.join(directory, "generations"),
+            )
+            server = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "backend.main:app", "--port", str(port),
+                 "--log-level", "warning", *server_args],
+                cwd=directory,
+                env=env,
+            )
+            try:
+                url = f"ws://127.0.0.1:{port}/api/proxy/echo/socket"
+                for _ in range(100):
+                    try:
+                        warmup = await connect(url)
+                        break
+                    except OSError:
+                        await asyncio.sleep(0.1)
+                else:
+                    raise RuntimeError("server did not start")
+                await warmup.send("warmup")
+                await warmup.recv()
+                await warmup.close()
+                await asyncio.sleep(0.5)
+
+                before = rss_kib(server.pid)
+                sockets = []
+                semaphore = asyncio.Semaphore(concurrency)
+                started = time.perf_counter()
+                await asyncio.gather(*(open_socket(url, sockets, semaphore) for _ in range(connections)))
+                elapsed = time.perf_counter() - started
+                await asyncio.sleep(0.5)
+                after = rss_kib(server.pid)
+
+                # Every socket still relays once they are all open
+                started_echo = time.perf_counter()
+                await asyncio.gather(*(ws.send("again") for ws in sockets))
+                assert all(reply == "again" for reply in await asyncio.gather(*(ws.recv() for ws in sockets)))
+                echo_elapsed = time.perf_counter() - started_echo
+
+                print(f"connections:          {len(sockets)}")
+                print(f"open time:            {elapsed:.2f} s")
+                print(f"round trip (all):     {echo_elapsed * 1000:.0f} ms")
+                print(f"server RSS before:    {before / 1024:.1f} MiB")
+                print(f"server RSS after:     {after / 1024:.1f} MiB")
+                print(f"memory per socket:    {(after - before) / len(sockets):.1f} KiB")
+
+                await asyncio.gather(*(ws.close() for ws in sockets))
+            finally:
+                server.terminate()
+                server.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200, help="sockets being opened at once")
+    parser.add_argument("server_args", nargs="*", help="extra uvicorn options, after --")
+    args = parser.parse_args()
+    asyncio.run(run(args.connections, args.concurrency, args.server_args))
+
+if __name__ == "__main__":
+    main()
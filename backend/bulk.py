@@ -0,0 +1,384 @@
+"""
+Bulk import and export of users, groups, permissions and the links between
+them, as NDJSON or CSV with one file per kind. Rows name users, groups and
+permissions instead of using ids, so an export loads into another database.
+
+Entities are created or updated by name; link rows are added, or removed
+with "op": "remove". Rows are applied in chunks, each a transaction of a few
+bulk statements. Invalid rows are skipped and reported with their line.
+
+    python -m backend.bulk import users users.ndjson
+    python -m backend.bulk import user_groups memberships.csv
+    python -m backend.bulk export users --format csv > users.csv
+"""
+import argparse
+import asyncio
+import codecs
+import csv
+import io
+import json
+import os
+import sys
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import Table, delete, insert, select, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.database import AsyncSessionLocal
+from backend.invalidation import GenerationBus, generations
+from backend.models import Group, Permission, User, group_permissions, user_groups, user_permissions
+
+# Rows per transaction
+BULK_CHUNK_ROWS = int(os.environ.get("BULK_CHUNK_ROWS", "1000"))
+# Errors listed in an import report (all of them are counted)
+MAX_REPORTED_ERRORS = 100
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+class BulkError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class EntityKind:
+    model: Any
+    key: str  # unique name column
+    required: Tuple[str, ...]
+    optional: Tuple[str, ...]
+    generation: str
+
+    @property
+    def fields(self) -> Tuple[str, ...]:
+        return self.required + self.optional
+
+
+@dataclass(frozen=True)
+class LinkKind:
+    table: Table
+    # (field in files, model, its name column, column of the table)
+    left: Tuple[str, Any, str, str]
+    right: Tuple[str, Any, str, str]
+    generation: str
+
+    @property
+    def fields(self) -> Tuple[str, ...]:
+        return self.left[0], self.right[0]
+
+
+KINDS = {
+    "users": EntityKind(User, "username", ("username", "email"), ("password_hash",), "users"),
+    "groups": EntityKind(Group, "name", ("name",), (), "groups"),
+    "permissions": EntityKind(Permission, "name", ("name",), ("description",), "permissions"),
+    "user_groups": LinkKind(user_groups, ("user", User, "username", "user_id"), ("group", Group, "name", "group_id"), "users"),
+    "user_permissions": LinkKind(
+        user_permissions, ("user", User, "username", "user_id"), ("permission", Permission, "name", "permission_id"), "users"
+    ),
+    "group_permissions": LinkKind(
+        group_permissions, ("group", Group, "name", "group_id"), ("permission", Permission, "name", "permission_id"), "groups"
+    ),
+}
+
+
+# --- Input ---
+
+async def read_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    async for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+async def ndjson_rows(lines: AsyncIterator[str]):
+    number = 0
+    async for line in lines:
+        number += 1
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, BulkError("Invalid JSON")
+            continue
+        yield number, row if isinstance(row, dict) else BulkError("Expected a JSON object")
+
+async def csv_rows(lines: AsyncIterator[str]):
+    """
+    Rows of a CSV file with a header line; empty cells are missing values.
+    Quoted cells may span lines.
+    """
+    header, record, number, start = None, "", 0, 0
+    async for line in lines:
+        number += 1
+        record, start = (record + "\n" + line, start) if record else (line, number)
+        if record.count('"') % 2:
+            continue  # inside a quoted cell
+        values, record = next(csv.reader([record.rstrip("\r")]), []), ""
+        if not any(values):
+            continue
+        if header is None:
+            header = [name.strip() for name in values]
+        elif len(values) != len(header):
+            yield start, BulkError(f"Expected {len(header)} cells")
+        else:
+            yield start, {name: value for name, value in zip(header, values) if value != ""}
+    if record:
+        yield start, BulkError("Unterminated quoted cell")
+
+def parse_rows(format: str, chunks: AsyncIterator[bytes]):
+    if format not in FORMATS:
+        raise ValueError(f"Unsupported format: {format}")
+    return (csv_rows if format == "csv" else ndjson_rows)(read_lines(chunks))
+
+
+# --- Output ---
+
+async def ndjson_lines(rows: AsyncIterator[dict]):
+    async for row in rows:
+        yield json.dumps(row).encode() + b"\n"
+
+async def csv_lines(fields, rows: AsyncIterator[dict]):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fields, lineterminator="\n")
+    writer.writeheader()
+    async for row in rows:
+        writer.writerow(row)
+        if buffer.tell() > 65536:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def text_values(row: dict, fields, required=()) -> dict:
+    for field in required:
+        if not row.get(field):
+            raise BulkError(f"Missing {field}")
+    values = {field: row[field] for field in fields if row.get(field) is not None}
+    for field, value in values.items():
+        if not isinstance(value, str):
+            raise BulkError(f"{field} must be a string")
+    return values
+
+
+class BulkTransfer:
+    """
+    Imports and exports on their own sessions: exports are streamed after
+    the request's session has closed.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], AsyncSession] = AsyncSessionLocal,
+        bus: GenerationBus = generations,
+        chunk_rows: int = BULK_CHUNK_ROWS,
+    ):
+        self.session_factory = session_factory
+        self.bus = bus
+        self.chunk_rows = chunk_rows
+
+    # Import
+
+    async def _upsert(self, db: AsyncSession, kind: EntityKind, rows):
+        counts, errors = {"created": 0, "updated": 0}, []
+        by_key = {}
+        for line, row in rows:
+            try:
+                values = text_values(row, kind.fields, kind.required)
+            except BulkError as e:
+                errors.append((line, str(e)))
+                continue
+            by_key[values[kind.key]] = values  # the last row wins
+        if not by_key:
+            return counts, errors
+        key = getattr(kind.model, kind.key)
+        existing = dict((await db.execute(select(key, kind.model.id).where(key.in_(list(by_key))))).all())
+        created = [values for name, values in by_key.items() if name not in existing]
+        updated = [{"id": existing[name], **values} for name, values in by_key.items() if name in existing]
+        if created:
+            await db.execute(insert(kind.model), created)
+        if updated:
+            await db.execute(update(kind.model), updated)
+        counts["created"], counts["updated"] = len(created), len(updated)
+        return counts, errors
+
+    async def _ids(self, db: AsyncSession, model, column: str, names) -> Dict[str, int]:
+        name = getattr(model, column)
+        return dict((await db.execute(select(name, model.id).where(name.in_(list(names))))).all())
+
+    async def _link(self, db: AsyncSession, kind: LinkKind, rows):
+        counts, errors = {"linked": 0, "unlinked": 0}, []
+        (left, left_model, left_name, left_column), (right, right_model, right_name, right_column) = kind.left, kind.right
+        parsed = []
+        for line, row in rows:
+            try:
+                values = text_values(row, (left, right, "op"), (left, right))
+                if values.get("op", "add") not in ("add", "remove"):
+                    raise BulkError("op must be add or remove")
+            except BulkError as e:
+                errors.append((line, str(e)))
+                continue
+            parsed.append((line, values))
+        left_ids = await self._ids(db, left_model, left_name, {values[left] for _, values in parsed})
+        right_ids = await self._ids(db, right_model, right_name, {values[right] for _, values in parsed})
+
+        ops = {}
+        for line, values in parsed:
+            if values[left] not in left_ids:
+                errors.append((line, f"Unknown {left} {values[left]}"))
+            elif values[right] not in right_ids:
+                errors.append((line, f"Unknown {right} {values[right]}"))
+            else:
+                ops[left_ids[values[left]], right_ids[values[right]]] = values.get("op", "add")
+        if not ops:
+            return counts, errors
+        columns = kind.table.c[left_column], kind.table.c[right_column]
+        pair = tuple_(*columns)
+        existing = set(map(tuple, (await db.execute(select(*columns).where(pair.in_(list(ops))))).all()))
+        added = [{left_column: l, right_column: r} for (l, r), op in ops.items() if op == "add" and (l, r) not in existing]
+        removed = [key for key, op in ops.items() if op == "remove" and key in existing]
+        if added:
+            await db.execute(insert(kind.table), added)
+        if removed:
+            await db.execute(delete(kind.table).where(pair.in_(removed)))
+        counts["linked"], counts["unlinked"] = len(added), len(removed)
+        return counts, errors
+
+    async def _apply_chunk(self, db: AsyncSession, kind, rows, report: dict):
+        apply = self._upsert if isinstance(kind, EntityKind) else self._link
+        try:
+            results = [await apply(db, kind, rows)]
+            await db.commit()
+        except IntegrityError:
+            # Apply the rows one by one to find those at fault
+            await db.rollback()
+            results = []
+            for line, row in rows:
+                try:
+                    results.append(await apply(db, kind, [(line, row)]))
+                    await db.commit()
+                except IntegrityError:
+                    await db.rollback()
+                    results.append(({}, [(line, "Conflicts with an existing row")]))
+        for counts, errors in results:
+            for name, count in counts.items():
+                report[name] += count
+            for line, error in errors:
+                self._error(report, line, error)
+
+    def _error(self, report: dict, line: int, error: str):
+        report["failed"] += 1
+        if len(report["errors"]) < MAX_REPORTED_ERRORS:
+            report["errors"].append({"line": line, "error": error})
+
+    async def import_rows(self, kind_name: str, rows) -> dict:
+        """
+        Apply (line, row) pairs of a kind and return the report. Rows given
+        as BulkError are reported as such.
+        """
+        kind = KINDS[kind_name]
+        report = {"rows": 0, "created": 0, "updated": 0, "linked": 0, "unlinked": 0, "failed": 0, "errors": []}
+        async with self.session_factory() as db:
+            chunk = []
+            async for line, row in rows:
+                report["rows"] += 1
+                if isinstance(row, BulkError):
+                    self._error(report, line, str(row))
+                    continue
+                chunk.append((line, row))
+                if len(chunk) >= self.chunk_rows:
+                    await self._apply_chunk(db, kind, chunk, report)
+                    chunk = []
+            if chunk:
+                await self._apply_chunk(db, kind, chunk, report)
+        report["errors"].sort(key=lambda error: error["line"])
+        if report["created"] or report["updated"] or report["linked"] or report["unlinked"]:
+            # Caches and the permission index of every worker reload
+            self.bus.bump(kind.generation)
+        return report
+
+    # Export
+
+    async def export_rows(self, kind_name: str, include_password_hashes: bool = False) -> AsyncIterator[dict]:
+        """
+        Every row of a kind in import format, read chunk by chunk in keyset
+        order.
+        """
+        kind = KINDS[kind_name]
+        fields = self.fields(kind_name, include_password_hashes)
+        if isinstance(kind, EntityKind):
+            order = (kind.model.id,)
+            statement = select(*(getattr(kind.model, name) for name in fields), kind.model.id)
+        else:
+            (left, left_model, left_name, left_column), (right, right_model, right_name, right_column) = kind.left, kind.right
+            order = (kind.table.c[left_column], kind.table.c[right_column])
+            statement = (
+                select(getattr(left_model, left_name).label(left), getattr(right_model, right_name).label(right), *order)
+                .join(left_model, left_model.id == order[0])
+                .join(right_model, right_model.id == order[1])
+            )
+        statement = statement.order_by(*order).limit(self.chunk_rows)
+        async with self.session_factory() as db:
+            after = None
+            while True:
+                page = statement
+                if after is not None:
+                    page = page.where(tuple_(*order) > tuple_(*after) if len(order) > 1 else order[0] > after[0])
+                rows = (await db.execute(page)).all()
+                for row in rows:
+                    yield {name: value for name, value in zip(fields, row) if value is not None}
+                if len(rows) < self.chunk_rows:
+                    return
+                after = rows[-1][len(fields):]
+
+    def fields(self, kind_name: str, include_password_hashes: bool = False) -> List[str]:
+        return [name for name in KINDS[kind_name].fields if name != "password_hash" or include_password_hashes]
+
+    def export(self, kind_name: str, format: str, include_password_hashes: bool = False) -> AsyncIterator[bytes]:
+        rows = self.export_rows(kind_name, include_password_hashes)
+        if format == "csv":
+            return csv_lines(self.fields(kind_name, include_password_hashes), rows)
+        return ndjson_lines(rows)
+
+
+bulk_transfer = BulkTransfer()
+
+
+async def file_chunks(path: str) -> AsyncIterator[bytes]:
+    with (sys.stdin.buffer if path == "-" else open(path, "rb")) as f:
+        while chunk := f.read(65536):
+            yield chunk
+
+async def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Bulk import and export of users, groups, permissions and their links")
+    commands = parser.add_subparsers(dest="command", required=True)
+    importing = commands.add_parser("import")
+    importing.add_argument("kind", choices=KINDS)
+    importing.add_argument("file", help="NDJSON or CSV file, - for stdin")
+    importing.add_argument("--format", choices=FORMATS, help="by default from the file extension")
+    exporting = commands.add_parser("export")
+    exporting.add_argument("kind", choices=KINDS)
+    exporting.add_argument("--format", choices=FORMATS, default="ndjson")
+    exporting.add_argument("--include-password-hashes", action="store_true")
+    args = parser.parse_args(argv)
+
+    from backend.migrations import upgrade
+    upgrade()
+    if args.command == "import":
+        format = args.format or ("csv" if args.file.endswith(".csv") else "ndjson")
+        report = await bulk_transfer.import_rows(args.kind, parse_rows(format, file_chunks(args.file)))
+        print(json.dumps(report, indent=2))
+        return 1 if report["failed"] else 0
+    async for chunk in bulk_transfer.export(args.kind, args.format, args.include_password_hashes):
+        sys.stdout.buffer.write(chunk)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,552 @@
+import asyncio
+import dataclasses
+import hashlib
+import json
+import os
+import shutil
+import struct
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+# Memory tier size and largest response kept in the cache
+PROXY_CACHE_MAX_BYTES = int(os.environ.get("PROXY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+PROXY_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("PROXY_CACHE_MAX_ENTRY_BYTES", str(8 * 1024 * 1024)))
+# Optional disk tier, e.g. /opt/centralarr/db/cache (empty = memory only)
+PROXY_CACHE_DIR = os.environ.get("PROXY_CACHE_DIR", "")
+PROXY_CACHE_DISK_MAX_BYTES = int(os.environ.get("PROXY_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# Headers carrying the user's identity, handled like Authorization (RFC 9111 3.5)
+CREDENTIAL_HEADERS = {
+    "authorization",
+    "cookie",
+    "x-emby-authorization",
+    "x-emby-token",
+    "x-mediabrowser-token",
+    "x-api-key",
+}
+
+# Never stored with a cached response
+UNCACHED_HEADERS = {
+    "connection",
+    "keep-alive",
+    "transfer-encoding",
+    "content-length",
+    "age",
+}
+
+CACHEABLE_STATUS_CODES = {200, 203, 301, 308, 404, 410}
+
+# Client validators, replaced by the cache's own when it revalidates an entry
+CONDITIONAL_HEADERS = {
+    "if-none-match",
+    "if-modified-since",
+    "if-match",
+    "if-unmodified-since",
+    "if-range",
+}
+
+# Headers sent with a 304 Not Modified (RFC 9110 15.4.5)
+NOT_MODIFIED_HEADERS = {
+    "cache-control",
+    "content-location",
+    "date",
+    "etag",
+    "expires",
+    "last-modified",
+    "vary",
+}
+
+
+def parse_cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    """
+    Parse a Cache-Control header into {directive: argument or None}.
+    """
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, argument = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') if argument else None
+    return directives
+
+def _seconds(value: Optional[str]) -> Optional[int]:
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+def _http_date(value: Optional[str]) -> Optional[float]:
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def cache_key(service_name: str, path: str, query: str) -> str:
+    return f"{service_name}\n/{path.lstrip('/')}?{query}"
+
+def has_credentials(request_headers) -> bool:
+    return any(name in request_headers for name in CREDENTIAL_HEADERS)
+
+def request_cache_policy(method: str, request_headers) -> Tuple[bool, bool]:
+    """
+    Return (may_serve_from_cache, may_store_response) for a client request.
+    """
+    if method != "GET" or "range" in request_headers:
+        return False, False
+    directives = parse_cache_control(request_headers.get("cache-control"))
+    if "no-store" in directives:
+        return False, False
+    # Hard reloads go to the upstream but still refresh the cache
+    may_serve = "no-cache" not in directives and directives.get("max-age") != "0"
+    if request_headers.get("pragma", "").lower() == "no-cache":
+        may_serve = False
+    return may_serve, True
+
+def freshness_lifetime(response_headers, default_ttl: Optional[int]) -> int:
+    """
+    Shared-cache freshness lifetime in seconds: s-maxage, max-age, Expires,
+    then the service's default TTL.
+    """
+    directives = parse_cache_control(response_headers.get("cache-control"))
+    if "no-cache" in directives:
+        return 0
+    for directive in ("s-maxage", "max-age"):
+        if directive in directives:
+            return _seconds(directives[directive]) or 0
+    expires = response_headers.get("expires")
+    if expires is not None:
+        expires_at = _http_date(expires)
+        date = _http_date(response_headers.get("date")) or time.time()
+        return max(int(expires_at - date), 0) if expires_at else 0
+    return default_ttl or 0
+
+def storable_lifetime(request_headers, status_code: int, response_headers, default_ttl: Optional[int]) -> Optional[int]:
+    """
+    Freshness lifetime if the response may be stored by a shared cache,
+    None otherwise. Responses that are stale right away are still stored
+    when they carry a validator, to be revalidated with a 304.
+    """
+    if status_code not in CACHEABLE_STATUS_CODES:
+        return None
+    directives = parse_cache_control(response_headers.get("cache-control"))
+    if "no-store" in directives or "private" in directives:
+        return None
+    if response_headers.get("vary", "").strip() == "*" or "set-cookie" in response_headers:
+        return None
+    # The key has no identity: a credentialed answer is only shared when the
+    # upstream says so, and never for the service's default TTL
+    credentialed = has_credentials(request_headers)
+    if credentialed and not ("public" in directives or "s-maxage" in directives):
+        return None
+    lifetime = freshness_lifetime(response_headers, None if credentialed else default_ttl)
+    if lifetime > 0:
+        return lifetime
+    return 0 if "etag" in response_headers or "last-modified" in response_headers else None
+
+def _etags(value: str) -> List[str]:
+    # Weak comparison (RFC 9110 8.8.3.2): W/"x" and "x" match
+    return [tag.strip().removeprefix("W/") for tag in value.split(",") if tag.strip()]
+
+
+@dataclass
+class CacheEntry:
+    key: str
+    status_code: int
+    headers: List[Tuple[str, str]]
+    body: bytes
+    date: float  # when the upstream generated the response
+    expires_at: float
+    vary: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(k) + len(v) for k, v in self.headers) + len(self.key)
+
+    def is_fresh(self, now: Optional[float] = None) -> bool:
+        return (now or time.time()) < self.expires_at
+
+    def age(self, now: Optional[float] = None) -> int:
+        return max(int((now or time.time()) - self.date), 0)
+
+    def matches(self, request_headers) -> bool:
+        """
+        The stored variant fits this request (Vary).
+        """
+        return all(request_headers.get(name, "") == value for name, value in self.vary.items())
+
+    def header(self, name: str) -> Optional[str]:
+        for k, v in self.headers:
+            if k.lower() == name:
+                return v
+        return None
+
+    def validators(self) -> Dict[str, str]:
+        """
+        Conditional request headers revalidating this entry upstream.
+        """
+        conditional = {}
+        etag = self.header("etag")
+        if etag is not None:
+            conditional["If-None-Match"] = etag
+        last_modified = self.header("last-modified")
+        if last_modified is not None:
+            conditional["If-Modified-Since"] = last_modified
+        return conditional
+
+    def not_modified(self, request_headers) -> bool:
+        """
+        The client's copy is the stored one (If-None-Match, or
+        If-Modified-Since when no ETag was sent).
+        """
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None:
+            etag = self.header("etag")
+            tags = _etags(if_none_match)
+            return "*" in tags or (etag is not None and etag.strip().removeprefix("W/") in tags)
+        since = _http_date(request_headers.get("if-modified-since"))
+        last_modified = _http_date(self.header("last-modified"))
+        return since is not None and last_modified is not None and last_modified <= since
+
+    def refreshed(self, response_headers, default_ttl: Optional[int]) -> "CacheEntry":
+        """
+        Copy of the entry updated by a 304 from the upstream: its headers
+        replace the stored ones and its freshness restarts (RFC 9111 4.3.4).
+        """
+        updated = {k.lower() for k in response_headers.keys()} - UNCACHED_HEADERS
+        headers = [(k, v) for k, v in self.headers if k.lower() not in updated]
+        headers += [(k, v) for k, v in response_headers.multi_items() if k.lower() in updated]
+        date = time.time() - (_seconds(response_headers.get("age")) or 0)
+        lifetime = freshness_lifetime({k.lower(): v for k, v in headers}, default_ttl)
+        return dataclasses.replace(self, headers=headers, date=date, expires_at=date + lifetime)
+
+    def to_bytes(self) -> bytes:
+        meta = json.dumps({
+            "key": self.key,
+            "status_code": self.status_code,
+            "headers": self.headers,
+            "date": self.date,
+            "expires_at": self.expires_at,
+            "vary": self.vary,
+        }).encode("utf-8")
+        return struct.pack("!I", len(meta)) + meta + self.body
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "CacheEntry":
+        (meta_length,) = struct.unpack_from("!I", data)
+        meta = json.loads(data[4:4 + meta_length])
+        meta["headers"] = [tuple(header) for header in meta["headers"]]
+        return cls(body=data[4 + meta_length:], **meta)
+
+
+class MemoryTier:
+    """
+    LRU of cache entries bounded by their total size in bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, entry: CacheEntry) -> int:
+        """
+        Store an entry, returns the number of entries evicted to make room.
+        """
+        self.pop(entry.key)
+        self._entries[entry.key] = entry
+        self.bytes += entry.size
+        evicted = 0
+        while self.bytes > self.max_bytes and self._entries:
+            _, old = self._entries.popitem(last=False)
+            self.bytes -= old.size
+            evicted += 1
+        return evicted
+
+    def pop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def purge(self, service_name: str):
+        # Snapshot the keys first, entries are popped while iterating
+        for key in list(self._entries):
+            if key.split("\n", 1)[0] == service_name:
+                self.pop(key)
+
+
+class DiskTier:
+    """
+    One file per entry under <directory>/<service hash>/, bounded by total
+    bytes. Used by all workers, each keeping its own LRU index: the bound
+    is approximate and files removed by another worker read as misses.
+    Methods block and are meant for the threadpool.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for service_dir in os.scandir(directory):
+            if service_dir.is_dir():
+                for entry in os.scandir(service_dir.path):
+                    stat = entry.stat()
+                    files.append((stat.st_atime, entry.path, stat.st_size))
+        for _, path, size in sorted(files):
+            self._index[path] = size
+            self.bytes += size
+
+    def _service_dir(self, service_name: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(service_name.encode("utf-8")).hexdigest()[:16])
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._service_dir(key.split("\n", 1)[0]), hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = CacheEntry.from_bytes(f.read())
+        except (OSError, ValueError):
+            self._forget(path)
+            return None
+        if path in self._index:
+            self._index.move_to_end(path)
+        return entry if entry.key == key else None
+
+    def put(self, entry: CacheEntry) -> int:
+        path = self._path(entry.key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = entry.to_bytes()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._forget(path)
+        self._index[path] = len(data)
+        self.bytes += len(data)
+        evicted = 0
+        while self.bytes > self.max_bytes and self._index:
+            old_path, _ = next(iter(self._index.items()))
+            self._forget(old_path)
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+            evicted += 1
+        return evicted
+
+    def _forget(self, path: str):
+        size = self._index.pop(path, None)
+        if size is not None:
+            self.bytes -= size
+
+    def purge(self, service_name: str):
+        service_dir = self._service_dir(service_name)
+        for path in list(self._index):
+            if os.path.dirname(path) == service_dir:
+                self._forget(path)
+        shutil.rmtree(service_dir, ignore_errors=True)
+
+
+class ResponseCache:
+    """
+    Two-tier cache of upstream responses: a byte-bounded LRU in memory and
+    an optional disk tier. Entries found on disk are promoted to memory.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = PROXY_CACHE_MAX_BYTES,
+        max_entry_bytes: int = PROXY_CACHE_MAX_ENTRY_BYTES,
+        directory: str = PROXY_CACHE_DIR,
+        disk_max_bytes: int = PROXY_CACHE_DISK_MAX_BYTES,
+    ):
+        self.max_entry_bytes = max_entry_bytes
+        self.memory = MemoryTier(max_bytes)
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self._disk: Optional[DiskTier] = None
+        self._opening: Optional["asyncio.Task[DiskTier]"] = None
+        self.counters = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "disk_evictions": 0,
+            "revalidations": 0,
+            "collapsed_revalidations": 0,
+            "not_modified": 0,
+        }
+        self._revalidations: Dict[str, "asyncio.Task[Optional[CacheEntry]]"] = {}
+
+    @property
+    def disk(self) -> Optional[DiskTier]:
+        return self._disk
+
+    async def open_disk(self) -> Optional[DiskTier]:
+        """
+        The disk tier, built in the threadpool the first time: it indexes
+        every file already there. Called at startup, and by the first
+        lookup otherwise.
+        """
+        if self._disk is None and self.directory:
+            if self._opening is None:
+                self._opening = asyncio.get_running_loop().create_task(
+                    run_in_threadpool(DiskTier, self.directory, self.disk_max_bytes)
+                )
+            try:
+                self._disk = await asyncio.shield(self._opening)
+            except OSError:
+                self._opening = None  # tried again by the next lookup
+                raise
+        return self._disk
+
+    async def get(self, key: str, request_headers) -> Optional[CacheEntry]:
+        """
+        Return the stored entry matching the request, fresh or not.
+        """
+        entry = self.memory.get(key)
+        disk = self._disk or await self.open_disk()
+        if entry is None and disk is not None:
+            entry = await run_in_threadpool(disk.get, key)
+            if entry is not None:
+                self.counters["disk_hits"] += 1
+                self.counters["evictions"] += self.memory.put(entry)
+        if entry is None or not entry.matches(request_headers):
+            return None
+        return entry
+
+    async def lookup(self, key: str, request_headers) -> Optional[CacheEntry]:
+        """
+        get() that counts a hit when the entry can be served as-is.
+        """
+        entry = await self.get(key, request_headers)
+        if entry is not None and entry.is_fresh():
+            self.counters["hits"] += 1
+        else:
+            self.counters["misses"] += 1
+        return entry
+
+    async def put(self, entry: CacheEntry):
+        self.counters["stores"] += 1
+        self.counters["evictions"] += self.memory.put(entry)
+        disk = self._disk or await self.open_disk()
+        if disk is not None:
+            self.counters["disk_evictions"] += await run_in_threadpool(disk.put, entry)
+
+    async def revalidate(
+        self, entry: CacheEntry, fetch: Callable[[], Awaitable[Optional[CacheEntry]]],
+    ) -> Optional[CacheEntry]:
+        """
+        Refresh a stale entry with fetch(), which asks the upstream and
+        returns the new entry (None if it cannot be cached anymore).
+        Concurrent revalidations of the same key wait for the first one,
+        which runs in its own task so a client going away does not fail
+        the others.
+        """
+        task = self._revalidations.get(entry.key)
+        if task is None:
+            self.counters["revalidations"] += 1
+            task = asyncio.get_running_loop().create_task(fetch())
+            self._revalidations[entry.key] = task
+            task.add_done_callback(lambda done: self._revalidation_done(entry.key, done))
+        else:
+            self.counters["collapsed_revalidations"] += 1
+        return await asyncio.shield(task)
+
+    def _revalidation_done(self, key: str, task: "asyncio.Task"):
+        if self._revalidations.get(key) is task:
+            del self._revalidations[key]
+
+    def writer(self, key: str, request_headers, resp, lifetime: int) -> "CacheWriter":
+        return CacheWriter(self, key, request_headers, resp, lifetime)
+
+    def purge(self, service_name: str):
+        """
+        Forget everything cached for a service (re-targeted or removed).
+        """
+        self.memory.purge(service_name)
+        if self.disk is not None:
+            self.disk.purge(service_name)
+
+    def stats(self) -> dict:
+        stats = dict(self.counters)
+        stats["entries"] = len(self.memory)
+        stats["bytes"] = self.memory.bytes
+        stats["max_bytes"] = self.memory.max_bytes
+        if self.disk is not None:
+            stats["disk_bytes"] = self.disk.bytes
+            stats["disk_max_bytes"] = self.disk.max_bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+class CacheWriter:
+    """
+    Collects a response body while it streams to the client, and stores it
+    once complete. Gives up as soon as the body exceeds max_entry_bytes.
+    """
+
+    def __init__(self, cache: ResponseCache, key: str, request_headers, resp, lifetime: int):
+        self.cache = cache
+        self.key = key
+        self.resp = resp
+        self.lifetime = lifetime
+        self.vary = {
+            name: request_headers.get(name, "")
+            for name in (part.strip().lower() for part in resp.headers.get("vary", "").split(","))
+            if name
+        }
+        self._chunks: Optional[List[bytes]] = []
+        self._size = 0
+
+    @property
+    def gave_up(self) -> bool:
+        return self._chunks is None
+
+    def feed(self, chunk: bytes):
+        if self._chunks is None:
+            return
+        self._size += len(chunk)
+        if self._size > self.cache.max_entry_bytes:
+            self._chunks = None
+        else:
+            self._chunks.append(chunk)
+
+    async def commit(self) -> Optional[CacheEntry]:
+        if self._chunks is None:
+            return None
+        now = time.time()
+        date = now - (_seconds(self.resp.headers.get("age")) or 0)
+        entry = CacheEntry(
+            key=self.key,
+            status_code=self.resp.status_code,
+            headers=[(k, v) for k, v in self.resp.headers.multi_items() if k.lower() not in UNCACHED_HEADERS],
+            body=b"".join(self._chunks),
+            date=date,
+            expires_at=date + self.lifetime,
+            vary=self.vary,
+        )
+        await self.cache.put(entry)
+        return entry
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,193 @@
+import asyncio
+import hashlib
+import os
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import anyio
+import httpx
+
+from backend.cache import CREDENTIAL_HEADERS
+
+# Largest response body shared between identical requests (0 = no coalescing)
+PROXY_COALESCE_MAX_BYTES = int(os.environ.get("PROXY_COALESCE_MAX_BYTES", str(4 * 1024 * 1024)))
+
+# Request headers that can change the upstream answer: identity first, so
+# two users never share a response, then content negotiation
+COALESCE_KEY_HEADERS = sorted(CREDENTIAL_HEADERS | {
+    "cookie",
+    "accept",
+    "accept-encoding",
+    "accept-language",
+})
+
+
+def coalesce_key(service_name: str, path: str, query: str, request_headers) -> str:
+    digest = hashlib.sha256()
+    for part in (service_name, path.lstrip("/"), query):
+        digest.update(part.encode("utf-8") + b"\0")
+    for name in COALESCE_KEY_HEADERS:
+        digest.update(name.encode("latin-1") + b":" + request_headers.get(name, "").encode("latin-1") + b"\0")
+    return digest.hexdigest()
+
+def is_coalescable(method: str, request_headers) -> bool:
+    """
+    Only plain GETs: no body, no byte range (each seek asks for its own).
+    """
+    if method != "GET" or "range" in request_headers:
+        return False
+    return request_headers.get("content-length", "0") == "0" and "transfer-encoding" not in request_headers
+
+
+class Flight:
+    """
+    One upstream request shared by identical concurrent client requests.
+    The body is read by a task of its own and kept until complete, so
+    every waiter streams it from the start at its own pace, and a client
+    going away does not affect the others.
+    """
+
+    def __init__(self):
+        self.response: Optional[httpx.Response] = None
+        self.error: Optional[BaseException] = None
+        self.shared = False
+        self.done = False
+        self.ready = asyncio.Event()
+        self._chunks: List[bytes] = []
+        self._more = asyncio.Event()
+        self._claimed = False
+        self._abandoned = False
+
+    def claim(self) -> bool:
+        """
+        True for the first caller only, e.g. to store the response once.
+        """
+        claimed, self._claimed = self._claimed, True
+        return not claimed
+
+    def _notify(self):
+        more, self._more = self._more, asyncio.Event()
+        more.set()
+
+    def abandon(self):
+        # The leader left before the headers: an unshared response is
+        # nobody's, close it
+        self._abandoned = True
+        if self.ready.is_set() and not self.shared and self.response is not None:
+            asyncio.get_running_loop().create_task(self.response.aclose())
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        index = 0
+        while True:
+            while index < len(self._chunks):
+                yield self._chunks[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._more.wait()
+
+
+class RequestCoalescer:
+    """
+    Single-flight for upstream GETs: identical requests in flight at the
+    same time (same service, URL, credentials and negotiation headers)
+    share one upstream call.
+
+    Only responses of known length up to max_bytes are shared; others (and
+    HTML pages, which get the JS injected per request) go back to their
+    leader and the other waiters send their own request.
+    """
+
+    def __init__(self, max_bytes: int = PROXY_COALESCE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._flights: Dict[str, Flight] = {}
+        self.counters = {
+            "flights": 0,
+            "coalesced": 0,
+            "fallbacks": 0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def shareable(self, resp: httpx.Response) -> bool:
+        content_length = resp.headers.get("content-length", "")
+        return content_length.isdigit() and int(content_length) <= self.max_bytes
+
+    async def send(
+        self,
+        key: str,
+        send: Callable[[], Awaitable[httpx.Response]],
+        rewritten: Callable[[httpx.Response], bool],
+    ) -> Tuple[httpx.Response, Optional[Flight]]:
+        """
+        Send the request unless an identical one is in flight. Returns the
+        upstream response and, when it is shared, the flight to stream the
+        body from. Without a flight the caller owns the response.
+        """
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = Flight()
+            self._flights[key] = flight
+            self.counters["flights"] += 1
+            asyncio.get_running_loop().create_task(self._run(key, flight, send, rewritten))
+        try:
+            await flight.ready.wait()
+        except asyncio.CancelledError:
+            if leader:
+                flight.abandon()
+            raise
+        if flight.error is not None and not flight.shared:
+            raise flight.error
+        if flight.shared:
+            if not leader:
+                self.counters["coalesced"] += 1
+            return flight.response, flight
+        if leader:
+            return flight.response, None
+        self.counters["fallbacks"] += 1
+        return await send(), None
+
+    async def _run(self, key: str, flight: Flight, send, rewritten):
+        try:
+            flight.response = await send()
+        except Exception as e:
+            flight.error = e
+        else:
+            flight.shared = not rewritten(flight.response) and self.shareable(flight.response)
+        finally:
+            flight.ready.set()
+        if not flight.shared:
+            self._forget(key, flight)
+            if flight._abandoned and flight.response is not None:
+                await flight.response.aclose()
+            return
+        # Read to the end even if every client left: the body is bounded
+        try:
+            async for chunk in flight.response.aiter_raw():
+                flight._chunks.append(chunk)
+                flight._notify()
+        except Exception as e:
+            flight.error = e
+        finally:
+            self._forget(key, flight)
+            flight.done = True
+            flight._notify()
+            with anyio.CancelScope(shield=True):
+                await flight.response.aclose()
+
+    def _forget(self, key: str, flight: Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> dict:
+        stats = dict(self.counters)
+        stats["in_flight"] = len(self._flights)
+        stats["max_bytes"] = self.max_bytes
+        return stats
+
+
+request_coalescer = RequestCoalescer()
@@ -1,127 +1,299 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy import or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from typing import List, Optional
 
 from backend.database import get_db
 from backend.models import User, Group, Permission, ProxyService, SSOProvider
 from backend.auth import get_current_active_user  # On suppose qu’elle gère la récupération user
 from backend.auth import admin_required  # Dépendance pour protéger routes aux admins
+from backend.bulk import FORMATS, KINDS, bulk_transfer, parse_rows
+from backend.cache import response_cache
+from backend.coalescing import request_coalescer
+from backend.invalidation import generations
+from backend.loading import includes, load_profile, related_rows
+from backend.pagination import PAGE_SIZE, keyset_page, page_response
+from backend.permissions import permission_index
+from backend.routing import routing_table
 
 router = APIRouter(prefix="/api/crud", tags=["crud"])
 
+# List endpoints return one page in the order of `sort` (a unique indexed
+# column, "-" prefix for descending); the next one is at the cursor given in
+# the X-Next-Cursor header. `search` keeps rows whose name starts with it,
+# `include` adds related rows (e.g. include=groups,permissions).
+
 # --- USERS ---
 
 @router.get("/users", response_model=List[dict])
-def list_users(db: Session = Depends(get_db), current_user=Depends(admin_required)):
-    users = db.query(User).all()
-    return [{"id": u.id, "username": u.username, "email": u.email} for u in users]
+async def list_users(request: Request, cursor: Optional[str] = None, limit: int = PAGE_SIZE, sort: str = "id",
+                     search: Optional[str] = None, username: Optional[str] = None, email: Optional[str] = None,
+                     include: str = "", db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    related = includes("users", include)
+    statement = select(User.id, User.username, User.email)
+    if search:
+        statement = statement.where(or_(User.username.startswith(search, autoescape=True),
+                                        User.email.startswith(search, autoescape=True)))
+    if username is not None:
+        statement = statement.where(User.username == username)
+    if email is not None:
+        statement = statement.where(User.email == email)
+    sort_columns = {"id": User.id, "username": User.username, "email": User.email}
+    rows, next_cursor = await keyset_page(db, statement, sort_columns, sort, cursor, limit)
+    await related_rows(db, "users", rows, related)
+    return page_response(request, rows, next_cursor)
 
 @router.get("/users/{user_id}", response_model=dict)
-def get_user(user_id: int, db: Session = Depends(get_db), current_user=Depends(admin_required)):
-    user = db.query(User).filter(User.id == user_id).first()
+async def get_user(user_id: int, db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    user = await db.get(User, user_id, options=load_profile("user"))
     if not user:
         raise HTTPException(404, "User not found")
-    return {"id": user.id, "username": user.username, "email": user.email}
+    return {"id": user.id, "username": user.username, "email": user.email,
+            "groups": [{"id": g.id, "name": g.name} for g in user.groups],
+            "permissions": [{"id": p.id, "name": p.name} for p in user.permissions]}
 
 @router.delete("/users/{user_id}")
-def delete_user(user_id: int, db: Session = Depends(get_db), current_user=Depends(admin_required)):
-    user = db.query(User).filter(User.id == user_id).first()
+async def delete_user(user_id: int, db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(404, "User not found")
-    db.delete(user)
-    db.commit()
+    await db.delete(user)
+    await db.commit()
+    permission_index.remove_user(user_id)
+    permission_index.acknowledge(generations.bump("users"))
     return {"message": "User deleted"}
 
 # --- GROUPS ---
 
 @router.get("/groups", response_model=List[dict])
-def list_groups(db: Session = Depends(get_db), current_user=Depends(admin_required)):
-    groups = db.query(Group).all()
-    return [{"id": g.id, "name": g.name} for g in groups]
+async def list_groups(request: Request, cursor: Optional[str] = None, limit: int = PAGE_SIZE, sort: str = "id",
+                      search: Optional[str] = None, include: str = "",
+                      db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    related = includes("groups", include)
+    statement = select(Group.id, Group.name)
+    if search:
+        statement = statement.where(Group.name.startswith(search, autoescape=True))
+    sort_columns = {"id": Group.id, "name": Group.name}
+    rows, next_cursor = await keyset_page(db, statement, sort_columns, sort, cursor, limit)
+    await related_rows(db, "groups", rows, related)
+    return page_response(request, rows, next_cursor)
+
+@router.get("/groups/{group_id}", response_model=dict)
+async def get_group(group_id: int, db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    group = await db.get(Group, group_id, options=load_profile("group"))
+    if not group:
+        raise HTTPException(404, "Group not found")
+    return {"id": group.id, "name": group.name,
+            "users": [{"id": u.id, "username": u.username} for u in group.users],
+            "permissions": [{"id": p.id, "name": p.name} for p in group.permissions]}
 
 @router.post("/groups")
-def create_group(name: str, db: Session = Depends(get_db), current_user=Depends(admin_required)):
+async def create_group(name: str, db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
     group = Group(name=name)
     db.add(group)
-    db.commit()
-    db.refresh(group)
+    await db.commit()
+    permission_index.acknowledge(generations.bump("groups"))
+    await db.refresh(group)
     return {"message": "Group created", "id": group.id}
 
 @router.put("/groups/{group_id}")
-def update_group(group_id: int, name: str, db: Session = Depends(get_db), current_user=Depends(admin_required)):
-    group = db.query(Group).filter(Group.id == group_id).first()
+async def update_group(group_id: int, name: str, db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    group = await db.get(Group, group_id)
     if not group:
         raise HTTPException(404, "Group not found")
     group.name = name
-    db.commit()
+    await db.commit()
+    permission_index.acknowledge(generations.bump("groups"))
     return {"message": "Group updated"}
 
 @router.delete("/groups/{group_id}")
-def delete_group(group_id: int, db: Session = Depends(get_db), current_user=Depends(admin_required)):
-    group = db.query(Group).filter(Group.id == group_id).first()
+async def delete_group(group_id: int, db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    group = await db.get(Group, group_id)
     if not group:
         raise HTTPException(404, "Group not found")
-    db.delete(group)
-    db.commit()
+    await db.delete(group)
+    await db.commit()
+    permission_index.remove_group(group_id)
+    permission_index.acknowledge(generations.bump("groups"))
     return {"message": "Group deleted"}
 
 # --- PERMISSIONS ---
 
 @router.get("/permissions", response_model=List[dict])
-def list_permissions(db: Session = Depends(get_db), current_user=Depends(admin_required)):
-    permissions = db.query(Permission).all()
-    return [{"id": p.id, "name": p.name, "description": p.description} for p in permissions]
+async def list_permissions(request: Request, cursor: Optional[str] = None, limit: int = PAGE_SIZE, sort: str = "id",
+                           search: Optional[str] = None, db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    statement = select(Permission.id, Permission.name, Permission.description)
+    if search:
+        statement = statement.where(Permission.name.startswith(search, autoescape=True))
+    sort_columns = {"id": Permission.id, "name": Permission.name}
+    return page_response(request, *await keyset_page(db, statement, sort_columns, sort, cursor, limit))
 
 @router.post("/permissions")
-def create_permission(name: str, description: str = "", db: Session = Depends(get_db), current_user=Depends(admin_required)):
+async def create_permission(name: str, description: str = "", db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
     permission = Permission(name=name, description=description)
     db.add(permission)
-    db.commit()
-    db.refresh(permission)
+    await db.commit()
+    permission_index.acknowledge(generations.bump("permissions"))
+    await db.refresh(permission)
     return {"message": "Permission created", "id": permission.id}
 
 @router.put("/permissions/{permission_id}")
-def update_permission(permission_id: int, name: str, description: str = "", db: Session = Depends(get_db), current_user=Depends(admin_required)):
-    permission = db.query(Permission).filter(Permission.id == permission_id).first()
+async def update_permission(permission_id: int, name: str, description: str = "", db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    permission = await db.get(Permission, permission_id)
     if not permission:
         raise HTTPException(404, "Permission not found")
     permission.name = name
     permission.description = description
-    db.commit()
+    await db.commit()
+    permission_index.acknowledge(generations.bump("permissions"))
     return {"message": "Permission updated"}
 
 @router.delete("/permissions/{permission_id}")
-def delete_permission(permission_id: int, db: Session = Depends(get_db), current_user=Depends(admin_required)):
-    permission = db.query(Permission).filter(Permission.id == permission_id).first()
+async def delete_permission(permission_id: int, db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    permission = await db.get(Permission, permission_id)
     if not permission:
         raise HTTPException(404, "Permission not found")
-    db.delete(permission)
-    db.commit()
+    if (await db.execute(select(ProxyService.id).where(ProxyService.permission_id == permission_id))).first():
+        raise HTTPException(400, "Permission is required by a proxy service")
+    await db.delete(permission)
+    await db.commit()
+    permission_index.remove_permission(permission_id)
+    permission_index.acknowledge(generations.bump("permissions"))
     return {"message": "Permission deleted"}
 
+# --- MEMBERSHIPS AND GRANTS ---
+
+async def set_link(db: AsyncSession, owner_model, owner_id: int, relation: str, target_model, target_id: int, linked: bool):
+    """
+    Add or remove target in a many-to-many relation of owner, and commit.
+    """
+    owner = await db.get(owner_model, owner_id, options=[selectinload(getattr(owner_model, relation))])
+    if not owner:
+        raise HTTPException(404, f"{owner_model.__name__} not found")
+    target = await db.get(target_model, target_id)
+    if not target:
+        raise HTTPException(404, f"{target_model.__name__} not found")
+    links = getattr(owner, relation)
+    if linked and target not in links:
+        links.append(target)
+    elif not linked and target in links:
+        links.remove(target)
+    await db.commit()
+
+@router.put("/users/{user_id}/groups/{group_id}")
+async def add_user_to_group(user_id: int, group_id: int, db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    await set_link(db, User, user_id, "groups", Group, group_id, True)
+    permission_index.add_member(user_id, group_id)
+    permission_index.acknowledge(generations.bump("users"))
+    return {"message": "User added to group"}
+
+@router.delete("/users/{user_id}/groups/{group_id}")
+async def remove_user_from_group(user_id: int, group_id: int, db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    await set_link(db, User, user_id, "groups", Group, group_id, False)
+    permission_index.remove_member(user_id, group_id)
+    permission_index.acknowledge(generations.bump("users"))
+    return {"message": "User removed from group"}
+
+@router.put("/users/{user_id}/permissions/{permission_id}")
+async def grant_user_permission(user_id: int, permission_id: int, db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    await set_link(db, User, user_id, "permissions", Permission, permission_id, True)
+    permission_index.grant_user(user_id, permission_id)
+    permission_index.acknowledge(generations.bump("users"))
+    return {"message": "Permission granted"}
+
+@router.delete("/users/{user_id}/permissions/{permission_id}")
+async def revoke_user_permission(user_id: int, permission_id: int, db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    await set_link(db, User, user_id, "permissions", Permission, permission_id, False)
+    permission_index.revoke_user(user_id, permission_id)
+    permission_index.acknowledge(generations.bump("users"))
+    return {"message": "Permission revoked"}
+
+@router.put("/groups/{group_id}/permissions/{permission_id}")
+async def grant_group_permission(group_id: int, permission_id: int, db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    await set_link(db, Group, group_id, "permissions", Permission, permission_id, True)
+    permission_index.grant_group(group_id, permission_id)
+    permission_index.acknowledge(generations.bump("groups"))
+    return {"message": "Permission granted"}
+
+@router.delete("/groups/{group_id}/permissions/{permission_id}")
+async def revoke_group_permission(group_id: int, permission_id: int, db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    await set_link(db, Group, group_id, "permissions", Permission, permission_id, False)
+    permission_index.revoke_group(group_id, permission_id)
+    permission_index.acknowledge(generations.bump("groups"))
+    return {"message": "Permission revoked"}
+
+# --- BULK IMPORT AND EXPORT ---
+# Kinds: users, groups, permissions, user_groups, user_permissions and
+# group_permissions, as NDJSON or CSV (see backend/bulk.py)
+
+def bulk_format(kind: str, format: str):
+    if kind not in KINDS:
+        raise HTTPException(404, f"Unknown kind, use one of: {', '.join(KINDS)}")
+    if format not in FORMATS:
+        raise HTTPException(400, f"Unsupported format, use one of: {', '.join(FORMATS)}")
+
+@router.post("/bulk/{kind}", response_model=dict)
+async def bulk_import(kind: str, request: Request, format: Optional[str] = None, current_user=Depends(admin_required)):
+    # The body is read and applied chunk by chunk, never held whole
+    if format is None:
+        format = "csv" if request.headers.get("content-type", "").startswith("text/csv") else "ndjson"
+    bulk_format(kind, format)
+    return await bulk_transfer.import_rows(kind, parse_rows(format, request.stream()))
+
+@router.get("/bulk/{kind}")
+async def bulk_export(kind: str, format: str = "ndjson", include_password_hashes: bool = False,
+                      current_user=Depends(admin_required)):
+    bulk_format(kind, format)
+    return StreamingResponse(
+        bulk_transfer.export(kind, format, include_password_hashes),
+        media_type=FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{kind}.{format}"'},
+    )
+
 # --- PROXY SERVICES ---
 
 @router.get("/proxys", response_model=List[dict])
-def list_proxys(db: Session = Depends(get_db), current_user=Depends(admin_required)):
-    proxys = db.query(ProxyService).all()
-    return [{"id": p.id, "name": p.name, "base_url": p.base_url, "description": p.description, "enabled": p.enabled} for p in proxys]
+async def list_proxys(request: Request, cursor: Optional[str] = None, limit: int = PAGE_SIZE, sort: str = "id",
+                      search: Optional[str] = None, enabled: Optional[bool] = None,
+                      db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    statement = select(ProxyService.id, ProxyService.name, ProxyService.base_url, ProxyService.description,
+                       ProxyService.enabled, ProxyService.max_body_size, ProxyService.cache_enabled,
+                       ProxyService.cache_ttl, ProxyService.permission_id)
+    if search:
+        statement = statement.where(ProxyService.name.startswith(search, autoescape=True))
+    if enabled is not None:
+        statement = statement.where(ProxyService.enabled == enabled)
+    sort_columns = {"id": ProxyService.id, "name": ProxyService.name}
+    return page_response(request, *await keyset_page(db, statement, sort_columns, sort, cursor, limit))
 
 @router.post("/proxys")
-def create_proxy(name: str, base_url: str, description: str = "", enabled: bool = True, db: Session = Depends(get_db), current_user=Depends(admin_required)):
+async def create_proxy(name: str, base_url: str, description: str = "", enabled: bool = True, max_body_size: int = None,
+                 cache_enabled: bool = False, cache_ttl: int = None, permission_id: int = None,
+                 db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
     proxy = ProxyService(
         name=name,
         base_url=base_url,
         description=description,
-        enabled=enabled
+        enabled=enabled,
+        max_body_size=max_body_size,
+        cache_enabled=cache_enabled,
+        cache_ttl=cache_ttl,
+        permission_id=permission_id
     )
     db.add(proxy)
-    db.commit()
-    db.refresh(proxy)
+    await db.commit()
+    generations.bump("services")
+    await db.refresh(proxy)
+    await routing_table.load(db)
     return {"message": "Proxy service created", "id": proxy.id}
 
 @router.put("/proxys/{proxy_id}")
-def update_proxy(proxy_id: int, name: str = None, base_url: str = None, description: str = None, enabled: bool = None, db: Session = Depends(get_db), current_user=Depends(admin_required)):
-    proxy = db.query(ProxyService).filter(ProxyService.id == proxy_id).first()
+async def update_proxy(proxy_id: int, name: str = None, base_url: str = None, description: str = None, enabled: bool = None,
+                 max_body_size: int = None, cache_enabled: bool = None, cache_ttl: int = None, permission_id: int = None,
+                 db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    proxy = await db.get(ProxyService, proxy_id)
     if not proxy:
         raise HTTPException(404, "Proxy not found")
     if name is not None:
@@ -132,39 +304,69 @@ def update_proxy(proxy_id: int, name: str = None, base_url: str = None, descript
         proxy.description = description
     if enabled is not None:
         proxy.enabled = enabled
-    db.commit()
+    if max_body_size is not None:
+        proxy.max_body_size = max_body_size or None  # 0 resets to the global limit
+    if cache_enabled is not None:
+        proxy.cache_enabled = cache_enabled
+    if cache_ttl is not None:
+        proxy.cache_ttl = cache_ttl or None
+    if permission_id is not None:
+        proxy.permission_id = permission_id or None  # 0 opens the service to every visitor
+    await db.commit()
+    generations.bump("services")
+    # Also drains the connection pool when the upstream target changes
+    await routing_table.load(db)
     return {"message": "Proxy service updated"}
 
 @router.delete("/proxys/{proxy_id}")
-def delete_proxy(proxy_id: int, db: Session = Depends(get_db), current_user=Depends(admin_required)):
-    proxy = db.query(ProxyService).filter(ProxyService.id == proxy_id).first()
+async def delete_proxy(proxy_id: int, db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    proxy = await db.get(ProxyService, proxy_id)
     if not proxy:
         raise HTTPException(404, "Proxy not found")
-    db.delete(proxy)
-    db.commit()
+    await db.delete(proxy)
+    await db.commit()
+    generations.bump("services")
+    await routing_table.load(db)
     return {"message": "Proxy service deleted"}
 
+@router.get("/proxy_cache", response_model=dict)
+async def proxy_cache_stats(current_user=Depends(admin_required)):
+    # Hit/miss/eviction counters of this worker, to size the cache
+    return response_cache.stats()
+
+@router.get("/proxy_coalescing", response_model=dict)
+async def proxy_coalescing_stats(current_user=Depends(admin_required)):
+    # Upstream GETs shared by identical concurrent requests in this worker
+    return request_coalescer.stats()
+
 # --- SSO PROVIDERS ---
 
 @router.get("/sso_providers", response_model=List[dict])
-def list_sso_providers(db: Session = Depends(get_db), current_user=Depends(admin_required)):
-    providers = db.query(SSOProvider).all()
-    return [{
-        "id": p.id,
-        "name": p.name,
-        "issuer_url": p.issuer_url,
-        "client_id": p.client_id,
-        "auth_url": p.auth_url,
-        "token_url": p.token_url,
-        "userinfo_url": p.userinfo_url,
-        "scope": p.scope,
-        "enabled": p.enabled
-    } for p in providers]
+async def list_sso_providers(request: Request, cursor: Optional[str] = None, limit: int = PAGE_SIZE, sort: str = "id",
+                             search: Optional[str] = None, enabled: Optional[bool] = None,
+                             db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    statement = select(
+        SSOProvider.id,
+        SSOProvider.name,
+        SSOProvider.issuer_url,
+        SSOProvider.client_id,
+        SSOProvider.auth_url,
+        SSOProvider.token_url,
+        SSOProvider.userinfo_url,
+        SSOProvider.scope,
+        SSOProvider.enabled
+    )
+    if search:
+        statement = statement.where(SSOProvider.name.startswith(search, autoescape=True))
+    if enabled is not None:
+        statement = statement.where(SSOProvider.enabled == enabled)
+    sort_columns = {"id": SSOProvider.id, "name": SSOProvider.name}
+    return page_response(request, *await keyset_page(db, statement, sort_columns, sort, cursor, limit))
 
 @router.post("/sso_providers")
-def create_sso_provider(name: str, issuer_url: str, client_id: str = None, client_secret: str = None,
+async def create_sso_provider(name: str, issuer_url: str, client_id: str = None, client_secret: str = None,
                         auth_url: str = None, token_url: str = None, userinfo_url: str = None, scope: str = 'openid profile email',
-                        enabled: bool = True, db: Session = Depends(get_db), current_user=Depends(admin_required)):
+                        enabled: bool = True, db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
     provider = SSOProvider(
         name=name,
         issuer_url=issuer_url,
@@ -177,16 +379,17 @@ def create_sso_provider(name: str, issuer_url: str, client_id: str = None, clien
         enabled=enabled
     )
     db.add(provider)
-    db.commit()
-    db.refresh(provider)
+    await db.commit()
+    generations.bump("sso_providers")
+    await db.refresh(provider)
     return {"message": "SSO provider created", "id": provider.id}
 
 @router.put("/sso_providers/{provider_id}")
-def update_sso_provider(provider_id: int, name: str = None, issuer_url: str = None, client_id: str = None,
+async def update_sso_provider(provider_id: int, name: str = None, issuer_url: str = None, client_id: str = None,
                         client_secret: str = None, auth_url: str = None, token_url: str = None,
                         userinfo_url: str = None, scope: str = None, enabled: bool = None,
-                        db: Session = Depends(get_db), current_user=Depends(admin_required)):
-    provider = db.query(SSOProvider).filter(SSOProvider.id == provider_id).first()
+                        db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    provider = await db.get(SSOProvider, provider_id)
     if not provider:
         raise HTTPException(404, "SSO provider not found")
     if name is not None:
@@ -207,14 +410,16 @@ def update_sso_provider(provider_id: int, name: str = None, issuer_url: str = No
         provider.scope = scope
     if enabled is not None:
         provider.enabled = enabled
-    db.commit()
+    await db.commit()
+    generations.bump("sso_providers")
     return {"message": "SSO provider updated"}
 
 @router.delete("/sso_providers/{provider_id}")
-def delete_sso_provider(provider_id: int, db: Session = Depends(get_db), current_user=Depends(admin_required)):
-    provider = db.query(SSOProvider).filter(SSOProvider.id == provider_id).first()
+async def delete_sso_provider(provider_id: int, db: AsyncSession = Depends(get_db), current_user=Depends(admin_required)):
+    provider = await db.get(SSOProvider, provider_id)
     if not provider:
         raise HTTPException(404, "SSO provider not found")
-    db.delete(provider)
-    db.commit()
+    await db.delete(provider)
+    await db.commit()
+    generations.bump("sso_providers")
     return {"message": "SSO provider deleted"}
\ No newline at end of file
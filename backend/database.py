@@ -1,20 +1,124 @@
-from sqlalchemy import create_engine
+import os
+from typing import Dict
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import URL, Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 
-DATABASE_URL = "sqlite:///./centralarr.db"
+from backend.querystats import query_stats
+
+# SQLite file (/opt/centralarr/db/centralarr.db in the Docker image)
+DB_PATH = os.environ.get("DB_PATH", "./centralarr.db")
+
+# Full database URL, e.g. postgresql://centralarr:secret@db/centralarr for
+# deployments with several nodes (defaults to the SQLite file above)
+DATABASE_URL = os.environ.get("DATABASE_URL", f"sqlite:///{DB_PATH}")
+
+# Drivers: psycopg 3 serves both engines on PostgreSQL
+SYNC_DRIVERS = {"sqlite": "sqlite", "postgresql": "postgresql+psycopg"}
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+psycopg"}
+
+
+def database_url(url, drivers: Dict[str, str]) -> URL:
+    """
+    The URL with the driver this app uses for its backend
+    ("postgres://" and "postgresql://" alike).
+    """
+    parsed = make_url(url)
+    backend = "postgresql" if parsed.get_backend_name() in ("postgres", "postgresql") else parsed.get_backend_name()
+    if backend not in drivers:
+        raise ValueError(f"Unsupported database backend: {backend}")
+    return parsed.set(drivername=drivers[backend])
+
+def is_sqlite(url) -> bool:
+    return make_url(url).get_backend_name() == "sqlite"
+
+ASYNC_DATABASE_URL = database_url(DATABASE_URL, ASYNC_DRIVERS)
+
+# Storage profile, applied to every new connection. WAL lets readers of all
+# workers go on while an admin write commits; NORMAL only syncs at
+# checkpoints, which is safe in WAL mode.
+SQLITE_PRAGMAS: Dict[str, str] = {
+    "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": os.environ.get("SQLITE_BUSY_TIMEOUT", "5000"),  # ms waiting for a lock
+    "mmap_size": os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)),
+    "cache_size": os.environ.get("SQLITE_CACHE_SIZE", "-16000"),  # negative: KiB per connection
+}
 
-engine = create_engine(
-    DATABASE_URL, connect_args={"check_same_thread": False}  # nécessaire pour SQLite
-)
+# Connections kept open per worker (and node). On SQLite each aiosqlite
+# connection has its own thread, so these also bound concurrent queries;
+# on PostgreSQL, workers x nodes x (size + overflow) must stay below the
+# server's max_connections.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "8"))
+# PostgreSQL: seconds to wait for a free connection, and to keep one before
+# replacing it (below server/proxy idle timeouts)
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", "1800"))
+
+
+def apply_sqlite_pragmas(engine: Engine, pragmas: Dict[str, str] = SQLITE_PRAGMAS):
+    """
+    Run the PRAGMA statements on each connection the engine opens.
+    """
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+def engine_options(url, **kwargs) -> dict:
+    kwargs.setdefault("pool_size", DB_POOL_SIZE)
+    kwargs.setdefault("max_overflow", DB_MAX_OVERFLOW)
+    if not is_sqlite(url):
+        # Connections dropped by the server, a failover or a proxy are
+        # replaced before use instead of failing a request
+        kwargs.setdefault("pool_pre_ping", True)
+        kwargs.setdefault("pool_recycle", DB_POOL_RECYCLE)
+        kwargs.setdefault("pool_timeout", DB_POOL_TIMEOUT)
+    return kwargs
+
+def make_async_engine(url=ASYNC_DATABASE_URL, pragmas: Dict[str, str] = SQLITE_PRAGMAS, **kwargs) -> AsyncEngine:
+    url = database_url(url, ASYNC_DRIVERS)
+    async_engine = create_async_engine(url, **engine_options(url, **kwargs))
+    if is_sqlite(url):
+        apply_sqlite_pragmas(async_engine.sync_engine, pragmas)
+    return async_engine
+
+def make_engine(url=DATABASE_URL, pragmas: Dict[str, str] = SQLITE_PRAGMAS) -> Engine:
+    """
+    Blocking engine on the same database.
+    """
+    url = database_url(url, SYNC_DRIVERS)
+    if is_sqlite(url):
+        engine = create_engine(url, connect_args={"check_same_thread": False})  # nécessaire pour SQLite
+        apply_sqlite_pragmas(engine, pragmas)
+        return engine
+    return create_engine(url, **engine_options(url, pool_size=2))
+
+# Blocking engine, for scripts, schema migrations and tests
+engine = make_engine()
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine used by the app: queries never block the event loop
+async_engine = make_async_engine()
+
+# Statement counts and timings of both (GET /api/metrics/db), unless
+# DB_QUERY_STATS=0
+if os.environ.get("DB_QUERY_STATS", "1") != "0":
+    query_stats.instrument(engine)
+    query_stats.instrument(async_engine.sync_engine)
+
+# Objects stay readable after commit, nothing is lazily reloaded
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 # Dependency pour FastAPI
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
@@ -0,0 +1,106 @@
+import fcntl
+import mmap
+import os
+import struct
+from typing import Dict, Optional
+
+# Shared file holding one generation counter per cached entity type
+CACHE_GENERATIONS_PATH = os.environ.get("CACHE_GENERATIONS_PATH", "./centralarr.generations")
+
+ENTITIES = ("services", "users", "groups", "permissions", "sso_providers", "tokens")
+
+_SLOT = struct.Struct("=Q")
+
+
+class GenerationBus:
+    """
+    Cross-worker cache invalidation without external services.
+
+    Every entity type has a 64-bit generation number in a small file mapped
+    in memory by all workers of the host. Writers bump the generation after
+    committing a change; readers compare it with the generation their cache
+    was built from, which costs a memory read per check.
+
+    Bumps are serialized with flock(). Reads are lock-free: a torn read can
+    only look like a change and cause one extra reload.
+    """
+
+    def __init__(self, path: str = CACHE_GENERATIONS_PATH):
+        self.path = path
+        self._fd: Optional[int] = None
+        self._mmap: Optional[mmap.mmap] = None
+        self._pid: Optional[int] = None
+
+    def _open(self) -> mmap.mmap:
+        # Opened lazily, and again after a fork: flock() locks belong to the
+        # open file, so workers must not share the parent's descriptor.
+        if self._mmap is not None and self._pid == os.getpid():
+            return self._mmap
+        size = _SLOT.size * len(ENTITIES)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+        self._fd = fd
+        self._mmap = mmap.mmap(fd, size)
+        self._pid = os.getpid()
+        return self._mmap
+
+    @staticmethod
+    def _offset(entity: str) -> int:
+        return ENTITIES.index(entity) * _SLOT.size
+
+    def current(self, entity: str) -> int:
+        return _SLOT.unpack_from(self._open(), self._offset(entity))[0]
+
+    def bump(self, *entities: str) -> Dict[str, int]:
+        """
+        Signal every worker that these entity types changed. Returns their
+        new generations.
+        """
+        shared = self._open()
+        bumped = {}
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            for entity in entities:
+                offset = self._offset(entity)
+                bumped[entity] = _SLOT.unpack_from(shared, offset)[0] + 1
+                _SLOT.pack_into(shared, offset, bumped[entity])
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return bumped
+
+    def watch(self, entity: str) -> "GenerationWatcher":
+        return GenerationWatcher(self, entity)
+
+    def close(self):
+        if self._mmap is not None and self._pid == os.getpid():
+            self._mmap.close()
+            os.close(self._fd)
+        self._fd = self._mmap = self._pid = None
+
+
+class GenerationWatcher:
+    """
+    Remembers which generation of an entity type a cache was built from.
+    """
+
+    def __init__(self, bus: GenerationBus, entity: str):
+        self.bus = bus
+        self.entity = entity
+        self.seen: Optional[int] = None
+
+    def current(self) -> int:
+        return self.bus.current(self.entity)
+
+    def changed(self) -> bool:
+        return self.seen is None or self.current() != self.seen
+
+    def mark(self, generation: int):
+        """
+        Record the generation read *before* reloading, so a change committed
+        during the reload triggers another one.
+        """
+        self.seen = generation
+
+
+generations = GenerationBus()
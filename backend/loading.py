@@ -0,0 +1,78 @@
+"""
+How relationships are loaded, per use.
+
+Relationships of the models are lazy, and a lazy load per row is an N+1:
+endpoints rendering memberships load them up front, with a named profile of
+loader options for ORM objects, or with related_rows() for the column rows
+of the list endpoints. Either way the number of queries doesn't grow with
+the number of rows.
+"""
+from collections import defaultdict
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from backend.models import Group, Permission, User, group_permissions, user_groups, user_permissions
+
+# Loader options by profile. selectinload: one "WHERE id IN (...)" query per
+# relationship, without the row multiplication of a joined load over two
+# collections.
+LOAD_PROFILES: Dict[str, Tuple] = {
+    # A user and what it belongs to
+    "user": (selectinload(User.groups), selectinload(User.permissions)),
+    # Everything authorization needs (backend/principals.py)
+    "principal": (selectinload(User.groups).selectinload(Group.permissions), selectinload(User.permissions)),
+    "group": (selectinload(Group.users), selectinload(Group.permissions)),
+    "permission": (selectinload(Permission.users), selectinload(Permission.groups)),
+}
+
+# Relations the list endpoints can include: association table column of the
+# listed rows, the one of the related rows, and the related columns rendered
+RELATED = {
+    "users": {
+        "groups": (user_groups.c.user_id, user_groups.c.group_id, Group, (Group.id, Group.name)),
+        "permissions": (user_permissions.c.user_id, user_permissions.c.permission_id, Permission, (Permission.id, Permission.name)),
+    },
+    "groups": {
+        "users": (user_groups.c.group_id, user_groups.c.user_id, User, (User.id, User.username)),
+        "permissions": (group_permissions.c.group_id, group_permissions.c.permission_id, Permission, (Permission.id, Permission.name)),
+    },
+}
+
+
+def load_profile(name: str) -> Tuple:
+    return LOAD_PROFILES[name]
+
+def includes(entity: str, include: str) -> List[str]:
+    """
+    Relation names of a comma-separated include parameter.
+    """
+    names = [name.strip() for name in include.split(",") if name.strip()]
+    for name in names:
+        if name not in RELATED[entity]:
+            raise HTTPException(400, f"Cannot include {name}, use some of: {', '.join(RELATED[entity])}")
+    return names
+
+async def related_rows(db: AsyncSession, entity: str, rows: Sequence[dict], names: Iterable[str]):
+    """
+    Add the related rows of each listed row under their relation name, with
+    one query per relation.
+    """
+    ids = [row["id"] for row in rows]
+    for name in names:
+        owner, target, model, columns = RELATED[entity][name]
+        related = defaultdict(list)
+        if ids:
+            statement = (
+                select(owner.label("owner"), *columns)
+                .join(model, model.id == target)
+                .where(owner.in_(ids))
+                .order_by(owner, model.id)
+            )
+            for row in (await db.execute(statement)).mappings():
+                related[row["owner"]].append({column.key: row[column.key] for column in columns})
+        for row in rows:
+            row[name] = related.get(row["id"], [])
@@ -1,19 +1,53 @@
 import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse, RedirectResponse
 from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
+from starlette.concurrency import run_in_threadpool
 
-from backend.auth import auth_bp
-from backend.proxy import proxy_bp
-from backend.crud import crud_bp
+from backend.auth import router as auth_router
+from backend.cache import response_cache
+from backend.proxy import proxy_router
+from backend.crud import router as crud_router
+from backend.database import async_engine
+from backend.metrics import router as metrics_router
+from backend.migrations import upgrade
+from backend.oidc import oidc_client
+from backend.passwords import password_hasher
+from backend.querystats import QueryStatsMiddleware
+from backend.routing import routing_table
+from backend.telemetry import registry
+from backend.upstream import upstream_clients
 
-app = FastAPI(title="CentralArr API")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Missing tables and pending migrations, one worker at a time
+    await run_in_threadpool(upgrade)
+    # Proxied requests resolve their service from memory, not the DB
+    await routing_table.refresh()
+    # Index of the disk cache, built off the event loop
+    await response_cache.open_disk()
+    # Metrics of this worker are shared with the others through METRICS_DIR
+    registry.start()
+    # Upstream connection pools live for the whole app lifetime
+    yield
+    await registry.stop()
+    await upstream_clients.aclose()
+    await oidc_client.aclose()
+    password_hasher.shutdown()
+    await async_engine.dispose()
+
+app = FastAPI(title="CentralArr API", lifespan=lifespan)
 
 # Add session middleware with secret key (needed for auth session)
 app.add_middleware(SessionMiddleware, secret_key=os.environ.get("SECRET_KEY", "supersecret"))
 
+# Queries per request, by route
+app.add_middleware(QueryStatsMiddleware)
+
 # Enable CORS for frontend dev server or front production
 origins = [
     "http://localhost",
@@ -26,13 +60,15 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Link", "X-Next-Cursor"],  # pagination of the list endpoints
 )
 
 # Register routers
-app.include_router(auth_bp, prefix="/api/auth", tags=["auth"])
-app.include_router(proxy_router, prefix="/api/proxy", tags=["proxy"])
-app.include_router(ws_router, prefix="/api/proxy", tags=["proxy"])
-app.include_router(crud_bp, prefix="/api/crud", tags=["crud"])
+# (prefixes and tags are declared on each router)
+app.include_router(auth_router)
+app.include_router(proxy_router)
+app.include_router(crud_router)
+app.include_router(metrics_router)
 
 # Serve Vue.js static files on prod
 FASTAPI_ENV = os.environ.get("FLASK_ENV", "prod")
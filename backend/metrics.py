@@ -0,0 +1,177 @@
+import os
+import secrets
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.auth import admin_required, principal_from_token
+from backend.cache import response_cache
+from backend.coalescing import request_coalescer
+from backend.database import get_db
+from backend.principals import principal_cache
+from backend.querystats import query_stats
+from backend.telemetry import registry
+from backend.tokens import token_service
+from backend.upstream import upstream_clients
+
+# Bearer token of the Prometheus scraper; without it only admins may scrape
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+router = APIRouter(prefix="/api/metrics", tags=["metrics"])
+
+# Values the app already keeps, read when scraped
+
+registry.gauge(
+    "centralarr_upstream_requests_in_flight",
+    "Upstream requests waiting for or reading a response",
+    ("service",),
+    lambda: {(service,): count for service, count in upstream_clients.in_flight().items()},
+)
+registry.gauge(
+    "centralarr_upstream_connections",
+    "Connections of the upstream pools: in use (active) or kept alive (idle)",
+    ("service", "state"),
+    lambda: {
+        (service, state): stats[state]
+        for service, stats in upstream_clients.pool_stats().items()
+        for state in ("active", "idle")
+    },
+)
+registry.gauge(
+    "centralarr_upstream_queued_requests",
+    "Requests waiting for a connection of an upstream pool",
+    ("service",),
+    lambda: {(service,): stats["queued"] for service, stats in upstream_clients.pool_stats().items()},
+)
+registry.gauge(
+    "centralarr_upstream_max_connections",
+    "Connections an upstream pool may open, in each worker (not summed over the workers)",
+    (),
+    lambda: {(): upstream_clients.limits.max_connections or 0},
+    per_worker=True,
+)
+registry.gauge("centralarr_workers", "Workers of the host reporting metrics", (), lambda: {(): 1})
+registry.counter(
+    "centralarr_response_cache_lookups_total",
+    "Lookups of the proxy response cache, served from it (hit) or not (miss)",
+    ("result",),
+    lambda: {("hit",): response_cache.counters["hits"], ("miss",): response_cache.counters["misses"]},
+)
+registry.counter(
+    "centralarr_response_cache_events_total",
+    "Stores, evictions and revalidations of the proxy response cache",
+    ("event",),
+    lambda: {
+        (event,): response_cache.counters[event]
+        for event in ("stores", "evictions", "disk_hits", "disk_evictions", "revalidations",
+                      "collapsed_revalidations", "not_modified")
+    },
+)
+registry.gauge(
+    "centralarr_response_cache_bytes",
+    "Bytes of the responses in the memory tier of the proxy response cache",
+    (),
+    lambda: {(): response_cache.memory.bytes},
+)
+registry.counter(
+    "centralarr_coalesced_requests_total",
+    "Proxied GETs by how they reached the upstream: own request (flight), "
+    "shared with an identical one (coalesced) or not shareable (fallback)",
+    ("result",),
+    lambda: {
+        ("flight",): request_coalescer.counters["flights"],
+        ("coalesced",): request_coalescer.counters["coalesced"],
+        ("fallback",): request_coalescer.counters["fallbacks"],
+    },
+)
+registry.counter(
+    "centralarr_principal_cache_lookups_total",
+    "Lookups of the authenticated users cache",
+    ("result",),
+    lambda: {("hit",): principal_cache.counters["hits"], ("miss",): principal_cache.counters["misses"]},
+)
+registry.counter(
+    "centralarr_token_verifications_total",
+    "Access token checks: from the verified tokens cache (hit), verified (miss) or rejected",
+    ("result",),
+    lambda: {
+        ("hit",): token_service.counters["cache_hits"],
+        ("miss",): token_service.counters["verified"],
+        ("rejected",): token_service.counters["rejected"],
+    },
+)
+registry.counter(
+    "centralarr_db_queries_total", "SQL statements run", (), lambda: {(): query_stats.queries}
+)
+registry.counter(
+    "centralarr_db_query_errors_total", "SQL statements that failed", (), lambda: {(): query_stats.errors}
+)
+registry.counter(
+    "centralarr_db_query_seconds_total", "Seconds spent running SQL statements", (), lambda: {(): query_stats.time}
+)
+
+
+def hit_ratio(metric: str):
+    # Over the lookups of every worker, so a single scrape gives the host's
+    def ratio(merged: dict) -> dict:
+        values = merged.get(metric, {})
+        hits = values.get(("hit",), 0)
+        lookups = hits + values.get(("miss",), 0)
+        return {(): hits / lookups if lookups else 0.0}
+    return ratio
+
+def pool_utilization(merged: dict) -> dict:
+    # Connections of every worker over what their pools may open together
+    capacity = merged.get("centralarr_upstream_max_connections", {}).get((), 0) * merged.get("centralarr_workers", {}).get((), 1)
+    return {
+        (service,): count / capacity
+        for (service, state), count in merged.get("centralarr_upstream_connections", {}).items()
+        if state == "active" and capacity
+    }
+
+registry.derive(
+    "centralarr_upstream_pool_utilization",
+    "Share of the connections the upstream pools of all workers may open that are in use, by service",
+    ("service",),
+    pool_utilization,
+)
+registry.derive(
+    "centralarr_response_cache_hit_ratio", "Share of response cache lookups served from it", (),
+    hit_ratio("centralarr_response_cache_lookups_total"),
+)
+registry.derive(
+    "centralarr_principal_cache_hit_ratio", "Share of authenticated user lookups served from the cache", (),
+    hit_ratio("centralarr_principal_cache_lookups_total"),
+)
+registry.derive(
+    "centralarr_token_verification_cache_hit_ratio", "Share of valid token checks served from the cache", (),
+    hit_ratio("centralarr_token_verifications_total"),
+)
+
+
+async def scrape_allowed(request: Request, db: AsyncSession = Depends(get_db)):
+    """
+    The METRICS_TOKEN bearer token when one is set, or an admin's.
+    """
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    if METRICS_TOKEN and secrets.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        return
+    principal = await principal_from_token(token, db)
+    if principal is None:
+        raise HTTPException(status_code=401, detail="Could not validate credentials", headers={"WWW-Authenticate": "Bearer"})
+    if not principal.is_admin:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+
+@router.get("", response_class=PlainTextResponse)
+async def prometheus_metrics(_=Depends(scrape_allowed)):
+    # Every worker of the host, in the Prometheus text format
+    return PlainTextResponse(await registry.exposition(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@router.get("/db", response_model=dict)
+async def db_metrics(statements: int = 20, current_user=Depends(admin_required)):
+    # Queries of this worker: totals, costliest statements, slow samples and
+    # queries per request of each route
+    return query_stats.snapshot(statements)
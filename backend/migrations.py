@@ -0,0 +1,100 @@
+"""
+Schema creation and migrations, for SQLite and PostgreSQL alike.
+
+New tables are created from the models; changes to tables that already
+exist in deployed databases are numbered migrations below. Applied
+versions are recorded in schema_migrations.
+
+    python -m backend.migrations
+"""
+import fcntl
+from contextlib import contextmanager
+from typing import Callable, List, Tuple
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.schema import CreateColumn
+
+from backend.database import Base, engine
+from backend.models import ProxyService
+
+# Key of the PostgreSQL advisory lock held while migrating
+MIGRATION_LOCK_KEY = 0x63617272
+
+schema_migrations = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String(200), nullable=False),
+)
+
+
+def add_column(connection: Connection, column: Column):
+    """
+    ALTER TABLE ... ADD COLUMN for a model column, unless it exists.
+    """
+    table = column.table.name
+    if column.name in {existing["name"] for existing in inspect(connection).get_columns(table)}:
+        return
+    quote = connection.dialect.identifier_preparer.quote
+    ddl = CreateColumn(column).compile(dialect=connection.dialect)
+    connection.execute(text(f"ALTER TABLE {quote(table)} ADD COLUMN {ddl}"))
+
+def proxy_upload_limit(connection: Connection):
+    add_column(connection, ProxyService.__table__.c.max_body_size)
+
+def proxy_response_cache(connection: Connection):
+    add_column(connection, ProxyService.__table__.c.cache_enabled)
+    add_column(connection, ProxyService.__table__.c.cache_ttl)
+
+def proxy_access_permission(connection: Connection):
+    add_column(connection, ProxyService.__table__.c.permission_id)
+
+# In order. Never change a released migration, append a new one.
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "proxy_services.max_body_size", proxy_upload_limit),
+    (2, "proxy_services.cache_enabled, cache_ttl", proxy_response_cache),
+    (3, "proxy_services.permission_id", proxy_access_permission),
+]
+
+
+@contextmanager
+def migration_lock(engine: Engine):
+    """
+    Workers starting together on SQLite take turns through a lock file
+    next to the database (PostgreSQL nodes use an advisory lock instead).
+    """
+    database = engine.url.database
+    if engine.dialect.name != "sqlite" or not database or database == ":memory:":
+        yield
+        return
+    with open(f"{database}.migrate.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def upgrade(engine: Engine = engine) -> List[int]:
+    """
+    Create missing tables and apply pending migrations, in one transaction.
+    Returns the versions applied.
+    """
+    with migration_lock(engine), engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        Base.metadata.create_all(connection)
+        schema_migrations.create(connection, checkfirst=True)
+        done = set(connection.scalars(select(schema_migrations.c.version)))
+        applied = []
+        for version, description, migrate in MIGRATIONS:
+            if version in done:
+                continue
+            migrate(connection)
+            connection.execute(schema_migrations.insert().values(version=version, description=description))
+            applied.append(version)
+        return applied
+
+if __name__ == "__main__":
+    applied = upgrade()
+    print(f"Applied migrations: {applied}" if applied else "Schema is up to date")
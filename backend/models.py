@@ -71,6 +71,10 @@ class ProxyService(Base):
     base_url = Column(String(200), nullable=False)
     description = Column(String(200), nullable=True)
     enabled = Column(Boolean, default=True)
+    max_body_size = Column(Integer, nullable=True)  # bytes, None = PROXY_MAX_BODY_SIZE
+    cache_enabled = Column(Boolean, default=False)
+    cache_ttl = Column(Integer, nullable=True)  # seconds, for responses without explicit freshness
+    permission_id = Column(Integer, ForeignKey('permissions.id'), nullable=True)  # None = open to every visitor
 
     def __repr__(self):
         return f"<ProxyService(name={self.name}, enabled={self.enabled})>"
@@ -90,4 +94,26 @@ class SSOProvider(Base):
     enabled = Column(Boolean, default=True)
 
     def __repr__(self):
-        return f"<SSOProvider(name={self.name}, enabled={self.enabled})>"
\ No newline at end of file
+        return f"<SSOProvider(name={self.name}, enabled={self.enabled})>"
+
+# A login and the refresh token currently valid for it. Each refresh replaces
+# refresh_jti, so a refresh token can only be used once.
+class TokenSession(Base):
+    __tablename__ = 'token_sessions'
+
+    id = Column(String(64), primary_key=True)  # "sid" claim of its tokens
+    username = Column(String(80), nullable=False, index=True)
+    refresh_jti = Column(String(64), nullable=False)
+    expires_at = Column(Integer, nullable=False, index=True)  # epoch seconds
+
+    def __repr__(self):
+        return f"<TokenSession(username={self.username})>"
+
+class RevokedToken(Base):
+    __tablename__ = 'revoked_tokens'
+
+    token_id = Column(String(64), primary_key=True)  # "jti" or "sid" claim
+    expires_at = Column(Integer, nullable=False, index=True)  # epoch seconds, then forgotten
+
+    def __repr__(self):
+        return f"<RevokedToken(token_id={self.token_id})>"
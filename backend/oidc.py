@@ -0,0 +1,252 @@
+import asyncio
+import functools
+import os
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import httpx
+from jose import jwk, jwt
+from jose.backends.base import Key
+from jose.exceptions import JOSEError
+
+from backend.tokens import JWT_LEEWAY
+
+# Seconds discovery documents and JWKS are used before being refreshed in the
+# background, and minimum seconds between two forced JWKS reloads (unknown kid)
+OIDC_CACHE_TTL = float(os.environ.get("OIDC_CACHE_TTL", "3600"))
+OIDC_JWKS_MIN_RELOAD_INTERVAL = float(os.environ.get("OIDC_JWKS_MIN_RELOAD_INTERVAL", "60"))
+# Seconds allowed for each call to an identity provider
+OIDC_TIMEOUT = float(os.environ.get("OIDC_TIMEOUT", "10"))
+# Seconds a document that couldn't be fetched fails at once instead of
+# waiting for the provider again (provider down)
+OIDC_FAILURE_TTL = float(os.environ.get("OIDC_FAILURE_TTL", "30"))
+
+# Default algorithm of JWKs without "alg", by key type
+DEFAULT_JWK_ALGORITHMS = {"RSA": "RS256", "EC": "ES256"}
+
+
+class OIDCError(Exception):
+    pass
+
+
+def json_object(response: httpx.Response, what: str) -> dict:
+    """
+    The JSON object of a provider's answer, OIDCError for anything else
+    (error pages).
+    """
+    try:
+        value = response.json()
+    except ValueError as e:
+        raise OIDCError(f"Invalid {what} from provider") from e
+    if not isinstance(value, dict):
+        raise OIDCError(f"Invalid {what} from provider")
+    return value
+
+
+def parse_jwks(document: dict) -> Dict[Optional[str], Key]:
+    """
+    Prepared signature keys of a JWKS document, by kid.
+    """
+    keys = {}
+    for key in document.get("keys", []):
+        algorithm = key.get("alg") or DEFAULT_JWK_ALGORITHMS.get(key.get("kty"))
+        if key.get("use", "sig") != "sig" or algorithm is None:
+            continue
+        try:
+            keys[key.get("kid")] = jwk.construct(key, algorithm)
+        except JOSEError:
+            continue  # key types jose can't use
+    return keys
+
+
+class OIDCClient:
+    """
+    Calls to identity providers on a pooled async client, with their
+    discovery documents and JWKS cached: an SSO login costs the code
+    exchange, and the userinfo call only when the ID token lacks the claims.
+
+    Expired documents keep being served while a single background task
+    refreshes them.
+    """
+
+    def __init__(
+        self,
+        ttl: float = OIDC_CACHE_TTL,
+        timeout: float = OIDC_TIMEOUT,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        failure_ttl: float = OIDC_FAILURE_TTL,
+    ):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.failure_ttl = failure_ttl
+        self.transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        self._documents: Dict[str, Tuple[float, Any]] = {}
+        self._fetches: Dict[str, asyncio.Task] = {}
+        self._forced_at: Dict[str, float] = {}
+        self._failed_at: Dict[str, float] = {}
+        self.counters = {"fetches": 0, "hits": 0, "background_refreshes": 0}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout, transport=self.transport)
+        return self._client
+
+    async def _fetch(self, url: str, parse: Callable[[dict], Any]):
+        self.counters["fetches"] += 1
+        response = await self.client.get(url, headers={"Accept": "application/json"})
+        response.raise_for_status()
+        document = response.json()
+        if not isinstance(document, dict):
+            raise ValueError(f"Not a JSON object: {url}")
+        value = parse(document)
+        self._documents[url] = (time.monotonic(), value)
+        self._failed_at.pop(url, None)
+        return value
+
+    def _start_fetch(self, url: str, parse: Callable[[dict], Any]) -> asyncio.Task:
+        task = self._fetches.get(url)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._fetch(url, parse))
+            self._fetches[url] = task
+            task.add_done_callback(functools.partial(self._fetched, url))
+        return task
+
+    def _fetched(self, url: str, task: asyncio.Task):
+        self._fetches.pop(url, None)
+        if not task.cancelled():
+            task.exception()  # a failed background refresh keeps the old document
+
+    async def document(self, url: str, parse: Callable[[dict], Any] = dict, force: bool = False):
+        """
+        Cached JSON document at url, through parse().
+        """
+        entry = self._documents.get(url)
+        if entry is None or force:
+            if entry is None and time.monotonic() - self._failed_at.get(url, float("-inf")) < self.failure_ttl:
+                raise OIDCError(f"Failed to fetch {url}")
+            try:
+                return await asyncio.shield(self._start_fetch(url, parse))
+            except (httpx.HTTPError, ValueError) as e:
+                if entry is None:
+                    self._failed_at[url] = time.monotonic()
+                    raise OIDCError(f"Failed to fetch {url}") from e
+                return entry[1]
+        if time.monotonic() - entry[0] > self.ttl and url not in self._fetches:
+            self.counters["background_refreshes"] += 1
+            self._start_fetch(url, parse)
+        self.counters["hits"] += 1
+        return entry[1]
+
+    async def discovery(self, issuer_url: str) -> dict:
+        return await self.document(issuer_url.rstrip("/") + "/.well-known/openid-configuration")
+
+    async def signing_key(self, jwks_uri: str, kid: Optional[str]) -> Optional[Key]:
+        keys = await self.document(jwks_uri, parse_jwks)
+        key = keys.get(kid) if kid or len(keys) != 1 else next(iter(keys.values()))
+        if key is None and time.monotonic() - self._forced_at.get(jwks_uri, float("-inf")) > OIDC_JWKS_MIN_RELOAD_INTERVAL:
+            # The provider may have rotated its keys
+            self._forced_at[jwks_uri] = time.monotonic()
+            key = (await self.document(jwks_uri, parse_jwks, force=True)).get(kid)
+        return key
+
+    async def validate_id_token(self, provider, metadata: dict, id_token: str, access_token: Optional[str]) -> dict:
+        """
+        Claims of an ID token checked locally: signature against the
+        provider's JWKS (or client secret for HS*), issuer, audience, expiry
+        and at_hash.
+        """
+        try:
+            header = jwt.get_unverified_header(id_token)
+        except JOSEError as e:
+            raise OIDCError("Invalid ID token") from e
+        algorithm = header.get("alg")
+        allowed = metadata.get("id_token_signing_alg_values_supported") or ["RS256"]
+        if not algorithm or algorithm == "none" or algorithm not in allowed:
+            raise OIDCError("Unexpected ID token algorithm")
+        if algorithm.startswith("HS"):
+            key = provider.client_secret
+        else:
+            key = await self.signing_key(metadata["jwks_uri"], header.get("kid"))
+        if key is None:
+            raise OIDCError("Unknown ID token key")
+        try:
+            return jwt.decode(
+                id_token,
+                key,
+                algorithms=[algorithm],
+                audience=provider.client_id,
+                issuer=metadata.get("issuer", provider.issuer_url),
+                access_token=access_token,
+                options={"leeway": JWT_LEEWAY},
+            )
+        except JOSEError as e:
+            raise OIDCError("Invalid ID token") from e
+
+    async def authorization_url(self, provider) -> str:
+        if provider.auth_url:
+            return provider.auth_url
+        endpoint = (await self.discovery(provider.issuer_url)).get("authorization_endpoint")
+        if not endpoint:
+            raise OIDCError("Provider has no authorization endpoint")
+        return endpoint
+
+    async def identity(self, provider, code: str, redirect_uri: str) -> dict:
+        """
+        Claims of the user who signed in with an authorization code.
+        """
+        try:
+            metadata = await self.discovery(provider.issuer_url)
+        except OIDCError:
+            if not (provider.token_url and provider.userinfo_url):
+                raise
+            metadata = {}  # plain OAuth2 provider, configured by hand
+
+        token_url = provider.token_url or metadata.get("token_endpoint")
+        if not token_url:
+            raise OIDCError("Provider has no token endpoint")
+        try:
+            token_response = await self.client.post(token_url, data={
+                "grant_type": "authorization_code",
+                "code": code,
+                "redirect_uri": redirect_uri,
+                "client_id": provider.client_id,
+                "client_secret": provider.client_secret,
+            })
+        except httpx.HTTPError as e:
+            raise OIDCError("Failed to get token from provider") from e
+        if token_response.status_code != 200:
+            raise OIDCError("Failed to get token from provider")
+        tokens = json_object(token_response, "token response")
+        access_token = tokens.get("access_token")
+
+        claims = {}
+        if tokens.get("id_token") and metadata.get("jwks_uri"):
+            claims = await self.validate_id_token(provider, metadata, tokens["id_token"], access_token)
+        if claims.get("email"):
+            return claims
+
+        userinfo_url = provider.userinfo_url or metadata.get("userinfo_endpoint")
+        if not userinfo_url:
+            raise OIDCError("Provider has no userinfo endpoint")
+        try:
+            userinfo_response = await self.client.get(userinfo_url, headers={"Authorization": f"Bearer {access_token}"})
+        except httpx.HTTPError as e:
+            raise OIDCError("Failed to fetch user info") from e
+        if userinfo_response.status_code != 200:
+            raise OIDCError("Failed to fetch user info")
+        userinfo = json_object(userinfo_response, "user info")
+        if claims.get("sub") and userinfo.get("sub") not in (None, claims["sub"]):
+            raise OIDCError("User info does not match the ID token")
+        return {**claims, **userinfo}
+
+    async def aclose(self):
+        for task in list(self._fetches.values()):
+            task.cancel()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+oidc_client = OIDCClient()
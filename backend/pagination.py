@@ -0,0 +1,81 @@
+"""
+Keyset pagination for the listing endpoints.
+
+A page is the rows after the cursor in the order of a unique, indexed
+column, so fetching page 1000 costs the same as page 1 (no OFFSET). The
+body stays a JSON list; the cursor of the next page is returned in the
+X-Next-Cursor and Link headers, and is absent on the last page.
+"""
+import base64
+import json
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Rows per page when the client gives no limit, and the most it may ask for
+PAGE_SIZE = int(os.environ.get("CRUD_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.environ.get("CRUD_MAX_PAGE_SIZE", "1000"))
+# Rows serialized per chunk of a streamed list
+STREAM_CHUNK_ROWS = 200
+
+
+def encode_cursor(value: Any) -> str:
+    return base64.urlsafe_b64encode(json.dumps([value]).encode()).rstrip(b"=").decode()
+
+def decode_cursor(cursor: str) -> Any:
+    try:
+        (value,) = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise HTTPException(400, "Invalid cursor")
+    return value
+
+
+async def keyset_page(
+    db: AsyncSession,
+    statement: Select,
+    sort_columns: Dict[str, Any],
+    sort: str,
+    cursor: Optional[str],
+    limit: int,
+) -> Tuple[List[dict], Optional[str]]:
+    """
+    One page of statement's rows as dicts, sorted by sort ("name", or
+    "-name" for descending) among sort_columns, which must be unique and
+    selected by statement. Returns the rows and the next cursor.
+    """
+    column = sort_columns.get(sort.lstrip("-"))
+    if column is None:
+        raise HTTPException(400, f"Cannot sort by {sort}, use one of: {', '.join(sort_columns)}")
+    descending = sort.startswith("-")
+    if cursor is not None:
+        after = decode_cursor(cursor)
+        statement = statement.where(column < after if descending else column > after)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    statement = statement.order_by(column.desc() if descending else column.asc()).limit(limit + 1)
+    rows = [dict(row) for row in (await db.execute(statement)).mappings()]
+    if len(rows) <= limit:
+        return rows, None
+    del rows[limit:]
+    return rows, encode_cursor(rows[-1][column.key])
+
+
+async def json_chunks(rows: Sequence[dict]):
+    yield b"["
+    for start in range(0, len(rows), STREAM_CHUNK_ROWS):
+        chunk = ",".join(json.dumps(row) for row in rows[start:start + STREAM_CHUNK_ROWS])
+        yield (b"," if start else b"") + chunk.encode()
+    yield b"]"
+
+def page_response(request: Request, rows: Sequence[dict], next_cursor: Optional[str]) -> StreamingResponse:
+    """
+    The rows as a JSON list written chunk by chunk, with the next cursor.
+    """
+    headers = {}
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+        headers["Link"] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
+    return StreamingResponse(json_chunks(rows), media_type="application/json", headers=headers)
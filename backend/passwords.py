@@ -0,0 +1,84 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+# bcrypt cost factor of new hashes. Passwords stored with another one are
+# rehashed at their next login.
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+
+# Hashes computed at once per worker, and hashes allowed to wait for a
+# thread before logins are turned away with 503 (login storms)
+PASSWORD_HASH_CONCURRENCY = int(os.environ.get("PASSWORD_HASH_CONCURRENCY", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_QUEUE = int(os.environ.get("PASSWORD_HASH_QUEUE", "32"))
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    """
+    bcrypt off the event loop: each hash takes a few hundred milliseconds of
+    CPU, which would stall every proxied stream of the worker. bcrypt
+    releases the GIL, so a small thread pool runs them in parallel.
+    """
+
+    def __init__(
+        self,
+        rounds: int = BCRYPT_ROUNDS,
+        concurrency: int = PASSWORD_HASH_CONCURRENCY,
+        queue: int = PASSWORD_HASH_QUEUE,
+    ):
+        # min = max = default: any other cost factor needs an update
+        self.context = CryptContext(
+            schemes=["bcrypt"],
+            deprecated="auto",
+            bcrypt__default_rounds=rounds,
+            bcrypt__min_rounds=rounds,
+            bcrypt__max_rounds=rounds,
+        )
+        self.concurrency = concurrency
+        self.queue = queue
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending = 0
+        self.counters = {"hashed": 0, "verified": 0, "rehashed": 0, "rejected": 0}
+
+    async def _run(self, fn, *args):
+        if self._pending >= self.concurrency + self.queue:
+            self.counters["rejected"] += 1
+            raise PasswordHasherBusy()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix="bcrypt")
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        self.counters["hashed"] += 1
+        return await self._run(self.context.hash, password)
+
+    async def verify_and_update(self, password: str, password_hash: Optional[str]) -> Tuple[bool, Optional[str]]:
+        """
+        (valid, new_hash): new_hash is set when the stored hash should be
+        replaced, e.g. after a change of BCRYPT_ROUNDS.
+        """
+        if not password_hash:
+            return False, None  # SSO accounts have no password
+        self.counters["verified"] += 1
+        valid, new_hash = await self._run(self.context.verify_and_update, password, password_hash)
+        if new_hash:
+            self.counters["rehashed"] += 1
+        return valid, new_hash
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,179 @@
+import asyncio
+from collections import defaultdict
+from typing import Callable, Dict, FrozenSet, Set
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.database import AsyncSessionLocal
+from backend.invalidation import GenerationBus, generations
+from backend.models import group_permissions, user_groups, user_permissions
+
+ENTITIES = ("users", "groups", "permissions")
+
+
+def bits(permission_ids) -> int:
+    mask = 0
+    for permission_id in permission_ids:
+        mask |= 1 << permission_id
+    return mask
+
+
+class PermissionIndex:
+    """
+    Effective permissions of every user (its own plus those of its groups),
+    as a bitset over permission ids, so access checks on the proxy path are
+    a dictionary lookup and a bit test.
+
+    Changes made by this worker are applied incrementally, only the users
+    they concern are recomputed. A change signalled by another worker through
+    the generation bus rebuilds the index from the association tables.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], AsyncSession] = AsyncSessionLocal,
+        bus: GenerationBus = generations,
+    ):
+        self.session_factory = session_factory
+        self._generations = {entity: bus.watch(entity) for entity in ENTITIES}
+        self._user_permissions: Dict[int, Set[int]] = defaultdict(set)
+        self._user_groups: Dict[int, Set[int]] = defaultdict(set)
+        self._group_permissions: Dict[int, Set[int]] = defaultdict(set)
+        self._group_members: Dict[int, Set[int]] = defaultdict(set)
+        self._effective: Dict[int, int] = {}
+        self._refresh_lock = asyncio.Lock()
+
+    async def load(self, db: AsyncSession):
+        """
+        (Re)build the index from the database.
+        """
+        seen = {entity: watcher.current() for entity, watcher in self._generations.items()}
+        user_permission_rows = (await db.execute(select(user_permissions.c.user_id, user_permissions.c.permission_id))).all()
+        user_group_rows = (await db.execute(select(user_groups.c.user_id, user_groups.c.group_id))).all()
+        group_permission_rows = (await db.execute(select(group_permissions.c.group_id, group_permissions.c.permission_id))).all()
+
+        self._user_permissions = defaultdict(set)
+        self._user_groups = defaultdict(set)
+        self._group_permissions = defaultdict(set)
+        self._group_members = defaultdict(set)
+        for user_id, permission_id in user_permission_rows:
+            self._user_permissions[user_id].add(permission_id)
+        for user_id, group_id in user_group_rows:
+            self._user_groups[user_id].add(group_id)
+            self._group_members[group_id].add(user_id)
+        for group_id, permission_id in group_permission_rows:
+            self._group_permissions[group_id].add(permission_id)
+
+        group_bits = {group_id: bits(permissions) for group_id, permissions in self._group_permissions.items()}
+        effective = {}
+        for user_id in self._user_permissions.keys() | self._user_groups.keys():
+            mask = bits(self._user_permissions.get(user_id, ()))
+            for group_id in self._user_groups.get(user_id, ()):
+                mask |= group_bits.get(group_id, 0)
+            effective[user_id] = mask
+        self._effective = effective
+        for entity, watcher in self._generations.items():
+            watcher.mark(seen[entity])
+
+    async def refresh(self):
+        async with self.session_factory() as db:
+            await self.load(db)
+
+    def is_stale(self) -> bool:
+        return any(watcher.changed() for watcher in self._generations.values())
+
+    async def ensure_fresh(self):
+        """
+        Rebuild the index if another worker changed memberships or if it was
+        never loaded. Concurrent callers wait for a single rebuild.
+        """
+        if not self.is_stale():
+            return
+        async with self._refresh_lock:
+            if self.is_stale():
+                await self.refresh()
+
+    def acknowledge(self, bumped: Dict[str, int]):
+        """
+        Record generations bumped by this worker after applying its change
+        here, so they don't trigger a rebuild. Skipped when the index was not
+        up to date right before, or another worker bumped too.
+        """
+        for entity, generation in bumped.items():
+            watcher = self._generations.get(entity)
+            if watcher is not None and watcher.seen == generation - 1:
+                watcher.mark(generation)
+
+    def allows(self, user_id: int, permission_id: int) -> bool:
+        return bool(self._effective.get(user_id, 0) >> permission_id & 1)
+
+    def effective(self, user_id: int) -> FrozenSet[int]:
+        mask = self._effective.get(user_id, 0)
+        return frozenset(permission_id for permission_id in range(mask.bit_length()) if mask >> permission_id & 1)
+
+    # Incremental changes, applied once committed
+
+    def _recompute(self, user_id: int):
+        mask = bits(self._user_permissions.get(user_id, ()))
+        for group_id in self._user_groups.get(user_id, ()):
+            mask |= bits(self._group_permissions.get(group_id, ()))
+        if mask:
+            self._effective[user_id] = mask
+        else:
+            self._effective.pop(user_id, None)
+
+    def add_member(self, user_id: int, group_id: int):
+        self._user_groups[user_id].add(group_id)
+        self._group_members[group_id].add(user_id)
+        self._recompute(user_id)
+
+    def remove_member(self, user_id: int, group_id: int):
+        self._user_groups[user_id].discard(group_id)
+        self._group_members[group_id].discard(user_id)
+        self._recompute(user_id)
+
+    def grant_user(self, user_id: int, permission_id: int):
+        self._user_permissions[user_id].add(permission_id)
+        self._effective[user_id] = self._effective.get(user_id, 0) | 1 << permission_id
+
+    def revoke_user(self, user_id: int, permission_id: int):
+        self._user_permissions[user_id].discard(permission_id)
+        self._recompute(user_id)
+
+    def grant_group(self, group_id: int, permission_id: int):
+        self._group_permissions[group_id].add(permission_id)
+        for user_id in self._group_members.get(group_id, ()):
+            self._effective[user_id] = self._effective.get(user_id, 0) | 1 << permission_id
+
+    def revoke_group(self, group_id: int, permission_id: int):
+        self._group_permissions[group_id].discard(permission_id)
+        for user_id in self._group_members.get(group_id, ()):
+            self._recompute(user_id)
+
+    def remove_user(self, user_id: int):
+        for group_id in self._user_groups.pop(user_id, ()):
+            self._group_members[group_id].discard(user_id)
+        self._user_permissions.pop(user_id, None)
+        self._effective.pop(user_id, None)
+
+    def remove_group(self, group_id: int):
+        members = self._group_members.pop(group_id, set())
+        self._group_permissions.pop(group_id, None)
+        for user_id in members:
+            self._user_groups[user_id].discard(group_id)
+            self._recompute(user_id)
+
+    def remove_permission(self, permission_id: int):
+        users = {user_id for user_id, permissions in self._user_permissions.items() if permission_id in permissions}
+        for user_id in users:
+            self._user_permissions[user_id].discard(permission_id)
+        for group_id, permissions in self._group_permissions.items():
+            if permission_id in permissions:
+                permissions.discard(permission_id)
+                users.update(self._group_members.get(group_id, ()))
+        for user_id in users:
+            self._recompute(user_id)
+
+
+permission_index = PermissionIndex()
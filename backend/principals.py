@@ -0,0 +1,109 @@
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, FrozenSet, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.invalidation import GenerationBus, generations
+from backend.loading import load_profile
+from backend.models import User
+
+# Seconds an authenticated user is trusted without reloading it, and users
+# kept per worker
+PRINCIPAL_CACHE_TTL = float(os.environ.get("PRINCIPAL_CACHE_TTL", "300"))
+PRINCIPAL_CACHE_SIZE = int(os.environ.get("PRINCIPAL_CACHE_SIZE", "10000"))
+
+
+@dataclass(frozen=True)
+class Principal:
+    """
+    What authorization needs to know about a user, detached from the
+    database session.
+    """
+    id: int
+    username: str
+    email: Optional[str]
+    groups: FrozenSet[str]
+    permissions: FrozenSet[str]  # own permissions and those of its groups
+
+    @property
+    def is_admin(self) -> bool:
+        return "admin" in self.groups
+
+    @classmethod
+    def from_user(cls, user: User) -> "Principal":
+        permissions = {permission.name for permission in user.permissions}
+        for group in user.groups:
+            permissions.update(permission.name for permission in group.permissions)
+        return cls(
+            id=user.id,
+            username=user.username,
+            email=user.email,
+            groups=frozenset(group.name for group in user.groups),
+            permissions=frozenset(permissions),
+        )
+
+async def load_principal(db: AsyncSession, username: str) -> Optional[Principal]:
+    result = await db.execute(select(User).options(*load_profile("principal")).where(User.username == username))
+    user = result.scalars().first()
+    return Principal.from_user(user) if user is not None else None
+
+
+class PrincipalCache:
+    """
+    Authenticated users by username (the token subject), so authorized
+    requests don't query the database.
+
+    Any change to users, groups or permissions, in any worker, empties the
+    cache through the generation bus; the TTL is only a safety net.
+    """
+
+    def __init__(
+        self,
+        ttl: float = PRINCIPAL_CACHE_TTL,
+        max_entries: int = PRINCIPAL_CACHE_SIZE,
+        bus: GenerationBus = generations,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._watchers = [bus.watch(entity) for entity in ("users", "groups", "permissions")]
+        self._entries: "OrderedDict[str, Tuple[float, Principal]]" = OrderedDict()
+        # Bumped on every clear: loads started before it are not stored
+        self._epoch = 0
+        self.counters = {"hits": 0, "misses": 0}
+
+    def _sync_generations(self):
+        if any(watcher.changed() for watcher in self._watchers):
+            for watcher in self._watchers:
+                watcher.mark(watcher.current())
+            self.clear()
+
+    def clear(self):
+        self._entries.clear()
+        self._epoch += 1
+
+    async def get(self, username: str, load: Callable[[], Awaitable[Optional[Principal]]]) -> Optional[Principal]:
+        """
+        Cached principal of a user, or load() it. None for unknown users.
+        """
+        self._sync_generations()
+        entry = self._entries.get(username)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._entries.move_to_end(username)
+            self.counters["hits"] += 1
+            return entry[1]
+        self.counters["misses"] += 1
+        epoch = self._epoch
+        principal = await load()
+        if principal is not None and epoch == self._epoch:
+            self._entries[username] = (time.monotonic(), principal)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return principal
+
+
+principal_cache = PrincipalCache()
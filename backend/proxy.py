@@ -1,17 +1,52 @@
-import asyncio
+import functools
+import os
+import re
+import time
+from typing import Optional
 from urllib.parse import urljoin, urlparse
+import anyio
 import httpx
 
 from fastapi import APIRouter, Request, Response, WebSocket, WebSocketDisconnect, HTTPException, Depends
+from fastapi.responses import StreamingResponse
 
-from backend.database import get_db
-from backend.models import ProxyService
+from backend.cache import (
+    CONDITIONAL_HEADERS,
+    NOT_MODIFIED_HEADERS,
+    CacheEntry,
+    CacheWriter,
+    cache_key,
+    request_cache_policy,
+    response_cache,
+    storable_lifetime,
+)
+from backend.auth import principal_from_token
+from backend.coalescing import Flight, coalesce_key, is_coalescable, request_coalescer
+from backend.permissions import permission_index
+from backend.routing import ServiceRoute, routing_table
+from backend.telemetry import (
+    proxy_bytes,
+    proxy_duration,
+    proxy_requests,
+    proxy_time_to_first_byte,
+    websocket_relays,
+    websocket_relays_total,
+)
+from backend.upstream import upstream_clients
+from backend.wsrelay import connect_upstream, relay
 from starlette.types import Receive, Scope, Send
+from websockets.exceptions import WebSocketException
 
 proxy_router = APIRouter(prefix="/api/proxy", tags=["proxy"])
 
 INJECTED_JS = '<script src="/static/injection.js"></script>'
 
+# Default upload limit in bytes for services without max_body_size (0 = no limit)
+PROXY_MAX_BODY_SIZE = int(os.environ.get("PROXY_MAX_BODY_SIZE", "0"))
+
+class RequestBodyTooLarge(Exception):
+    pass
+
 def adjust_set_cookie_header(set_cookie_value: str, proxy_path_prefix: str) -> str:
     """
     Modify the 'Path' attribute in Set-Cookie header to use proxy path,
@@ -30,83 +65,388 @@ def adjust_set_cookie_header(set_cookie_value: str, proxy_path_prefix: str) -> s
         new_parts.append(f"Path={proxy_path_prefix}")
     return ";".join(new_parts)
 
+class JavaScriptInjector:
+    """
+    Incremental JS injection: feed HTML chunks as they arrive and get them
+    back with INJECTED_JS inserted before the first </body>. Only the last
+    few bytes of a chunk are held back, in case the tag is split across a
+    chunk boundary.
+    """
+
+    CLOSING_BODY_TAG = re.compile(rb"</body>", re.IGNORECASE)
+    CARRY_SIZE = len(b"</body>") - 1
+
+    def __init__(self, snippet: bytes = INJECTED_JS.encode("utf-8")):
+        self.snippet = snippet
+        self.injected = False
+        self._carry = b""
+
+    def feed(self, chunk: bytes) -> bytes:
+        if self.injected:
+            return chunk
+        data = self._carry + chunk if self._carry else chunk
+        match = self.CLOSING_BODY_TAG.search(data)
+        if match:
+            self.injected = True
+            self._carry = b""
+            idx = match.start()
+            return data[:idx] + self.snippet + data[idx:]
+        self._carry = data[-self.CARRY_SIZE:]
+        return data[:-self.CARRY_SIZE]
+
+    def flush(self) -> bytes:
+        rest, self._carry = self._carry, b""
+        return rest
+
 async def inject_javascript(content: bytes) -> bytes:
     """
     Inject JS snippet in HTML content.
     """
-    closing_body_tag = b"</body>"
-    idx = content.lower().find(closing_body_tag)
-    if idx == -1:
-        return content
-    return content[:idx] + INJECTED_JS.encode("utf-8") + content[idx:]
+    injector = JavaScriptInjector()
+    return injector.feed(content) + injector.flush()
+
+# Hop-by-hop headers are never forwarded to the client
+STREAMED_EXCLUDED_HEADERS = {
+    "transfer-encoding",
+    "connection",
+    "content-security-policy",
+}
+
+# Content encodings httpx can decode on the fly (brotli is optional)
+try:
+    import brotli  # noqa: F401
+    DECODABLE_ENCODINGS = {"identity", "gzip", "deflate", "br"}
+except ImportError:
+    DECODABLE_ENCODINGS = {"identity", "gzip", "deflate"}
+
+# Rewritten bodies are decoded and change length
+REWRITTEN_EXCLUDED_HEADERS = STREAMED_EXCLUDED_HEADERS | {
+    "content-encoding",
+    "content-length",
+}
+
+def rewrite_response_headers(upstream_headers, proxy_prefix: str, excluded_headers: set):
+    """
+    Filter upstream response headers and rewrite Location / Set-Cookie
+    so they point at the proxy path. Returns a list of (name, value)
+    pairs, repeated headers (Set-Cookie) are kept.
+    """
+    response_headers = []
+    for k, v in upstream_headers.multi_items():
+        if k.lower() in excluded_headers:
+            continue
+        # Adjust Location header for redirects
+        if k.lower() == "location" and v.startswith("/"):
+            response_headers.append(("Location", proxy_prefix + v))
+        # Adjust Set-Cookie header path attribute for proxy
+        elif k.lower() == "set-cookie":
+            response_headers.append((k, adjust_set_cookie_header(v, proxy_prefix)))
+        else:
+            response_headers.append((k, v))
+    return response_headers
+
+async def stream_upstream(resp: httpx.Response, injector: JavaScriptInjector = None, cache_writer: CacheWriter = None):
+    """
+    Yield the upstream body chunk by chunk, without buffering it.
+    Without an injector the raw (still encoded) bytes are forwarded; with one
+    the body is decoded incrementally and passed through the injector.
+    A cache writer gets a copy of the raw chunks and stores the response
+    once the whole body went through.
+    If the client disconnects the generator is cancelled and the upstream
+    response is closed, which aborts the upstream read.
+    """
+    try:
+        if injector is None:
+            async for chunk in resp.aiter_raw():
+                if cache_writer is not None:
+                    cache_writer.feed(chunk)
+                yield chunk
+            if cache_writer is not None:
+                await cache_writer.commit()
+        else:
+            async for chunk in resp.aiter_bytes():
+                chunk = injector.feed(chunk)
+                if chunk:
+                    yield chunk
+            rest = injector.flush()
+            if rest:
+                yield rest
+    finally:
+        with anyio.CancelScope(shield=True):
+            await resp.aclose()
+
+async def stream_flight(flight: Flight, cache_writer: CacheWriter = None):
+    """
+    stream_upstream() for a response shared by coalesced requests.
+    """
+    async for chunk in flight.stream():
+        if cache_writer is not None:
+            cache_writer.feed(chunk)
+        yield chunk
+    if cache_writer is not None:
+        await cache_writer.commit()
+
+def cached_response(entry: CacheEntry, proxy_prefix: str, request_headers, x_cache: str = "HIT") -> Response:
+    """
+    Answer from a cache entry: 304 when the client's validators match it,
+    the stored response otherwise.
+    """
+    if entry.status_code == 200 and entry.not_modified(request_headers):
+        response_cache.counters["not_modified"] += 1
+        response = Response(status_code=304)
+        headers = [(k, v) for k, v in entry.headers if k.lower() in NOT_MODIFIED_HEADERS]
+    else:
+        response = Response(content=entry.body, status_code=entry.status_code)
+        headers = entry.headers
+    for k, v in rewrite_response_headers(httpx.Headers(headers), proxy_prefix, STREAMED_EXCLUDED_HEADERS):
+        response.headers.append(k, v)
+    response.headers["Age"] = str(entry.age())
+    response.headers["X-Cache"] = x_cache
+    return response
+
+def observe_response(service_name: str, status_code: int, started: float):
+    """
+    Count a proxied response once its headers are ready.
+    """
+    proxy_requests.inc((service_name, str(status_code)))
+    proxy_time_to_first_byte.observe((service_name,), time.perf_counter() - started)
+
+def observe_cached(response: Response, service_name: str, started: float) -> Response:
+    # Cached bodies are sent at once: first byte and end are the same
+    observe_response(service_name, response.status_code, started)
+    proxy_duration.observe((service_name,), time.perf_counter() - started)
+    proxy_bytes.inc((service_name, "out"), len(response.body))
+    return response
+
+async def metered(body, service_name: str, started: float):
+    """
+    Pass a streamed body through, counting its bytes and the time until it
+    is sent (or the client went away).
+    """
+    sent = 0
+    try:
+        async for chunk in body:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        proxy_bytes.inc((service_name, "out"), sent)
+        proxy_duration.observe((service_name,), time.perf_counter() - started)
+        with anyio.CancelScope(shield=True):
+            await body.aclose()
+
+async def revalidate_entry(
+    client: httpx.AsyncClient, url: str, headers: dict, params, entry: CacheEntry, cache_ttl: Optional[int]
+) -> Optional[CacheEntry]:
+    """
+    Ask the upstream whether a stale entry is still valid, with the entry's
+    own validators instead of the client's. Returns the refreshed entry on
+    304, the new one if the resource changed and can be cached, else None
+    without reading the rest of the body.
+    """
+    headers = {k: v for k, v in headers.items() if k.lower() not in CONDITIONAL_HEADERS}
+    headers.update(entry.validators())
+    try:
+        resp = await client.send(client.build_request("GET", url, headers=headers, params=params), stream=True)
+    except httpx.RequestError:
+        return None
+    try:
+        if resp.status_code == 304:
+            entry = entry.refreshed(resp.headers, cache_ttl)
+            await response_cache.put(entry)
+            return entry
+        lifetime = storable_lifetime(headers, resp.status_code, resp.headers, cache_ttl)
+        if lifetime is None:
+            return None
+        writer = response_cache.writer(entry.key, headers, resp, lifetime)
+        async for chunk in resp.aiter_raw():
+            writer.feed(chunk)
+            if writer.gave_up:
+                return None  # too big to store: the client's own request fetches it
+        return await writer.commit()
+    except httpx.HTTPError:
+        return None
+    finally:
+        await resp.aclose()
+
+async def stream_request_body(request: Request, max_body_size: int, service_name: str):
+    """
+    Forward the incoming body to the upstream as it is received.
+    httpx pulls the next chunk only once the previous one is written, so
+    memory stays bounded by the chunk size.
+    """
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        proxy_bytes.inc((service_name, "in"), len(chunk))
+        if max_body_size and received > max_body_size:
+            raise RequestBodyTooLarge()
+        yield chunk
+
+def needs_rewrite(request: Request, resp: httpx.Response) -> bool:
+    """
+    Only complete HTML documents get the JS injection. Partial content
+    (206, or any answer to a Range request) and HEAD responses are always
+    streamed as-is, injecting into them would corrupt byte offsets.
+    """
+    if request.method == "HEAD" or resp.status_code == 206 or "range" in request.headers:
+        return False
+    if "text/html" not in resp.headers.get("content-type", "").lower():
+        return False
+    # Bodies we cannot decode are passed through untouched
+    encodings = resp.headers.get("content-encoding", "identity").lower().split(",")
+    return all(encoding.strip() in DECODABLE_ENCODINGS for encoding in encodings)
+
+def has_request_body(request: Request) -> bool:
+    content_length = request.headers.get("content-length")
+    if content_length is not None:
+        return content_length != "0"
+    return "transfer-encoding" in request.headers
+
+async def check_access(service: ServiceRoute, request_headers) -> Optional[int]:
+    """
+    None if the visitor may use the service, else the refusal status: 401
+    without a valid bearer token, 403 without the service's permission.
+    Services without a permission are open to every visitor.
+    """
+    if service.permission_id is None:
+        return None
+    scheme, _, token = request_headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return 401
+    # Own short session: a cache miss must not pin a connection while streaming
+    async with permission_index.session_factory() as db:
+        principal = await principal_from_token(token, db)
+    if principal is None:
+        return 401
+    if principal.is_admin:
+        return None
+    await permission_index.ensure_fresh()
+    return None if permission_index.allows(principal.id, service.permission_id) else 403
+
+async def accessible_service(service_name: str, request: Request) -> ServiceRoute:
+    """
+    Route of the requested service, if the visitor may use it.
+    """
+    await routing_table.ensure_fresh()
+    service = routing_table.get(service_name)
+    if not service:
+        raise HTTPException(status_code=404, detail=f"Service '{service_name}' not found or disabled")
+    refused = await check_access(service, request.headers)
+    if refused is not None:
+        proxy_requests.inc((service.name, str(refused)))
+    if refused == 401:
+        raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    if refused == 403:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    return service
 
 @proxy_router.api_route(
     "/{service_name}/{full_path:path}",
-    methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"],
+    methods=["GET", "HEAD", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"],
 )
-@proxy_router.api_route("/{service_name}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"])
+@proxy_router.api_route("/{service_name}", methods=["GET", "HEAD", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"])
 async def proxy_http(
     service_name: str,
     full_path: str = "",
     request: Request = None,
-    db=Depends(get_db),
+    service: ServiceRoute = Depends(accessible_service),
 ):
-    service = db.query(ProxyService).filter_by(name=service_name, enabled=True).first()
-    if not service:
-        raise HTTPException(status_code=404, detail=f"Service '{service_name}' not found or disabled")
-
+    started = time.perf_counter()
     # Compose target URL
     target_url = urljoin(service.base_url.rstrip("/") + "/", full_path.lstrip("/"))
 
     # Forward headers except Host
     headers = {k: v for k, v in request.headers.items() if k.lower() != "host"}
+    if service.permission_id is not None:
+        headers.pop("authorization", None)  # our own token, not the upstream's
 
-    async with httpx.AsyncClient(timeout=None, follow_redirects=False) as client:
-        try:
-            body = await request.body()
-            resp = await client.request(
-                method=request.method,
-                url=target_url,
-                headers=headers,
-                content=body,
-                cookies=request.cookies,
-                params=request.query_params,
-            )
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=502, detail=f"Upstream unreachable: {str(e)}")
+    # Reject oversized uploads before contacting the upstream
+    max_body_size = service.max_body_size or PROXY_MAX_BODY_SIZE
+    content_length = request.headers.get("content-length", "")
+    if max_body_size and content_length.isdigit() and int(content_length) > max_body_size:
+        proxy_requests.inc((service.name, "413"))
+        raise HTTPException(status_code=413, detail="Request body too large")
 
-    excluded_headers = {
-        "content-encoding",
-        "content-length",
-        "transfer-encoding",
-        "connection",
-        "content-security-policy",
-    }
+    # Shared cache, for services that enable it (artwork, static bundles)
+    key = None
+    entry = None
+    if service.cache_enabled:
+        may_serve, may_store = request_cache_policy(request.method, request.headers)
+        if may_store:
+            key = cache_key(service.name, full_path, request.url.query)
+        if may_serve:
+            entry = await response_cache.lookup(key, request.headers)
+            if entry is not None and entry.is_fresh():
+                return observe_cached(cached_response(entry, service.proxy_prefix, request.headers), service.name, started)
 
-    response_headers = []
-    proxy_prefix = f"/api/proxy/{service_name}"
+    client = upstream_clients.get(service.name, service.base_url)
 
-    # Adjust Location header for redirects
-    location = resp.headers.get("Location")
-    for k, v in resp.headers.items():
-        if k.lower() in excluded_headers:
-            continue
-        if k.lower() == "location" and location and location.startswith("/"):
-            new_location = proxy_prefix + location
-            response_headers.append(("Location", new_location))
-        # Adjust Set-Cookie header path attribute for proxy
-        elif k.lower() == "set-cookie":
-            new_cookie = adjust_set_cookie_header(v, proxy_prefix)
-            response_headers.append((k, new_cookie))
+    # Stale entry with a validator: a single conditional request refreshes
+    # it for every client asking for it meanwhile
+    if entry is not None and entry.validators():
+        fetch = functools.partial(
+            revalidate_entry, client, target_url, headers, request.query_params, entry, service.cache_ttl
+        )
+        entry = await response_cache.revalidate(entry, fetch)
+        if entry is not None and entry.matches(request.headers):
+            response = cached_response(entry, service.proxy_prefix, request.headers, "REVALIDATED")
+            return observe_cached(response, service.name, started)
+    flight = None
+    try:
+        upstream_request = client.build_request(
+            method=request.method,
+            url=target_url,
+            headers=headers,
+            content=stream_request_body(request, max_body_size, service.name) if has_request_body(request) else None,
+            params=request.query_params,
+        )
+        send = functools.partial(client.send, upstream_request, stream=True)
+        # Identical GETs in flight (same user) share one upstream request
+        if request_coalescer.enabled and is_coalescable(request.method, request.headers):
+            resp, flight = await request_coalescer.send(
+                coalesce_key(service.name, full_path, request.url.query, request.headers),
+                send,
+                functools.partial(needs_rewrite, request),
+            )
         else:
-            response_headers.append((k, v))
+            resp = await send()
+    except RequestBodyTooLarge:
+        proxy_requests.inc((service.name, "413"))
+        raise HTTPException(status_code=413, detail="Request body too large")
+    except httpx.RequestError as e:
+        proxy_requests.inc((service.name, "502"))
+        raise HTTPException(status_code=502, detail=f"Upstream unreachable: {str(e)}")
+
+    proxy_prefix = service.proxy_prefix
+    observe_response(service.name, resp.status_code, started)
 
-    content = resp.content
-    content_type = resp.headers.get("content-type", "").lower()
-    if "text/html" in content_type:
-        content = await inject_javascript(content)
+    # HTML pages are decoded and get the JS injected while they stream
+    if needs_rewrite(request, resp):
+        body = metered(stream_upstream(resp, JavaScriptInjector()), service.name, started)
+        response = StreamingResponse(body, status_code=resp.status_code)
+        for k, v in rewrite_response_headers(resp.headers, proxy_prefix, REWRITTEN_EXCLUDED_HEADERS):
+            response.headers.append(k, v)
+        return response
 
-    return Response(content=content, status_code=resp.status_code, headers=dict(response_headers))
+    # Everything else: raw (still encoded) bytes are forwarded as they arrive.
+    # Content-Length, Content-Range and Accept-Ranges are kept untouched so
+    # 206 Partial Content answers to Range / If-Range requests (media seeking)
+    # reach the client as the upstream sent them.
+    cache_writer = None
+    if key is not None and (flight is None or flight.claim()):
+        lifetime = storable_lifetime(request.headers, resp.status_code, resp.headers, service.cache_ttl)
+        if lifetime is not None:
+            cache_writer = response_cache.writer(key, request.headers, resp, lifetime)
+    if flight is not None:
+        body = stream_flight(flight, cache_writer)
+    else:
+        body = stream_upstream(resp, cache_writer=cache_writer)
+    response = StreamingResponse(metered(body, service.name, started), status_code=resp.status_code)
+    for k, v in rewrite_response_headers(resp.headers, proxy_prefix, STREAMED_EXCLUDED_HEADERS):
+        response.headers.append(k, v)
+    if key is not None:
+        response.headers["X-Cache"] = "MISS"
+    return response
 
 
 @proxy_router.websocket("/{service_name}/{full_path:path}")
@@ -114,43 +454,34 @@ async def proxy_websocket(
     websocket: WebSocket,
     service_name: str,
     full_path: str,
-    db=Depends(get_db),
 ):
-    await websocket.accept()
-
-    service = db.query(ProxyService).filter_by(name=service_name, enabled=True).first()
-    if not service:
+    await routing_table.ensure_fresh()
+    service = routing_table.get(service_name)
+    if not service or await check_access(service, websocket.headers) is not None:
+        await websocket.accept()
         await websocket.close(code=1008)  # Policy Violation
         return
 
-    # Prepare WebSocket URL (convert http(s) to ws(s))
-    base_url = service.base_url
-    if base_url.startswith("https://"):
-        ws_url = "wss://" + base_url[len("https://") :]
-    elif base_url.startswith("http://"):
-        ws_url = "ws://" + base_url[len("http://") :]
-    else:
-        ws_url = base_url
-
-    target_ws_url = urljoin(ws_url.rstrip("/") + "/", full_path.lstrip("/"))
-
-    async with httpx.AsyncClient() as client:
-        try:
-            async with client.ws_connect(target_ws_url) as upstream_ws:
+    target_ws_url = urljoin(service.ws_url.rstrip("/") + "/", full_path.lstrip("/"))
+    if websocket.url.query:
+        target_ws_url += "?" + websocket.url.query
 
-                async def forward_upstream_to_client():
-                    async for message in upstream_ws.iter_bytes():
-                        await websocket.send_bytes(message)
+    client_headers = websocket.headers
+    if service.permission_id is not None:
+        client_headers = {k: v for k, v in client_headers.items() if k != "authorization"}
 
-                async def forward_client_to_upstream():
-                    try:
-                        while True:
-                            message = await websocket.receive_bytes()
-                            await upstream_ws.send_bytes(message)
-                    except WebSocketDisconnect:
-                        pass
-
-                await asyncio.gather(forward_upstream_to_client(), forward_client_to_upstream())
+    # The upstream is connected first, so its subprotocol choice reaches the client
+    try:
+        upstream_ws = await connect_upstream(target_ws_url, client_headers)
+    except (OSError, TimeoutError, WebSocketException):
+        await websocket.accept()
+        await websocket.close(code=1011)  # Internal error
+        return
 
-        except Exception:
-            await websocket.close(code=1011)  # Internal error
\ No newline at end of file
+    await websocket.accept(subprotocol=upstream_ws.subprotocol)
+    websocket_relays.inc((service.name,))
+    websocket_relays_total.inc((service.name,))
+    try:
+        await relay(websocket, upstream_ws)
+    finally:
+        websocket_relays.dec((service.name,))
@@ -0,0 +1,207 @@
+"""
+Counts and timings of the SQL statements run by the app's engines, per
+worker, per statement shape and per request.
+
+Two cursor events per statement and a few additions: cheap enough to stay
+on in production. Statements are grouped by their normalized SQL (values and
+IN lists replaced by "?"), computed once per distinct statement string.
+"""
+import contextvars
+import logging
+import os
+import re
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+
+# Statements slower than this (ms) are kept as samples, the latest ones
+DB_SLOW_QUERY_MS = float(os.environ.get("DB_SLOW_QUERY_MS", "100"))
+DB_SLOW_QUERY_SAMPLES = int(os.environ.get("DB_SLOW_QUERY_SAMPLES", "50"))
+# Requests running more queries, or spending more ms in the database, are
+# logged as warnings (the others at debug level)
+DB_REQUEST_QUERY_WARN = int(os.environ.get("DB_REQUEST_QUERY_WARN", "50"))
+DB_REQUEST_TIME_WARN_MS = float(os.environ.get("DB_REQUEST_TIME_WARN_MS", "500"))
+# Distinct statements tracked per worker, the next ones are counted together
+DB_STATEMENT_STATS_SIZE = int(os.environ.get("DB_STATEMENT_STATS_SIZE", "500"))
+
+OTHER_STATEMENTS = "(other statements)"
+
+logger = logging.getLogger(__name__)
+
+_STRINGS_AND_NUMBERS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PLACEHOLDERS = re.compile(r"\?|%\(\w+\)s|%s")
+_LISTS = re.compile(r"\(\?(?:\s*,\s*\?)*\)(?:\s*,\s*\(\?(?:\s*,\s*\?)*\))*")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize(statement: str) -> str:
+    """
+    The shape of a statement: the same for every value and list length,
+    and for SQLite and PostgreSQL placeholders.
+    """
+    statement = _PLACEHOLDERS.sub("?", _STRINGS_AND_NUMBERS.sub("?", statement))
+    return _SPACES.sub(" ", _LISTS.sub("(?)", statement)).strip()
+
+
+class RequestQueries:
+    __slots__ = ("request", "count", "time")
+
+    def __init__(self, request: str):
+        self.request = request
+        self.count = 0
+        self.time = 0.0
+
+# Queries of the request being handled (shared with the tasks it starts)
+current_request: contextvars.ContextVar[Optional[RequestQueries]] = contextvars.ContextVar("current_request", default=None)
+
+
+class QueryStats:
+    def __init__(
+        self,
+        slow_query_ms: float = DB_SLOW_QUERY_MS,
+        slow_query_samples: int = DB_SLOW_QUERY_SAMPLES,
+        max_statements: int = DB_STATEMENT_STATS_SIZE,
+    ):
+        self.slow_query_ms = slow_query_ms
+        self.max_statements = max_statements
+        self.queries = 0
+        self.errors = 0
+        self.time = 0.0
+        self._normalized: Dict[str, str] = {}
+        self._statements: Dict[str, List[float]] = {}  # count, total seconds, max seconds
+        self._routes: Dict[str, List[float]] = {}  # requests, queries, seconds, max queries
+        self.slow_queries = deque(maxlen=slow_query_samples)
+
+    # Engine events
+
+    def instrument(self, engine):
+        """
+        Record the statements of an Engine (the sync_engine of an async one).
+        """
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+        event.listen(engine, "handle_error", self._failed)
+
+    def remove(self, engine):
+        event.remove(engine, "before_cursor_execute", self._before)
+        event.remove(engine, "after_cursor_execute", self._after)
+        event.remove(engine, "handle_error", self._failed)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        self.record(statement, time.perf_counter() - conn.info["query_started"].pop())
+
+    def _failed(self, exception_context):
+        self.errors += 1
+        connection = exception_context.connection
+        if connection is not None and connection.info.get("query_started"):
+            connection.info["query_started"].pop()
+
+    def shape(self, statement: str) -> str:
+        normalized = self._normalized.get(statement)
+        if normalized is None:
+            if len(self._normalized) >= 4 * self.max_statements:
+                self._normalized.clear()
+            normalized = self._normalized[statement] = normalize(statement)
+        return normalized
+
+    def record(self, statement: str, elapsed: float):
+        self.queries += 1
+        self.time += elapsed
+        request = current_request.get()
+        if request is not None:
+            request.count += 1
+            request.time += elapsed
+        shape = self.shape(statement)
+        stats = self._statements.get(shape)
+        if stats is None:
+            key = shape if len(self._statements) < self.max_statements else OTHER_STATEMENTS
+            stats = self._statements.setdefault(key, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        if elapsed > stats[2]:
+            stats[2] = elapsed
+        if elapsed * 1000 >= self.slow_query_ms:
+            self.slow_queries.append({
+                "statement": shape,
+                "ms": round(elapsed * 1000, 3),
+                "at": time.time(),
+                "request": request.request if request is not None else None,
+            })
+
+    # Requests
+
+    def finish_request(self, route: Optional[str], request: RequestQueries):
+        if route is not None:
+            stats = self._routes.get(route)
+            if stats is None:
+                stats = self._routes[route] = [0, 0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += request.count
+            stats[2] += request.time
+            if request.count > stats[3]:
+                stats[3] = request.count
+        if request.count > DB_REQUEST_QUERY_WARN or request.time * 1000 > DB_REQUEST_TIME_WARN_MS:
+            logger.warning("%s: %d queries, %.1f ms in the database", request.request, request.count, request.time * 1000)
+        elif request.count and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s: %d queries, %.1f ms in the database", request.request, request.count, request.time * 1000)
+
+    def snapshot(self, statements: int = 20) -> dict:
+        """
+        Totals of this worker, the statements taking the most time, the
+        latest slow queries and the queries per request of each route.
+        """
+        top = sorted(self._statements.items(), key=lambda item: item[1][1], reverse=True)[:statements]
+        return {
+            "queries": self.queries,
+            "errors": self.errors,
+            "time_ms": round(self.time * 1000, 3),
+            "slow_query_ms": self.slow_query_ms,
+            "statements": [
+                {"statement": shape, "count": count, "total_ms": round(total * 1000, 3),
+                 "mean_ms": round(total * 1000 / count, 3), "max_ms": round(longest * 1000, 3)}
+                for shape, (count, total, longest) in top
+            ],
+            "slow_queries": list(self.slow_queries),
+            "routes": {
+                route: {"requests": requests, "queries": queries, "queries_per_request": round(queries / requests, 2),
+                        "max_queries": most, "time_ms": round(seconds * 1000, 3)}
+                for route, (requests, queries, seconds, most) in sorted(self._routes.items())
+            },
+        }
+
+    def reset(self):
+        self.queries = self.errors = 0
+        self.time = 0.0
+        self._statements.clear()
+        self._routes.clear()
+        self.slow_queries.clear()
+
+
+query_stats = QueryStats()
+
+
+class QueryStatsMiddleware:
+    """
+    Count the queries of each HTTP request, by route (ASGI middleware: no
+    extra task per request).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request = RequestQueries(f"{scope['method']} {scope['path']}")
+        token = current_request.set(request)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_request.reset(token)
+            route = scope.get("route")
+            query_stats.finish_request(getattr(route, "path", None), request)
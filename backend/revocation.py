@@ -0,0 +1,80 @@
+import asyncio
+import os
+import time
+from typing import Callable, Dict, Optional
+
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.database import AsyncSessionLocal
+from backend.invalidation import GenerationBus, generations
+from backend.models import RevokedToken
+
+# Minimum seconds between two deletions of expired revocations
+REVOCATION_COMPACT_INTERVAL = float(os.environ.get("REVOCATION_COMPACT_INTERVAL", "3600"))
+
+
+class RevocationList:
+    """
+    Ids of revoked tokens ("jti") and logged-out sessions ("sid"), each kept
+    until the last token it covers expires. Every request checks it with a
+    dictionary lookup; the set is reloaded from revoked_tokens only when a
+    worker signals a revocation through the "tokens" generation.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], AsyncSession] = AsyncSessionLocal,
+        bus: GenerationBus = generations,
+    ):
+        self.session_factory = session_factory
+        self.bus = bus
+        self._generation = bus.watch("tokens")
+        self._revoked: Dict[str, int] = {}
+        self._compacted_at = 0.0
+        self._refresh_lock = asyncio.Lock()
+
+    async def load(self, db: AsyncSession):
+        generation = self._generation.current()
+        rows = (await db.execute(
+            select(RevokedToken.token_id, RevokedToken.expires_at).where(RevokedToken.expires_at > int(time.time()))
+        )).all()
+        self._revoked = dict(rows)
+        self._generation.mark(generation)
+
+    async def refresh(self):
+        async with self.session_factory() as db:
+            await self.load(db)
+
+    async def ensure_fresh(self):
+        if not self._generation.changed():
+            return
+        async with self._refresh_lock:
+            if self._generation.changed():
+                await self.refresh()
+
+    def is_revoked(self, *token_ids: Optional[str]) -> bool:
+        now = time.time()
+        return any(self._revoked.get(token_id, 0) > now for token_id in token_ids if token_id)
+
+    async def revoke(self, db: AsyncSession, token_id: str, expires_at: int):
+        """
+        Revoke a token or session id until expires_at (epoch seconds) and
+        commit, dropping revocations that have expired along the way.
+        """
+        if await db.get(RevokedToken, token_id) is None:
+            db.add(RevokedToken(token_id=token_id, expires_at=expires_at))
+        if time.monotonic() - self._compacted_at > REVOCATION_COMPACT_INTERVAL:
+            self._compacted_at = time.monotonic()
+            await db.execute(delete(RevokedToken).where(RevokedToken.expires_at <= int(time.time())))
+            now = time.time()
+            self._revoked = {key: expiry for key, expiry in self._revoked.items() if expiry > now}
+        await db.commit()
+        seen = self._generation.seen
+        self._revoked[token_id] = max(expires_at, self._revoked.get(token_id, 0))
+        generation = self.bus.bump("tokens")["tokens"]
+        if seen == generation - 1:
+            self._generation.mark(generation)  # nothing else changed
+
+
+revocation_list = RevocationList()
@@ -0,0 +1,131 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.cache import response_cache
+from backend.database import AsyncSessionLocal
+from backend.invalidation import GenerationBus, generations
+from backend.models import ProxyService
+from backend.upstream import upstream_clients
+
+# Optional safety net: seconds before the table is reloaded on its own
+# (0 = only reload when a worker signals a change through the generation bus)
+SERVICE_ROUTES_TTL = float(os.environ.get("SERVICE_ROUTES_TTL", "0"))
+
+
+def to_ws_url(base_url: str) -> str:
+    """
+    Convert http(s) base URL to ws(s).
+    """
+    if base_url.startswith("https://"):
+        return "wss://" + base_url[len("https://"):]
+    if base_url.startswith("http://"):
+        return "ws://" + base_url[len("http://"):]
+    return base_url
+
+
+@dataclass(frozen=True)
+class ServiceRoute:
+    name: str
+    base_url: str
+    enabled: bool
+    ws_url: str
+    proxy_prefix: str
+    max_body_size: Optional[int] = None
+    cache_enabled: bool = False
+    cache_ttl: Optional[int] = None
+    permission_id: Optional[int] = None
+
+    @classmethod
+    def from_model(cls, service: ProxyService) -> "ServiceRoute":
+        return cls(
+            name=service.name,
+            base_url=service.base_url,
+            enabled=bool(service.enabled),
+            ws_url=to_ws_url(service.base_url),
+            proxy_prefix=f"/api/proxy/{service.name}",
+            max_body_size=service.max_body_size,
+            cache_enabled=bool(service.cache_enabled),
+            cache_ttl=service.cache_ttl,
+            permission_id=service.permission_id,
+        )
+
+
+class RoutingTable:
+    """
+    In-process copy of the ProxyService table, so proxied requests and
+    websockets resolve their upstream without touching the database.
+
+    The whole table is swapped at once on reload, lookups never see a
+    half-built table. Changes made in other workers are noticed through the
+    "services" generation of the bus.
+    """
+
+    def __init__(
+        self,
+        ttl: float = SERVICE_ROUTES_TTL,
+        session_factory: Callable[[], AsyncSession] = AsyncSessionLocal,
+        bus: GenerationBus = generations,
+    ):
+        self.ttl = ttl
+        self.session_factory = session_factory
+        self._generation = bus.watch("services")
+        self._routes: Dict[str, ServiceRoute] = {}
+        self._loaded_at: Optional[float] = None
+        self._refresh_lock = asyncio.Lock()
+
+    async def load(self, db: AsyncSession):
+        """
+        (Re)build the table from the database. Connection pools of services
+        that were removed, disabled or re-targeted are drained, and their
+        cached responses dropped.
+        """
+        generation = self._generation.current()
+        services = (await db.execute(select(ProxyService))).scalars().all()
+        routes = {service.name: ServiceRoute.from_model(service) for service in services}
+        for name, old in self._routes.items():
+            new = routes.get(name)
+            if old.enabled and (new is None or not new.enabled or new.base_url != old.base_url):
+                upstream_clients.discard(name)
+            if old.cache_enabled and (new is None or not new.cache_enabled or new.base_url != old.base_url):
+                response_cache.purge(name)
+        self._routes = routes
+        self._loaded_at = time.monotonic()
+        self._generation.mark(generation)
+
+    async def refresh(self):
+        async with self.session_factory() as db:
+            await self.load(db)
+
+    def is_stale(self) -> bool:
+        if self._loaded_at is None or self._generation.changed():
+            return True
+        return bool(self.ttl) and time.monotonic() - self._loaded_at > self.ttl
+
+    async def ensure_fresh(self):
+        """
+        Reload the table if another worker changed a service, if it expired
+        or was never loaded. Concurrent callers wait for a single reload.
+        """
+        if not self.is_stale():
+            return
+        async with self._refresh_lock:
+            if self.is_stale():
+                await self.refresh()
+
+    def get(self, name: str) -> Optional[ServiceRoute]:
+        """
+        Return the route of an enabled service, or None.
+        """
+        route = self._routes.get(name)
+        if route is None or not route.enabled:
+            return None
+        return route
+
+
+routing_table = RoutingTable()
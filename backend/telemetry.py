@@ -0,0 +1,296 @@
+"""
+Prometheus metrics, kept per worker and summed over the workers of the
+host when scraped (GET /api/metrics).
+
+Updates are additions to dictionary entries from the event loop thread: no
+lock and no I/O on the request path. Every METRICS_FLUSH_INTERVAL seconds
+each worker writes its values to METRICS_DIR/<pid>.json; the worker
+answering a scrape adds the files of the other running workers to its own
+live values. Files of workers that exited are deleted, so totals drop when
+a worker is replaced, which Prometheus treats as a counter reset.
+"""
+import asyncio
+import bisect
+import json
+import math
+import os
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+METRICS_DIR = os.environ.get("METRICS_DIR", "./centralarr-metrics")
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "5"))
+
+# Seconds: proxied requests take from a few ms (cache hits) to minutes
+# (downloads)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+Labels = Tuple[str, ...]
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        function: Optional[Callable[[], Dict[Labels, float]]] = None,
+        per_worker: bool = False,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        # Settings every worker has alike (pool sizes): the workers' values
+        # are not summed, the largest is reported
+        self.per_worker = per_worker
+        self.values: Dict[Labels, object] = {}
+
+    def collect(self) -> Dict[Labels, object]:
+        # Metrics with a function read their values from it when collected
+        return self.function() if self.function is not None else self.values
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, labels: Labels = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, labels: Labels, value: float):
+        self.values[labels] = value
+
+    def inc(self, labels: Labels = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, labels: Labels = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels: Labels, value: float):
+        # Count per bucket (the last one is +Inf), then the sum
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+
+def add(total, value):
+    if total is None:
+        return list(value) if isinstance(value, list) else value
+    if isinstance(total, list):
+        return [a + b for a, b in zip(total, value)]
+    return total + value
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_value(value: float) -> str:
+    if isinstance(value, int) or (isinstance(value, float) and value.is_integer() and abs(value) < 1e15):
+        return str(int(value))
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Registry:
+    def __init__(self, directory: str = METRICS_DIR, flush_interval: float = METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.metrics: Dict[str, Metric] = {}
+        # Gauges computed from the merged values of all workers (ratios)
+        self.derived: List[Tuple[str, str, Sequence[str], Callable[[dict], Dict[Labels, float]]]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = (), function=None) -> Counter:
+        return self.register(Counter(name, help, labelnames, function))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = (), function=None, per_worker: bool = False) -> Gauge:
+        return self.register(Gauge(name, help, labelnames, function, per_worker))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def derive(self, name: str, help: str, labelnames: Sequence[str], function: Callable[[dict], Dict[Labels, float]]):
+        self.derived.append((name, help, tuple(labelnames), function))
+
+    # Workers
+
+    def snapshot(self) -> Dict[str, list]:
+        return {name: [[list(labels), value] for labels, value in metric.collect().items()] for name, metric in self.metrics.items()}
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, f"{os.getpid()}.json")
+
+    def _write(self, data: str):
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as f:
+            f.write(data)
+        os.replace(temporary, self.path)
+
+    async def flush(self):
+        # Values are read on the event loop, the file written in a thread
+        await run_in_threadpool(self._write, json.dumps(self.snapshot()))
+
+    def other_workers(self) -> List[Dict[str, list]]:
+        snapshots = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return snapshots
+        for name in names:
+            pid, extension = os.path.splitext(name)
+            if extension != ".json" or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            path = os.path.join(self.directory, name)
+            if not is_running(int(pid)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # being replaced
+        return snapshots
+
+    def merged(self, others: Sequence[Dict[str, list]] = ()) -> Dict[str, Dict[Labels, object]]:
+        """
+        Values of this worker plus those of the other snapshots, by metric
+        (the largest one for per-worker settings).
+        """
+        merged = {}
+        for snapshot in [self.snapshot(), *others]:
+            for name, samples in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue  # from another version of the app
+                values = merged.setdefault(name, {})
+                for labels, value in samples:
+                    labels = tuple(labels)
+                    if metric.per_worker:
+                        values[labels] = max(values.get(labels, value), value)
+                    else:
+                        values[labels] = add(values.get(labels), value)
+        return merged
+
+    def render(self, merged: Dict[str, Dict[Labels, object]]) -> str:
+        """
+        The text exposition format of Prometheus.
+        """
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for labels, value in sorted(merged.get(name, {}).items()):
+                if isinstance(metric, Histogram):
+                    cumulative = 0
+                    for bound, count in zip((*metric.buckets, math.inf), value):
+                        cumulative += count
+                        le = "+Inf" if bound == math.inf else format_value(bound)
+                        bucket = format_labels(metric.labelnames, labels, f'le="{le}"')
+                        lines.append(f"{name}_bucket{bucket} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(metric.labelnames, labels)} {format_value(value[-1])}")
+                    lines.append(f"{name}_count{format_labels(metric.labelnames, labels)} {cumulative}")
+                else:
+                    lines.append(f"{name}{format_labels(metric.labelnames, labels)} {format_value(value)}")
+        for name, help, labelnames, function in self.derived:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in sorted(function(merged).items()):
+                lines.append(f"{name}{format_labels(labelnames, labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    async def exposition(self) -> str:
+        others = await run_in_threadpool(self.other_workers)
+        return self.render(self.merged(others))
+
+    # Background flushes
+
+    async def _run(self):
+        while True:
+            try:
+                await self.flush()
+            except OSError:
+                pass  # the next flush will tell
+            await asyncio.sleep(self.flush_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """
+        Stop flushing and forget this worker's file: its values go away
+        with it.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+registry = Registry()
+
+# Proxy
+
+proxy_requests = registry.counter(
+    "centralarr_proxy_requests_total", "Proxied HTTP requests, by service and response status", ("service", "code")
+)
+proxy_time_to_first_byte = registry.histogram(
+    "centralarr_proxy_time_to_first_byte_seconds",
+    "Seconds until the response headers of a proxied request are ready (from the cache or the upstream)",
+    ("service",),
+)
+proxy_duration = registry.histogram(
+    "centralarr_proxy_duration_seconds", "Seconds until the whole response of a proxied request is sent", ("service",)
+)
+proxy_bytes = registry.counter(
+    "centralarr_proxy_bytes_total",
+    "Body bytes of proxied requests, received from clients (in) and sent to them (out)",
+    ("service", "direction"),
+)
+websocket_relays = registry.gauge("centralarr_proxy_websocket_relays", "WebSocket connections being relayed", ("service",))
+websocket_relays_total = registry.counter(
+    "centralarr_proxy_websocket_relays_total", "WebSocket connections relayed since start", ("service",)
+)
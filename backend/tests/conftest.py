@@ -1,13 +1,30 @@
+import os
+import shutil
+import subprocess
+import tempfile
+from contextlib import contextmanager
 import pytest
+
+# Keep the app's database (migrated at startup), the cross-worker generation
+# file and the metrics out of the working tree
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "centralarr.db"))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.environ['DB_PATH']}")
+os.environ.setdefault("CACHE_GENERATIONS_PATH", os.path.join(tempfile.mkdtemp(), "centralarr.generations"))
+os.environ.setdefault("METRICS_DIR", tempfile.mkdtemp())
+
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 
 from backend.main import app
-from backend.database import Base, get_db, SessionLocal
+from backend.database import ASYNC_DRIVERS, Base, database_url, get_db, make_engine, SessionLocal
 
-# Use an in-memory SQLite database for tests
-SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
+# Use a throwaway SQLite database for tests
+TEST_DATABASE_PATH = os.path.join(tempfile.mkdtemp(), "test.db")
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{TEST_DATABASE_PATH}"
 
 # Create engine and session factory for testing
 engine = create_engine(
@@ -15,13 +32,68 @@ engine = create_engine(
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# The app's side of the same database (NullPool: no connection outlives
+# the event loop of a TestClient)
+async_engine = create_async_engine(f"sqlite+aiosqlite:///{TEST_DATABASE_PATH}", poolclass=NullPool)
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 # Override the get_db dependency in FastAPI app to use test DB session
-def override_get_db():
-    session = TestingSessionLocal()
-    try:
+async def override_get_db():
+    async with TestingAsyncSessionLocal() as session:
         yield session
-    finally:
-        session.close()
+
+# PostgreSQL for the tests: TEST_POSTGRES_URL, or a throwaway cluster when
+# initdb and pg_ctl are on the PATH. Its tests are skipped otherwise.
+TEST_POSTGRES_URL = os.environ.get("TEST_POSTGRES_URL")
+
+@pytest.fixture(scope="session")
+def postgres_url(tmp_path_factory):
+    pytest.importorskip("psycopg")
+    if TEST_POSTGRES_URL:
+        yield TEST_POSTGRES_URL
+        return
+    initdb, pg_ctl = shutil.which("initdb"), shutil.which("pg_ctl")
+    if not (initdb and pg_ctl) or os.geteuid() == 0:
+        pytest.skip("no PostgreSQL server available")
+    data = tmp_path_factory.mktemp("pgdata")
+    subprocess.run([initdb, "-D", data, "-U", "postgres", "--auth=trust"], check=True, capture_output=True)
+    subprocess.run(
+        [pg_ctl, "-D", data, "-o", f"-k {data} -c listen_addresses=''", "-w", "start"],
+        check=True, capture_output=True,
+    )
+    yield f"postgresql://postgres@/postgres?host={data}"
+    subprocess.run([pg_ctl, "-D", data, "-m", "immediate", "stop"], capture_output=True)
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def test_database_url(request, tmp_path):
+    """
+    URL of an empty database, once per backend.
+    """
+    if request.param == "sqlite":
+        return f"sqlite:///{tmp_path / 'centralarr.db'}"
+    url = request.getfixturevalue("postgres_url")
+    from backend.migrations import schema_migrations
+    sync_engine = make_engine(url)
+    with sync_engine.begin() as connection:
+        Base.metadata.drop_all(connection)
+        schema_migrations.drop(connection, checkfirst=True)
+    sync_engine.dispose()
+    return url
+
+@pytest.fixture()
+def test_database(test_database_url):
+    """
+    Fresh schema for one test: a blocking session factory to seed it and
+    an async one for the app.
+    """
+    sync_engine = make_engine(test_database_url)
+    Base.metadata.create_all(bind=sync_engine)
+    async_engine = create_async_engine(database_url(test_database_url, ASYNC_DRIVERS), poolclass=NullPool)
+    yield (
+        sessionmaker(bind=sync_engine, expire_on_commit=False),
+        async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False),
+    )
+    sync_engine.dispose()
 
 @pytest.fixture(scope="session")
 def db_engine():
@@ -56,4 +128,72 @@ def client():
     app.dependency_overrides[get_db] = override_get_db
     with TestClient(app) as c:
         yield c
-    app.dependency_overrides.clear()
\ No newline at end of file
+    app.dependency_overrides.clear()
+
+
+@contextmanager
+def max_queries(limit: int):
+    """
+    Fail if the block runs more than limit SQL statements, on any engine.
+    Yields the list of statements run so far.
+    """
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(Engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, "before_cursor_execute", record)
+    assert len(statements) <= limit, f"{len(statements)} queries, expected at most {limit}:\n" + "\n".join(statements)
+
+@pytest.fixture()
+def assert_max_queries():
+    """
+    max_queries(), for tests: with assert_max_queries(3): client.get(...)
+    """
+    return max_queries
+
+@pytest.fixture()
+def api(test_database, monkeypatch):
+    """
+    Client of the app running on test_database, with an admin user
+    (admin / adminpass). Yields (client, blocking session factory).
+    """
+    from passlib.context import CryptContext
+    from backend.bulk import BulkTransfer
+    from backend.models import Group, User
+    from backend.permissions import PermissionIndex
+    from backend.principals import PrincipalCache
+    from backend.revocation import RevocationList
+    from backend.routing import RoutingTable
+
+    SyncSession, AsyncSession = test_database
+    with SyncSession() as session:
+        admin = User(username="admin", email="admin@example.com",
+                     password_hash=CryptContext(schemes=["bcrypt"]).hash("adminpass"))
+        admin.groups.append(Group(name="admin"))
+        session.add(admin)
+        session.commit()
+
+    async def get_test_db():
+        async with AsyncSession() as session:
+            yield session
+
+    table = RoutingTable(session_factory=AsyncSession)
+    monkeypatch.setattr("backend.proxy.routing_table", table)
+    monkeypatch.setattr("backend.crud.routing_table", table)
+    monkeypatch.setattr("backend.auth.principal_cache", PrincipalCache())
+    monkeypatch.setattr("backend.auth.revocation_list", RevocationList(session_factory=AsyncSession))
+    index = PermissionIndex(session_factory=AsyncSession)
+    monkeypatch.setattr("backend.proxy.permission_index", index)
+    monkeypatch.setattr("backend.crud.permission_index", index)
+    monkeypatch.setattr("backend.crud.bulk_transfer", BulkTransfer(session_factory=AsyncSession))
+    app.dependency_overrides[get_db] = get_test_db
+    with TestClient(app) as c:
+        token = c.post("/api/auth/token", data={"username": "admin", "password": "adminpass"}).json()["access_token"]
+        c.headers["Authorization"] = f"Bearer {token}"
+        yield c, SyncSession
+    app.dependency_overrides.clear()
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import pytest
+from sqlalchemy import func, select
+import backend.crud
+from backend.bulk import BulkTransfer, main, parse_rows
+from backend.models import Group, Permission, User
+
+USERS = 5000
+
+def ndjson(rows):
+    return "".join(json.dumps(row) + "\n" for row in rows)
+
+async def body(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+async def collect(rows):
+    return [row async for row in rows]
+
+@pytest.mark.asyncio
+async def test_csv_records_across_lines_and_chunks():
+    rows = await collect(parse_rows("csv", body(
+        b'\xef\xbb\xbfname,descrip', b'tion\r\nmedia,"Jellyfin, ', b'and\n""Navidrome"""\n', b'\nempty,\nbroken\n"open'
+    )))
+    assert rows[0] == (2, {"name": "media", "description": 'Jellyfin, and\n"Navidrome"'})
+    assert rows[1] == (5, {"name": "empty"})
+    assert [(line, str(error)) for line, error in rows[2:]] == [(6, "Expected 2 cells"), (7, "Unterminated quoted cell")]
+
+def test_import_and_export_users(api):
+    client, Session = api
+    users = [{"username": f"user{i}", "email": f"user{i}@example.com", "password_hash": f"hash{i}"} for i in range(USERS)]
+    report = client.post("/api/crud/bulk/users", content=ndjson(users)).json()
+    assert report == {"rows": USERS, "created": USERS, "updated": 0, "linked": 0, "unlinked": 0, "failed": 0, "errors": []}
+
+    users[7]["email"] = "seven@example.com"
+    assert client.post("/api/crud/bulk/users", content=ndjson(users[:10])).json()["updated"] == 10
+    with Session() as session:
+        assert session.scalar(select(func.count()).select_from(User)) == USERS + 1
+        assert session.scalar(select(User.email).where(User.username == "user7")) == "seven@example.com"
+
+    resp = client.get("/api/crud/bulk/users", params={"include_password_hashes": True})
+    assert resp.headers["content-type"].startswith("application/x-ndjson")
+    exported = [json.loads(line) for line in resp.text.splitlines()]
+    assert exported[1:] == users
+    assert exported[0] == {"username": "admin", "email": "admin@example.com", "password_hash": exported[0]["password_hash"]}
+    assert "password_hash" not in client.get("/api/crud/bulk/users").text
+
+def test_memberships_in_csv(api):
+    client, Session = api
+    client.post("/api/crud/bulk/users", content=ndjson({"username": f"u{i}", "email": f"u{i}@example.com"} for i in range(30)))
+    csv_headers = {"Content-Type": "text/csv"}
+    assert client.post("/api/crud/bulk/groups", content="name\nfamily\nguests\n", headers=csv_headers).json()["created"] == 2
+    assert client.post("/api/crud/bulk/permissions", content="name,description\njellyfin,Movies\n", headers=csv_headers).json()["created"] == 1
+
+    memberships = "user,group\n" + "".join(f"u{i},{'family' if i < 10 else 'guests'}\n" for i in range(30))
+    assert client.post("/api/crud/bulk/user_groups", content=memberships, headers=csv_headers).json()["linked"] == 30
+    assert client.post("/api/crud/bulk/group_permissions", content=ndjson([{"group": "family", "permission": "jellyfin"}])).json()["linked"] == 1
+
+    # The permission index of the worker rebuilds after bulk changes
+    with Session() as session:
+        user_ids = dict(session.execute(select(User.username, User.id)).all())
+        permission_id = session.scalar(select(Permission.id))
+    asyncio.run(backend.crud.permission_index.ensure_fresh())
+    assert backend.crud.permission_index.allows(user_ids["u3"], permission_id)
+    assert not backend.crud.permission_index.allows(user_ids["u13"], permission_id)
+
+    moves = "user,group,op\nu3,family,remove\nu3,guests,\nu3,guests,add\n"
+    report = client.post("/api/crud/bulk/user_groups", content=moves, headers=csv_headers).json()
+    assert (report["linked"], report["unlinked"]) == (1, 1)
+    asyncio.run(backend.crud.permission_index.ensure_fresh())
+    assert not backend.crud.permission_index.allows(user_ids["u3"], permission_id)
+
+    exported = client.get("/api/crud/bulk/user_groups", params={"format": "csv"}).text.splitlines()
+    assert exported[0] == "user,group"
+    assert "u3,guests" in exported and "u3,family" not in exported
+    assert len(exported) == 1 + 30 + 1  # with admin,admin
+
+def test_invalid_rows_are_reported(api):
+    client, Session = api
+    rows = "\n".join([
+        json.dumps({"username": "alice", "email": "alice@example.com"}),
+        json.dumps({"username": "bob"}),
+        "not json",
+        json.dumps({"username": "carol", "email": "admin@example.com"}),  # taken
+        json.dumps({"username": "dave", "email": 42}),
+        json.dumps({"username": "erin", "email": "erin@example.com"}),
+    ])
+    report = client.post("/api/crud/bulk/users", content=rows).json()
+    assert report["created"] == 2 and report["failed"] == 4
+    assert [error["line"] for error in report["errors"]] == [2, 3, 4, 5]
+    with Session() as session:
+        assert set(session.scalars(select(User.username))) == {"admin", "alice", "erin"}
+
+    report = client.post("/api/crud/bulk/user_groups", content=ndjson([
+        {"user": "alice", "group": "admin"}, {"user": "nobody", "group": "admin"}, {"user": "erin", "group": "admin", "op": "move"},
+    ])).json()
+    assert report["linked"] == 1
+    assert [error["error"] for error in report["errors"]] == ["Unknown user nobody", "op must be add or remove"]
+
+    assert client.post("/api/crud/bulk/tokens", content="").status_code == 404
+    assert client.post("/api/crud/bulk/users", params={"format": "xml"}, content="").status_code == 400
+
+def test_command_line(test_database, tmp_path, monkeypatch, capsys):
+    SyncSession, AsyncSession = test_database
+    monkeypatch.setattr("backend.bulk.bulk_transfer", BulkTransfer(session_factory=AsyncSession, chunk_rows=7))
+    monkeypatch.setattr("backend.migrations.upgrade", lambda: [])
+    path = tmp_path / "groups.csv"
+    path.write_text("name\n" + "".join(f"group{i:02d}\n" for i in range(20)))
+    assert asyncio.run(main(["import", "groups", str(path)])) == 0
+    assert json.loads(capsys.readouterr().out)["created"] == 20
+    assert asyncio.run(main(["export", "groups", "--format", "csv"])) == 0
+    assert capsys.readouterr().out.splitlines() == ["name"] + [f"group{i:02d}" for i in range(20)]
+    with SyncSession() as session:
+        assert session.scalar(select(func.count()).select_from(Group)) == 20
@@ -0,0 +1,182 @@
+import asyncio
+import threading
+import time
+import httpx
+import pytest
+from backend.cache import (
+    CacheEntry,
+    DiskTier,
+    MemoryTier,
+    ResponseCache,
+    cache_key,
+    freshness_lifetime,
+    request_cache_policy,
+    storable_lifetime,
+)
+
+def entry(key, body=b"x" * 100, lifetime=60, **kwargs):
+    now = time.time()
+    return CacheEntry(key=key, status_code=200, headers=[("content-type", "image/png")], body=body,
+                      date=now, expires_at=now + lifetime, **kwargs)
+
+def test_freshness_lifetime_precedence():
+    assert freshness_lifetime(httpx.Headers({"cache-control": "max-age=10, s-maxage=20"}), None) == 20
+    assert freshness_lifetime(httpx.Headers({"cache-control": "max-age=10"}), 300) == 10
+    assert freshness_lifetime(httpx.Headers({"cache-control": "no-cache, max-age=10"}), 300) == 0
+    assert freshness_lifetime(httpx.Headers({
+        "date": "Mon, 01 Jan 2024 00:00:00 GMT", "expires": "Mon, 01 Jan 2024 00:05:00 GMT",
+    }), None) == 300
+    # The service TTL only applies without explicit freshness
+    assert freshness_lifetime(httpx.Headers({}), 300) == 300
+
+def test_storable_responses():
+    public = httpx.Headers({"cache-control": "max-age=60"})
+    assert storable_lifetime(httpx.Headers({}), 200, public, None) == 60
+    assert storable_lifetime(httpx.Headers({}), 500, public, None) is None
+    assert storable_lifetime(httpx.Headers({}), 200, httpx.Headers({"cache-control": "no-store"}), 60) is None
+    assert storable_lifetime(httpx.Headers({}), 200, httpx.Headers({"cache-control": "private, max-age=60"}), None) is None
+    assert storable_lifetime(httpx.Headers({}), 200, httpx.Headers({"vary": "*", "cache-control": "max-age=60"}), None) is None
+    assert storable_lifetime(httpx.Headers({}), 200, httpx.Headers({"set-cookie": "a=1", "cache-control": "max-age=60"}), None) is None
+    # Authorization: only explicitly shareable responses
+    auth = httpx.Headers({"authorization": "Bearer x"})
+    assert storable_lifetime(auth, 200, public, None) is None
+    assert storable_lifetime(auth, 200, httpx.Headers({"cache-control": "public, max-age=60"}), None) == 60
+    # Cookies too, and the service TTL never makes them shareable
+    cookie = httpx.Headers({"cookie": "session=alice"})
+    assert storable_lifetime(cookie, 200, httpx.Headers({}), 300) is None
+    assert storable_lifetime(cookie, 200, httpx.Headers({"cache-control": "must-revalidate, max-age=60"}), 300) is None
+    assert storable_lifetime(cookie, 200, httpx.Headers({"cache-control": "public"}), 300) is None
+    assert storable_lifetime(cookie, 200, httpx.Headers({"cache-control": "s-maxage=60"}), 300) == 60
+
+def test_request_cache_policy():
+    assert request_cache_policy("GET", httpx.Headers({})) == (True, True)
+    assert request_cache_policy("POST", httpx.Headers({})) == (False, False)
+    assert request_cache_policy("GET", httpx.Headers({"range": "bytes=0-"})) == (False, False)
+    assert request_cache_policy("GET", httpx.Headers({"cache-control": "no-store"})) == (False, False)
+    assert request_cache_policy("GET", httpx.Headers({"cache-control": "no-cache"})) == (False, True)
+
+def test_memory_tier_evicts_least_recently_used_by_bytes():
+    first, second, third = (entry(cache_key("svc", f"/{i}", "")) for i in range(3))
+    tier = MemoryTier(max_bytes=first.size * 2)
+    tier.put(first)
+    tier.put(second)
+    tier.get(first.key)  # first is now the most recent
+    assert tier.put(third) == 1
+    assert tier.get(second.key) is None
+    assert tier.get(first.key) is first
+    assert tier.bytes == first.size + third.size
+
+def test_memory_tier_purges_one_service():
+    tier = MemoryTier(max_bytes=10 ** 6)
+    tier.put(entry(cache_key("jellyfin", "/a", "")))
+    tier.put(entry(cache_key("navidrome", "/a", "")))
+    tier.purge("jellyfin")
+    assert len(tier) == 1 and tier.bytes == entry(cache_key("navidrome", "/a", "")).size
+
+def test_vary_selects_matching_variant():
+    stored = entry("k", vary={"accept-encoding": "gzip"})
+    assert stored.matches(httpx.Headers({"accept-encoding": "gzip"}))
+    assert not stored.matches(httpx.Headers({"accept-encoding": "br"}))
+
+def test_disk_tier_roundtrip_and_bound(tmp_path):
+    tier = DiskTier(str(tmp_path), max_bytes=10 ** 6)
+    stored = entry(cache_key("jellyfin", "/poster", "tag=1"), body=b"\x00\xff" * 1000)
+    tier.put(stored)
+    loaded = tier.get(stored.key)
+    assert loaded == stored
+
+    # A new worker rebuilds its index from the files
+    assert DiskTier(str(tmp_path), max_bytes=10 ** 6).bytes == tier.bytes
+
+    small = DiskTier(str(tmp_path), max_bytes=tier.bytes)
+    assert small.put(entry(cache_key("jellyfin", "/other", ""), body=b"y" * 1000)) == 1
+    assert small.get(stored.key) is None
+
+def test_disk_tier_is_indexed_off_the_event_loop(tmp_path, monkeypatch):
+    threads = []
+
+    class RecordingTier(DiskTier):
+        def __init__(self, *args):
+            threads.append(threading.current_thread())
+            super().__init__(*args)
+    monkeypatch.setattr("backend.cache.DiskTier", RecordingTier)
+
+    async def scenario():
+        cache = ResponseCache(max_bytes=10 ** 6, directory=str(tmp_path))
+        assert cache.disk is None
+        # Concurrent first lookups share one build
+        await asyncio.gather(*(cache.lookup(cache_key("jellyfin", "/poster", ""), httpx.Headers({})) for _ in range(5)))
+        assert isinstance(cache.disk, RecordingTier)
+        assert await cache.open_disk() is cache.disk
+
+    asyncio.run(scenario())
+    assert len(threads) == 1 and threads[0] is not threading.main_thread()
+
+def test_response_cache_counters_and_disk_promotion(tmp_path):
+    async def scenario():
+        cache = ResponseCache(max_bytes=10 ** 6, directory=str(tmp_path))
+        key = cache_key("jellyfin", "/poster", "")
+        assert await cache.lookup(key, httpx.Headers({})) is None
+        await cache.put(entry(key))
+
+        # Memory tier lost (e.g. restart): served from disk and promoted
+        cache.memory = MemoryTier(10 ** 6)
+        assert (await cache.lookup(key, httpx.Headers({}))).body == b"x" * 100
+        assert len(cache.memory) == 1
+        return cache.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["misses"] == 1 and stats["hits"] == 1 and stats["disk_hits"] == 1
+    assert stats["stores"] == 1
+    assert stats["hit_ratio"] == 0.5
+
+def test_validator_only_responses_are_stored_stale():
+    etag_only = httpx.Headers({"cache-control": "no-cache", "etag": '"v1"'})
+    assert storable_lifetime(httpx.Headers({}), 200, etag_only, None) == 0
+    assert storable_lifetime(httpx.Headers({}), 200, httpx.Headers({"cache-control": "no-cache"}), None) is None
+
+def test_conditional_requests_match_entry():
+    stored = entry("k")
+    stored.headers += [("ETag", 'W/"v1"'), ("Last-Modified", "Mon, 01 Jan 2024 00:00:00 GMT")]
+    assert stored.validators() == {"If-None-Match": 'W/"v1"', "If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT"}
+    assert stored.not_modified(httpx.Headers({"if-none-match": '"v0", "v1"'}))
+    assert stored.not_modified(httpx.Headers({"if-none-match": "*"}))
+    assert not stored.not_modified(httpx.Headers({"if-none-match": '"v2"'}))
+    assert stored.not_modified(httpx.Headers({"if-modified-since": "Tue, 02 Jan 2024 00:00:00 GMT"}))
+    assert not stored.not_modified(httpx.Headers({"if-modified-since": "Sun, 31 Dec 2023 00:00:00 GMT"}))
+    # If-None-Match takes precedence over If-Modified-Since
+    assert not stored.not_modified(httpx.Headers({
+        "if-none-match": '"v2"', "if-modified-since": "Tue, 02 Jan 2024 00:00:00 GMT",
+    }))
+
+def test_refreshed_entry_takes_304_headers():
+    stale = entry("k", lifetime=-10)
+    stale.headers += [("Cache-Control", "max-age=60"), ("ETag", '"v1"')]
+    fresh = stale.refreshed(httpx.Headers({"cache-control": "max-age=120", "etag": '"v1"'}), None)
+    assert fresh.is_fresh() and not stale.is_fresh()
+    assert 119 <= fresh.expires_at - time.time() <= 120
+    assert fresh.header("cache-control") == "max-age=120"
+    assert fresh.header("content-type") == "image/png"
+    assert fresh.body == stale.body
+
+def test_concurrent_revalidations_share_one_fetch():
+    async def scenario():
+        cache = ResponseCache(max_bytes=10 ** 6)
+        stale = entry("k", lifetime=-10)
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return stale.refreshed(httpx.Headers({"cache-control": "max-age=60"}), None)
+
+        results = await asyncio.gather(*(cache.revalidate(stale, fetch) for _ in range(20)))
+        # The next stale hit revalidates again
+        await cache.revalidate(stale, fetch)
+        return cache, calls, results
+
+    cache, calls, results = asyncio.run(scenario())
+    assert len(calls) == 2
+    assert all(result is results[0] for result in results)
+    assert cache.counters["revalidations"] == 2
+    assert cache.counters["collapsed_revalidations"] == 19
@@ -0,0 +1,94 @@
+import asyncio
+import httpx
+import pytest
+from backend.coalescing import RequestCoalescer, coalesce_key, is_coalescable
+
+def response(body=b"data", headers=None):
+    async def chunks():
+        for i in range(0, len(body), 2):
+            await asyncio.sleep(0)
+            yield body[i:i + 2]
+    headers = {"Content-Length": str(len(body)), **(headers or {})}
+    return httpx.Response(200, headers=headers, content=chunks())
+
+def never_rewritten(resp):
+    return False
+
+async def read(coalescer, key, send, rewritten=never_rewritten):
+    resp, flight = await coalescer.send(key, send, rewritten)
+    if flight is None:
+        return resp, b"".join([chunk async for chunk in resp.aiter_raw()])
+    return resp, b"".join([chunk async for chunk in flight.stream()])
+
+def test_key_depends_on_identity_and_negotiation():
+    base = coalesce_key("jellyfin", "/Items", "Limit=5", httpx.Headers({"authorization": "a"}))
+    assert base == coalesce_key("jellyfin", "Items", "Limit=5", httpx.Headers({"authorization": "a", "user-agent": "tv"}))
+    assert base != coalesce_key("jellyfin", "/Items", "Limit=5", httpx.Headers({"authorization": "b"}))
+    assert base != coalesce_key("jellyfin", "/Items", "Limit=5", httpx.Headers({"authorization": "a", "accept-encoding": "br"}))
+    assert base != coalesce_key("jellyfin", "/Items", "Limit=6", httpx.Headers({"authorization": "a"}))
+
+def test_only_plain_gets_are_coalesced():
+    assert is_coalescable("GET", httpx.Headers({}))
+    assert not is_coalescable("POST", httpx.Headers({}))
+    assert not is_coalescable("GET", httpx.Headers({"range": "bytes=0-"}))
+    assert not is_coalescable("GET", httpx.Headers({"content-length": "3"}))
+
+@pytest.mark.asyncio
+async def test_waiters_share_the_body_and_late_waiters_start_a_new_flight():
+    coalescer = RequestCoalescer(max_bytes=1024)
+    calls = []
+
+    async def send():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return response(b"0123456789")
+
+    results = await asyncio.gather(*(read(coalescer, "k", send) for _ in range(5)))
+    assert [body for _, body in results] == [b"0123456789"] * 5
+    await read(coalescer, "k", send)
+    assert len(calls) == 2
+    assert coalescer.stats() == {"flights": 2, "coalesced": 4, "fallbacks": 0, "in_flight": 0, "max_bytes": 1024}
+
+@pytest.mark.asyncio
+async def test_large_or_rewritten_responses_are_not_shared():
+    coalescer = RequestCoalescer(max_bytes=4)
+    calls = []
+
+    async def send():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return response(b"0123456789")
+
+    results = await asyncio.gather(*(read(coalescer, "k", send) for _ in range(3)))
+    assert [body for _, body in results] == [b"0123456789"] * 3
+    assert len(calls) == 3
+    assert coalescer.counters["fallbacks"] == 2
+
+@pytest.mark.asyncio
+async def test_upstream_errors_reach_every_waiter():
+    coalescer = RequestCoalescer()
+    calls = []
+
+    async def send():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise httpx.ConnectError("refused")
+
+    results = await asyncio.gather(*(read(coalescer, "k", send) for _ in range(3)), return_exceptions=True)
+    assert all(isinstance(result, httpx.ConnectError) for result in results)
+    assert len(calls) == 1
+
+@pytest.mark.asyncio
+async def test_a_waiter_leaving_does_not_cancel_the_flight():
+    coalescer = RequestCoalescer()
+
+    async def send():
+        await asyncio.sleep(0.01)
+        return response(b"0123456789")
+
+    leader = asyncio.ensure_future(read(coalescer, "k", send))
+    follower = asyncio.ensure_future(read(coalescer, "k", send))
+    await asyncio.sleep(0)
+    leader.cancel()
+    _, body = await follower
+    assert body == b"0123456789"
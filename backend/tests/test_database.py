@@ -0,0 +1,44 @@
+from sqlalchemy import select
+from backend.models import Group, User
+
+def test_login_and_me_run_on_the_async_session(api):
+    client, _ = api
+    resp = client.get("/api/auth/me")
+    assert resp.status_code == 200
+    assert resp.json()["username"] == "admin"
+
+def test_register_user(api):
+    client, Session = api
+    resp = client.post("/api/auth/register", json={"username": "alice", "email": "alice@example.com", "password": "pw"})
+    assert resp.status_code == 200
+    assert client.post("/api/auth/register", json={"username": "alice", "password": "pw"}).status_code == 400
+    with Session() as session:
+        assert session.scalars(select(User.email).where(User.username == "alice")).one() == "alice@example.com"
+
+def test_crud_roundtrip(api):
+    client, Session = api
+    group_id = client.post("/api/crud/groups", params={"name": "family"}).json()["id"]
+    assert {"id": group_id, "name": "family"} in client.get("/api/crud/groups").json()
+    assert client.put(f"/api/crud/groups/{group_id}", params={"name": "friends"}).status_code == 200
+    assert client.delete(f"/api/crud/groups/{group_id}").status_code == 200
+    assert client.delete(f"/api/crud/groups/{group_id}").status_code == 404
+
+def test_deleting_a_user_removes_its_memberships(api):
+    client, Session = api
+    with Session() as session:
+        user = User(username="bob", email="bob@example.com")
+        user.groups.append(Group(name="kids"))
+        session.add(user)
+        session.commit()
+        user_id = user.id
+    assert client.delete(f"/api/crud/users/{user_id}").status_code == 200
+    with Session() as session:
+        assert session.get(User, user_id) is None
+        assert session.scalars(select(Group).where(Group.name == "kids")).one().users == []
+
+def test_proxy_changes_reach_the_routing_table(api):
+    client, _ = api
+    proxy_id = client.post("/api/crud/proxys", params={"name": "jellyfin", "base_url": "http://jellyfin.lan"}).json()["id"]
+    assert [p["name"] for p in client.get("/api/crud/proxys").json()] == ["jellyfin"]
+    client.put(f"/api/crud/proxys/{proxy_id}", params={"enabled": False})
+    assert client.get("/api/proxy/jellyfin/").status_code == 404
@@ -0,0 +1,71 @@
+import multiprocessing
+import pytest
+from backend.invalidation import GenerationBus
+from backend.models import ProxyService
+from backend.routing import RoutingTable
+
+@pytest.fixture()
+def bus_path(tmp_path):
+    return str(tmp_path / "centralarr.generations")
+
+def bump_in_other_process(path, entity, times):
+    bus = GenerationBus(path)
+    for _ in range(times):
+        bus.bump(entity)
+
+def test_generations_start_at_zero_and_increase(bus_path):
+    bus = GenerationBus(bus_path)
+    assert bus.current("services") == 0
+    bus.bump("services")
+    bus.bump("services", "users")
+    assert bus.current("services") == 2
+    assert bus.current("users") == 1
+    assert bus.current("groups") == 0
+
+def test_bumps_are_seen_by_other_workers(bus_path):
+    bus = GenerationBus(bus_path)
+    watcher = bus.watch("users")
+    watcher.mark(watcher.current())
+
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=bump_in_other_process, args=(bus_path, "users", 50)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert watcher.changed()
+    # No bump is lost between concurrent writers
+    assert bus.current("users") == 200
+    # Other entity types are untouched
+    assert bus.current("services") == 0
+
+def test_watcher_reports_change_once_marked(bus_path):
+    watcher = GenerationBus(bus_path).watch("groups")
+    assert watcher.changed()  # never loaded
+    watcher.mark(watcher.current())
+    assert not watcher.changed()
+    GenerationBus(bus_path).bump("groups")
+    assert watcher.changed()
+
+@pytest.mark.asyncio
+async def test_routing_table_reloads_after_change_in_other_worker(bus_path, test_database):
+    SyncSession, AsyncSession = test_database
+    with SyncSession() as session:
+        session.add(ProxyService(name="radarr", base_url="http://radarr.lan", enabled=True))
+        session.commit()
+
+    table = RoutingTable(session_factory=AsyncSession, bus=GenerationBus(bus_path))
+    await table.refresh()
+    assert not table.is_stale()
+
+    # Another worker edits the service and signals it
+    with SyncSession() as session:
+        session.query(ProxyService).filter_by(name="radarr").update({"base_url": "http://radarr2.lan"})
+        session.commit()
+    GenerationBus(bus_path).bump("services")
+
+    assert table.is_stale()
+    await table.ensure_fresh()
+    assert table.get("radarr").base_url == "http://radarr2.lan"
+    assert not table.is_stale()
@@ -0,0 +1,78 @@
+import asyncio
+import pytest
+from sqlalchemy import insert
+from backend.models import Group, Permission, User, group_permissions, user_groups, user_permissions
+from backend.principals import load_principal
+
+USERS = 300
+GROUPS = 12
+
+@pytest.fixture()
+def memberships(api):
+    """
+    Users in one or two groups, with a permission of their own for some.
+    """
+    client, Session = api
+    with Session() as session:
+        session.execute(insert(User), [{"id": 100 + i, "username": f"user{i}", "email": f"user{i}@example.com"} for i in range(USERS)])
+        session.execute(insert(Group), [{"id": 100 + g, "name": f"group{g}"} for g in range(GROUPS)])
+        session.execute(insert(Permission), [{"id": 100 + p, "name": f"service{p}"} for p in range(GROUPS)])
+        session.execute(insert(user_groups), [
+            {"user_id": 100 + i, "group_id": 100 + g} for i in range(USERS) for g in {i % GROUPS, i % 5}
+        ])
+        session.execute(insert(group_permissions), [{"group_id": 100 + g, "permission_id": 100 + g} for g in range(GROUPS)])
+        session.execute(insert(user_permissions), [{"user_id": 100 + i, "permission_id": 100} for i in range(0, USERS, 3)])
+        session.commit()
+    client.get("/api/crud/users", params={"limit": 1})  # the principal of the admin is cached
+    return client, Session
+
+def test_users_with_their_groups_in_constant_queries(memberships, assert_max_queries):
+    client, _ = memberships
+    for limit in (10, 1000):
+        with assert_max_queries(3):
+            users = client.get("/api/crud/users", params={"limit": limit, "include": "groups,permissions"}).json()
+        assert len(users) == min(limit, USERS + 1)
+    user7 = next(user for user in users if user["username"] == "user7")
+    assert user7["groups"] == [{"id": 102, "name": "group2"}, {"id": 107, "name": "group7"}]
+    assert user7["permissions"] == []
+    assert next(user for user in users if user["username"] == "user3")["permissions"] == [{"id": 100, "name": "service0"}]
+
+    with assert_max_queries(1):
+        assert "groups" not in client.get("/api/crud/users").json()[0]
+    assert client.get("/api/crud/users", params={"include": "password_hash"}).status_code == 400
+
+def test_groups_with_members(memberships, assert_max_queries):
+    client, _ = memberships
+    with assert_max_queries(3):
+        groups = client.get("/api/crud/groups", params={"include": "users,permissions", "search": "group"}).json()
+    assert [len(group["users"]) for group in groups] == [80] * 5 + [25] * 7
+    assert all(group["permissions"] == [{"id": group["id"], "name": f"service{group['id'] - 100}"}] for group in groups)
+
+def test_detail_endpoints(memberships, assert_max_queries):
+    client, _ = memberships
+    with assert_max_queries(3):
+        user = client.get("/api/crud/users/103").json()
+    assert [group["name"] for group in user["groups"]] == ["group3"]
+    assert user["permissions"] == [{"id": 100, "name": "service0"}]
+    with assert_max_queries(3):
+        group = client.get("/api/crud/groups/100").json()
+    assert len(group["users"]) == 80 and group["permissions"] == [{"id": 100, "name": "service0"}]
+    assert client.get("/api/crud/groups/1000").status_code == 404
+
+def test_principal_loads_in_constant_queries(memberships, test_database, assert_max_queries):
+    _, AsyncSession = test_database
+
+    async def load():
+        async with AsyncSession() as db:
+            return await load_principal(db, "user12")
+
+    with assert_max_queries(4):  # user, groups, their permissions, own permissions
+        principal = asyncio.run(load())
+    assert principal.groups == {"group0", "group2"}
+    assert principal.permissions == {"service0", "service2"}
+
+def test_query_limit_is_enforced(memberships, assert_max_queries):
+    client, _ = memberships
+    with pytest.raises(AssertionError, match="3 queries, expected at most 2"):
+        with assert_max_queries(2):
+            client.get("/api/crud/users", params={"include": "groups,permissions"})
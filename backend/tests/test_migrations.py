@@ -0,0 +1,41 @@
+from sqlalchemy import Boolean, Column, Integer, MetaData, String, Table, inspect, select
+from backend.database import make_engine
+from backend.migrations import MIGRATIONS, schema_migrations, upgrade
+from backend.models import ProxyService
+
+def legacy_proxy_services(metadata):
+    # proxy_services as first released, before upload limits and caching
+    return Table(
+        "proxy_services",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String(100), unique=True, nullable=False),
+        Column("base_url", String(200), nullable=False),
+        Column("description", String(200), nullable=True),
+        Column("enabled", Boolean, default=True),
+    )
+
+def test_fresh_database_gets_schema_and_versions(test_database_url):
+    engine = make_engine(test_database_url)
+    assert upgrade(engine) == [version for version, _, _ in MIGRATIONS]
+    assert upgrade(engine) == []
+    with engine.connect() as connection:
+        assert inspect(connection).has_table("users")
+        assert sorted(connection.scalars(select(schema_migrations.c.version))) == [1, 2, 3]
+    engine.dispose()
+
+def test_existing_database_is_migrated_in_place(test_database_url):
+    engine = make_engine(test_database_url)
+    legacy = legacy_proxy_services(MetaData())
+    with engine.begin() as connection:
+        legacy.create(connection)
+        connection.execute(legacy.insert().values(name="jellyfin", base_url="http://jellyfin.lan", enabled=True))
+
+    assert upgrade(engine) == [1, 2, 3]
+
+    with engine.connect() as connection:
+        columns = {column["name"] for column in inspect(connection).get_columns("proxy_services")}
+        assert {"max_body_size", "cache_enabled", "cache_ttl", "permission_id"} <= columns
+        row = connection.execute(select(ProxyService.__table__)).one()
+        assert (row.name, row.max_body_size, row.cache_ttl) == ("jellyfin", None, None)
+    engine.dispose()
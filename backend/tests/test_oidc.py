@@ -0,0 +1,212 @@
+import asyncio
+import time
+from urllib.parse import parse_qs, urlparse
+import httpx
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import FastAPI, Form, Header, HTTPException
+from fastapi.responses import HTMLResponse, JSONResponse
+from jose import jwk, jwt
+from sqlalchemy import select
+from backend.models import SSOProvider, User
+from backend.oidc import OIDCClient, OIDCError
+
+ISSUER = "https://idp.test"
+CLIENT_ID = "centralarr"
+
+
+def rsa_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048).private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    )
+
+
+class FakeIdP:
+    """
+    OpenID provider served in-process: discovery, JWKS, token and userinfo
+    endpoints, counting the calls it gets.
+    """
+
+    def __init__(self):
+        self.key, self.kid = rsa_key(), "key-1"
+        self.claims = {"sub": "u-1", "email": "sso@example.com", "preferred_username": "sso-user"}
+        self.userinfo = {"sub": "u-1", "email": "sso@example.com", "preferred_username": "sso-user"}
+        self.audience = CLIENT_ID
+        self.discovery_enabled = True
+        self.error_page = None  # endpoint answering HTML instead of JSON
+        self.missing_endpoints = ()  # keys left out of the discovery document
+        self.hits = {"discovery": 0, "jwks": 0, "token": 0, "userinfo": 0}
+        self.app = FastAPI()
+        self.app.get("/.well-known/openid-configuration")(self.discovery)
+        self.app.get("/jwks")(self.jwks)
+        self.app.post("/token")(self.token)
+        self.app.get("/userinfo")(self.user_info)
+
+    def rotate(self):
+        self.key, self.kid = rsa_key(), "key-2"
+
+    def discovery(self):
+        self.hits["discovery"] += 1
+        if not self.discovery_enabled:
+            return JSONResponse({}, status_code=404)
+        document = {
+            "issuer": ISSUER,
+            "authorization_endpoint": f"{ISSUER}/authorize",
+            "token_endpoint": f"{ISSUER}/token",
+            "userinfo_endpoint": f"{ISSUER}/userinfo",
+            "jwks_uri": f"{ISSUER}/jwks",
+            "id_token_signing_alg_values_supported": ["RS256"],
+        }
+        return {key: value for key, value in document.items() if key not in self.missing_endpoints}
+
+    def jwks(self):
+        self.hits["jwks"] += 1
+        public = jwk.construct(self.key, "RS256").public_key().to_dict()
+        return {"keys": [{**public, "kid": self.kid, "use": "sig"}]}
+
+    def token(self, code: str = Form(...), client_id: str = Form(...)):
+        self.hits["token"] += 1
+        if self.error_page == "token":
+            return HTMLResponse("<html>Service unavailable</html>")
+        access_token = f"at-{code}"
+        claims = {**self.claims, "iss": ISSUER, "aud": self.audience, "iat": int(time.time()), "exp": int(time.time()) + 300}
+        id_token = jwt.encode(claims, self.key, algorithm="RS256", headers={"kid": self.kid}, access_token=access_token)
+        return {"access_token": access_token, "token_type": "Bearer", "id_token": id_token}
+
+    def user_info(self, authorization: str = Header(...)):
+        self.hits["userinfo"] += 1
+        if not authorization.startswith("Bearer at-"):
+            raise HTTPException(401)
+        if self.error_page == "userinfo":
+            return HTMLResponse("<html>Service unavailable</html>")
+        return self.userinfo
+
+
+class Provider:
+    issuer_url = ISSUER
+    client_id = CLIENT_ID
+    client_secret = "secret"
+    auth_url = token_url = userinfo_url = None
+
+
+@pytest.fixture()
+def idp():
+    return FakeIdP()
+
+@pytest.fixture()
+def oidc(idp):
+    return OIDCClient(transport=httpx.ASGITransport(app=idp.app))
+
+@pytest.mark.asyncio
+async def test_id_token_claims_skip_userinfo_and_documents_are_cached(idp, oidc):
+    for code in ("one", "two"):
+        claims = await oidc.identity(Provider, code, "https://centralarr.test/callback")
+        assert claims["email"] == "sso@example.com"
+    assert idp.hits == {"discovery": 1, "jwks": 1, "token": 2, "userinfo": 0}
+    await oidc.aclose()
+
+@pytest.mark.asyncio
+async def test_userinfo_completes_id_tokens_without_email(idp, oidc):
+    idp.claims = {"sub": "u-1"}
+    claims = await oidc.identity(Provider, "code", "https://centralarr.test/callback")
+    assert claims["preferred_username"] == "sso-user"
+    assert idp.hits["userinfo"] == 1
+
+    idp.userinfo = {**idp.userinfo, "sub": "someone-else"}
+    with pytest.raises(OIDCError):
+        await oidc.identity(Provider, "code", "https://centralarr.test/callback")
+
+@pytest.mark.asyncio
+async def test_id_tokens_for_others_are_rejected(idp, oidc):
+    idp.audience = "another-client"
+    with pytest.raises(OIDCError, match="Invalid ID token"):
+        await oidc.identity(Provider, "code", "https://centralarr.test/callback")
+
+@pytest.mark.asyncio
+async def test_rotated_provider_keys_are_fetched(idp, oidc):
+    await oidc.identity(Provider, "code", "https://centralarr.test/callback")
+    idp.rotate()
+    assert (await oidc.identity(Provider, "code", "https://centralarr.test/callback"))["sub"] == "u-1"
+    assert idp.hits["jwks"] == 2
+
+@pytest.mark.asyncio
+async def test_expired_documents_are_refreshed_in_the_background(idp):
+    oidc = OIDCClient(ttl=0, transport=httpx.ASGITransport(app=idp.app))
+    first = await oidc.discovery(ISSUER)
+    assert await oidc.discovery(ISSUER) == first  # served at once
+    await asyncio.gather(*oidc._fetches.values())
+    assert idp.hits["discovery"] == 2
+
+    idp.discovery_enabled = False  # failing refreshes keep the last document
+    assert await oidc.discovery(ISSUER) == first
+    await asyncio.gather(*oidc._fetches.values(), return_exceptions=True)
+    assert await oidc.discovery(ISSUER) == first
+
+@pytest.mark.asyncio
+async def test_plain_oauth2_providers_use_their_endpoints(idp, oidc):
+    idp.discovery_enabled = False
+
+    class Manual(Provider):
+        token_url = f"{ISSUER}/token"
+        userinfo_url = f"{ISSUER}/userinfo"
+
+    claims = await oidc.identity(Manual, "code", "https://centralarr.test/callback")
+    assert claims["email"] == "sso@example.com"
+    assert idp.hits["userinfo"] == 1
+    with pytest.raises(OIDCError):
+        await oidc.identity(Provider, "code", "https://centralarr.test/callback")
+
+def test_sso_login_through_the_api(api, idp, oidc, monkeypatch):
+    client, Session = api
+    monkeypatch.setattr("backend.auth.oidc_client", oidc)
+    with Session() as session:
+        session.add(SSOProvider(name="idp", issuer_url=ISSUER, client_id=CLIENT_ID, client_secret="secret", enabled=True))
+        session.commit()
+
+    resp = client.get("/api/auth/login_sso/idp", follow_redirects=False)
+    assert resp.status_code == 307
+    location = urlparse(resp.headers["location"])
+    assert f"{location.scheme}://{location.netloc}{location.path}" == f"{ISSUER}/authorize"
+    assert parse_qs(location.query)["redirect_uri"] == ["http://testserver/api/auth/sso/callback/idp"]
+
+    tokens = client.get("/api/auth/sso/callback/idp", params={"code": "abc", "state": "s"}).json()
+    me = client.get("/api/auth/me", headers={"Authorization": f"Bearer {tokens['access_token']}"}).json()
+    assert me["username"] == "sso-user"
+    assert idp.hits == {"discovery": 1, "jwks": 1, "token": 1, "userinfo": 0}
+    with Session() as session:
+        assert session.scalars(select(User.email).where(User.username == "sso-user")).one() == "sso@example.com"
+
+@pytest.mark.asyncio
+async def test_provider_error_pages_are_oidc_errors(idp, oidc):
+    idp.error_page = "token"
+    with pytest.raises(OIDCError, match="Invalid token response"):
+        await oidc.identity(Provider, "code", "https://centralarr.test/callback")
+    idp.error_page, idp.claims = "userinfo", {"sub": "u-1"}
+    with pytest.raises(OIDCError, match="Invalid user info"):
+        await oidc.identity(Provider, "code", "https://centralarr.test/callback")
+
+@pytest.mark.asyncio
+async def test_failed_discovery_is_not_retried_at_once(idp):
+    oidc = OIDCClient(transport=httpx.ASGITransport(app=idp.app))
+    idp.discovery_enabled = False
+    for _ in range(3):
+        with pytest.raises(OIDCError):
+            await oidc.discovery(ISSUER)
+    assert idp.hits["discovery"] == 1
+
+    oidc.failure_ttl = 0
+    idp.discovery_enabled = True
+    assert (await oidc.discovery(ISSUER))["issuer"] == ISSUER
+    assert idp.hits["discovery"] == 2
+
+@pytest.mark.asyncio
+async def test_endpoints_missing_from_discovery_are_oidc_errors(idp, oidc):
+    idp.missing_endpoints = ("token_endpoint",)
+    with pytest.raises(OIDCError, match="no token endpoint"):
+        await oidc.identity(Provider, "code", "https://centralarr.test/callback")
+
+    oidc = OIDCClient(transport=httpx.ASGITransport(app=idp.app))
+    idp.missing_endpoints, idp.claims = ("userinfo_endpoint",), {"sub": "u-1"}
+    with pytest.raises(OIDCError, match="no userinfo endpoint"):
+        await oidc.identity(Provider, "code", "https://centralarr.test/callback")
@@ -0,0 +1,58 @@
+import asyncio
+import threading
+import pytest
+from sqlalchemy import select
+from backend.models import User
+from backend.passwords import PasswordHasher, PasswordHasherBusy
+
+@pytest.mark.asyncio
+async def test_hash_and_verify_off_the_loop():
+    hasher = PasswordHasher(rounds=4)
+    password_hash = await hasher.hash("secret")
+    assert password_hash.startswith("$2b$04$")
+    assert await hasher.verify_and_update("secret", password_hash) == (True, None)
+    assert await hasher.verify_and_update("wrong", password_hash) == (False, None)
+    assert await hasher.verify_and_update("secret", None) == (False, None)
+    hasher.shutdown()
+
+@pytest.mark.asyncio
+async def test_other_cost_factors_are_rehashed():
+    old_hash = await PasswordHasher(rounds=4).hash("secret")
+    hasher = PasswordHasher(rounds=5)
+    valid, new_hash = await hasher.verify_and_update("secret", old_hash)
+    assert valid and new_hash.startswith("$2b$05$")
+    assert (await hasher.verify_and_update("wrong", old_hash)) == (False, None)
+    assert hasher.counters["rehashed"] == 1
+
+@pytest.mark.asyncio
+async def test_excess_hashes_are_shed():
+    hasher = PasswordHasher(concurrency=1, queue=1)
+    release = threading.Event()
+    hasher.context = type("Blocking", (), {"hash": lambda self, password: release.wait() and password})()
+
+    first = asyncio.ensure_future(hasher.hash("a"))
+    queued = asyncio.ensure_future(hasher.hash("b"))
+    await asyncio.sleep(0.05)  # the loop keeps running while a hash blocks
+    with pytest.raises(PasswordHasherBusy):
+        await hasher.hash("c")
+    release.set()
+    assert await asyncio.gather(first, queued) == ["a", "b"]
+    assert await hasher.hash("d") == "d"
+    assert hasher.counters["rejected"] == 1
+    hasher.shutdown()
+
+def test_login_upgrades_the_cost_factor(api, monkeypatch):
+    client, Session = api
+    monkeypatch.setattr("backend.auth.password_hasher", PasswordHasher(rounds=4))
+    assert client.post("/api/auth/token", data={"username": "admin", "password": "adminpass"}).status_code == 200
+    with Session() as session:
+        password_hash = session.scalars(select(User.password_hash).where(User.username == "admin")).one()
+    assert password_hash.startswith("$2b$04$")
+    assert client.post("/api/auth/token", data={"username": "admin", "password": "adminpass"}).status_code == 200
+
+def test_logins_are_turned_away_when_saturated(api, monkeypatch):
+    client, _ = api
+    monkeypatch.setattr("backend.auth.password_hasher", PasswordHasher(concurrency=0, queue=0))
+    resp = client.post("/api/auth/token", data={"username": "admin", "password": "adminpass"})
+    assert resp.status_code == 503
+    assert resp.headers["retry-after"] == "1"
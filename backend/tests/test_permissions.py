@@ -0,0 +1,183 @@
+import random
+import httpx
+import pytest
+from sqlalchemy import insert, select, union
+from backend.invalidation import GenerationBus
+from backend.models import Group, Permission, ProxyService, User, group_permissions, user_groups, user_permissions
+from backend.permissions import PermissionIndex
+from backend.upstream import upstream_clients
+
+USERS = 3000
+GROUPS = 300
+PERMISSIONS = 200
+
+@pytest.fixture()
+def bus(tmp_path):
+    return GenerationBus(str(tmp_path / "centralarr.generations"))
+
+@pytest.fixture()
+def directory(test_database):
+    """
+    Thousands of users spread over hundreds of groups, with permissions
+    granted to both.
+    """
+    SyncSession, AsyncSession = test_database
+    rng = random.Random(16)
+    with SyncSession() as session:
+        session.execute(insert(User), [
+            {"id": i, "username": f"user{i}", "email": f"user{i}@example.com"} for i in range(1, USERS + 1)
+        ])
+        session.execute(insert(Group), [{"id": i, "name": f"group{i}"} for i in range(1, GROUPS + 1)])
+        session.execute(insert(Permission), [{"id": i, "name": f"service{i}"} for i in range(1, PERMISSIONS + 1)])
+        session.execute(insert(user_groups), [
+            {"user_id": u, "group_id": g} for u in range(1, USERS + 1) for g in rng.sample(range(1, GROUPS + 1), rng.randrange(4))
+        ])
+        session.execute(insert(group_permissions), [
+            {"group_id": g, "permission_id": p} for g in range(1, GROUPS + 1) for p in rng.sample(range(1, PERMISSIONS + 1), rng.randrange(6))
+        ])
+        session.execute(insert(user_permissions), [
+            {"user_id": u, "permission_id": p} for u in range(1, USERS + 1) for p in rng.sample(range(1, PERMISSIONS + 1), rng.randrange(3))
+        ])
+        session.commit()
+    return SyncSession, AsyncSession
+
+def expected_permissions(session):
+    rows = session.execute(union(
+        select(user_permissions.c.user_id, user_permissions.c.permission_id),
+        select(user_groups.c.user_id, group_permissions.c.permission_id)
+        .join(group_permissions, group_permissions.c.group_id == user_groups.c.group_id),
+    )).all()
+    effective = {user_id: set() for user_id in range(1, USERS + 1)}
+    for user_id, permission_id in rows:
+        effective[user_id].add(permission_id)
+    return effective
+
+async def loaded_index(AsyncSession, bus):
+    index = PermissionIndex(session_factory=AsyncSession, bus=bus)
+    await index.refresh()
+    return index
+
+@pytest.mark.asyncio
+async def test_index_matches_the_database(directory, bus):
+    SyncSession, AsyncSession = directory
+    index = await loaded_index(AsyncSession, bus)
+    with SyncSession() as session:
+        expected = expected_permissions(session)
+    for user_id, permissions in expected.items():
+        assert index.effective(user_id) == permissions
+        assert all(index.allows(user_id, p) == (p in permissions) for p in range(1, PERMISSIONS + 1))
+
+@pytest.mark.asyncio
+async def test_incremental_changes_match_a_rebuild(directory, bus):
+    SyncSession, AsyncSession = directory
+    index = await loaded_index(AsyncSession, bus)
+    rng = random.Random(17)
+    with SyncSession() as session:
+        for _ in range(500):
+            user_id, group_id, permission_id = rng.randint(1, USERS), rng.randint(1, GROUPS), rng.randint(1, PERMISSIONS)
+            change = rng.choice(["member", "user_grant", "group_grant"])
+            table, ids, add, remove = {
+                "member": (user_groups, {"user_id": user_id, "group_id": group_id},
+                           lambda: index.add_member(user_id, group_id), lambda: index.remove_member(user_id, group_id)),
+                "user_grant": (user_permissions, {"user_id": user_id, "permission_id": permission_id},
+                               lambda: index.grant_user(user_id, permission_id), lambda: index.revoke_user(user_id, permission_id)),
+                "group_grant": (group_permissions, {"group_id": group_id, "permission_id": permission_id},
+                                lambda: index.grant_group(group_id, permission_id), lambda: index.revoke_group(group_id, permission_id)),
+            }[change]
+            condition = [table.c[name] == value for name, value in ids.items()]
+            if session.execute(select(table).where(*condition)).first():
+                session.execute(table.delete().where(*condition))
+                remove()
+            else:
+                session.execute(table.insert().values(**ids))
+                add()
+        for group_id in rng.sample(range(1, GROUPS + 1), 20):
+            session.execute(user_groups.delete().where(user_groups.c.group_id == group_id))
+            session.execute(group_permissions.delete().where(group_permissions.c.group_id == group_id))
+            index.remove_group(group_id)
+        for user_id in rng.sample(range(1, USERS + 1), 100):
+            session.execute(user_groups.delete().where(user_groups.c.user_id == user_id))
+            session.execute(user_permissions.delete().where(user_permissions.c.user_id == user_id))
+            index.remove_user(user_id)
+        for permission_id in rng.sample(range(1, PERMISSIONS + 1), 10):
+            session.execute(user_permissions.delete().where(user_permissions.c.permission_id == permission_id))
+            session.execute(group_permissions.delete().where(group_permissions.c.permission_id == permission_id))
+            index.remove_permission(permission_id)
+        session.commit()
+        expected = expected_permissions(session)
+
+    rebuilt = await loaded_index(AsyncSession, bus)
+    for user_id, permissions in expected.items():
+        assert index.effective(user_id) == rebuilt.effective(user_id) == permissions
+
+@pytest.mark.asyncio
+async def test_own_changes_are_acknowledged_others_rebuild(test_database, bus):
+    _, AsyncSession = test_database
+    index = await loaded_index(AsyncSession, bus)
+    index.grant_user(1, 5)
+    index.acknowledge(bus.bump("users"))
+    assert not index.is_stale()
+    assert index.allows(1, 5)
+
+    GenerationBus(bus.path).bump("groups")  # another worker
+    index.grant_user(1, 6)
+    index.acknowledge(bus.bump("groups"))
+    assert index.is_stale()
+    await index.ensure_fresh()
+    assert not index.allows(1, 5)  # never committed
+
+@pytest.fixture()
+def restricted(api, monkeypatch):
+    """
+    A 'media' service restricted to the 'media' permission, a user 'alice'
+    without it, and her token.
+    """
+    client, Session = api
+    with Session() as session:
+        permission = Permission(name="media")
+        session.add(permission)
+        session.flush()
+        session.add(ProxyService(name="media", base_url="http://media.local", enabled=True, permission_id=permission.id))
+        session.commit()
+        permission_id = permission.id
+    assert client.post("/api/auth/register", json={"username": "alice", "email": "alice@example.com", "password": "pw"}).status_code == 200
+    token = client.post("/api/auth/token", data={"username": "alice", "password": "pw"}).json()["access_token"]
+
+    async def body():
+        yield b"ok"
+
+    seen = []
+    def handler(request):
+        seen.append(request)
+        return httpx.Response(200, content=body())
+    monkeypatch.setattr(upstream_clients, "_create_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    upstream_clients.discard("media")
+    with Session() as session:
+        user_id = session.scalars(select(User.id).where(User.username == "alice")).one()
+    yield client, {"Authorization": f"Bearer {token}"}, user_id, permission_id, seen
+    upstream_clients.discard("media")
+
+def test_restricted_services_need_the_permission(restricted):
+    client, alice, user_id, permission_id, seen = restricted
+    assert client.get("/api/proxy/media/", headers={"Authorization": ""}).status_code == 401
+    assert client.get("/api/proxy/media/", headers={"Authorization": "Bearer forged"}).status_code == 401
+    assert client.get("/api/proxy/media/", headers=alice).status_code == 403
+    assert client.get("/api/proxy/media/").status_code == 200  # admin
+    assert "authorization" not in seen[-1].headers
+
+def test_grants_apply_at_once(restricted):
+    client, alice, user_id, permission_id, _ = restricted
+    group_id = client.post("/api/crud/groups", params={"name": "family"}).json()["id"]
+    assert client.put(f"/api/crud/groups/{group_id}/permissions/{permission_id}").status_code == 200
+    assert client.get("/api/proxy/media/", headers=alice).status_code == 403
+    assert client.put(f"/api/crud/users/{user_id}/groups/{group_id}").status_code == 200
+    assert client.get("/api/proxy/media/", headers=alice).status_code == 200
+    assert client.delete(f"/api/crud/users/{user_id}/groups/{group_id}").status_code == 200
+    assert client.get("/api/proxy/media/", headers=alice).status_code == 403
+    assert client.put(f"/api/crud/users/{user_id}/permissions/{permission_id}").status_code == 200
+    assert client.get("/api/proxy/media/", headers=alice).status_code == 200
+    assert client.put(f"/api/crud/users/{user_id}/permissions/999").status_code == 404
+
+def test_permission_of_a_service_cannot_be_deleted(restricted):
+    client, _, _, permission_id, _ = restricted
+    assert client.delete(f"/api/crud/permissions/{permission_id}").status_code == 400
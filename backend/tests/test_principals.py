@@ -0,0 +1,110 @@
+import pytest
+from sqlalchemy import event
+from backend.invalidation import GenerationBus
+from backend.models import Group, Permission, User
+from backend.principals import Principal, PrincipalCache
+
+def principal(name="alice", groups=()):
+    return Principal(id=1, username=name, email=None, groups=frozenset(groups), permissions=frozenset())
+
+@pytest.fixture()
+def bus(tmp_path):
+    return GenerationBus(str(tmp_path / "centralarr.generations"))
+
+class Loader:
+    def __init__(self, result):
+        self.result = result
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        return self.result
+
+@pytest.mark.asyncio
+async def test_cached_principal_is_not_reloaded(bus):
+    cache = PrincipalCache(bus=bus)
+    load = Loader(principal())
+    assert await cache.get("alice", load) == principal()
+    assert await cache.get("alice", load) == principal()
+    assert load.calls == 1
+    assert cache.counters == {"hits": 1, "misses": 1}
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("entity", ["users", "groups", "permissions"])
+async def test_changes_empty_the_cache(bus, entity):
+    cache = PrincipalCache(bus=bus)
+    load = Loader(principal())
+    await cache.get("alice", load)
+    GenerationBus(bus.path).bump(entity)  # e.g. another worker
+    await cache.get("alice", load)
+    assert load.calls == 2
+
+@pytest.mark.asyncio
+async def test_ttl_expiry_and_unknown_users(bus):
+    cache = PrincipalCache(ttl=0, bus=bus)
+    load = Loader(principal())
+    await cache.get("alice", load)
+    await cache.get("alice", load)
+    assert load.calls == 2
+    missing = Loader(None)
+    assert await cache.get("ghost", missing) is None
+    assert await cache.get("ghost", missing) is None
+    assert missing.calls == 2
+
+@pytest.mark.asyncio
+async def test_load_racing_a_change_is_not_stored(bus):
+    cache = PrincipalCache(bus=bus)
+
+    async def stale():
+        GenerationBus(bus.path).bump("users")
+        cache._sync_generations()
+        return principal()
+
+    await cache.get("alice", stale)
+    load = Loader(principal())
+    await cache.get("alice", load)
+    assert load.calls == 1
+
+@pytest.mark.asyncio
+async def test_least_recently_used_are_evicted(bus):
+    cache = PrincipalCache(max_entries=2, bus=bus)
+    loads = {name: Loader(principal(name)) for name in ("a", "b", "c")}
+    await cache.get("a", loads["a"])
+    await cache.get("b", loads["b"])
+    await cache.get("a", loads["a"])
+    await cache.get("c", loads["c"])
+    await cache.get("a", loads["a"])
+    await cache.get("b", loads["b"])
+    assert (loads["a"].calls, loads["b"].calls) == (1, 2)
+
+def test_principal_collects_group_permissions():
+    user = User(id=7, username="bob", email="bob@example.com")
+    user.permissions.append(Permission(name="sonarr"))
+    group = Group(name="family")
+    group.permissions.append(Permission(name="radarr"))
+    user.groups.append(group)
+    assert Principal.from_user(user) == Principal(
+        id=7, username="bob", email="bob@example.com",
+        groups=frozenset({"family"}), permissions=frozenset({"sonarr", "radarr"}),
+    )
+
+def count_queries(test_database):
+    _, AsyncSession = test_database
+    queries = []
+    event.listen(AsyncSession.kw["bind"].sync_engine, "before_cursor_execute", lambda *args: queries.append(args[2]))
+    return queries
+
+def test_admin_endpoints_authorize_without_queries(api, test_database):
+    client, _ = api
+    assert client.get("/api/auth/me").status_code == 200
+    queries = count_queries(test_database)
+    assert client.get("/api/crud/proxy_cache").status_code == 200
+    assert client.get("/api/auth/me").json()["username"] == "admin"
+    assert queries == []
+
+def test_removing_the_admin_group_is_seen_at_once(api, test_database):
+    client, _ = api
+    assert client.get("/api/crud/proxy_cache").status_code == 200
+    group_id = next(g["id"] for g in client.get("/api/crud/groups").json() if g["name"] == "admin")
+    assert client.delete(f"/api/crud/groups/{group_id}").status_code == 200
+    assert client.get("/api/crud/proxy_cache").status_code == 403
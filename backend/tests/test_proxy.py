@@ -1,9 +1,16 @@
+import asyncio
 import pytest
+import httpx
 from fastapi.testclient import TestClient
+import backend.proxy
 from backend.main import app
 from backend.models import ProxyService
 from backend.database import Base, engine, SessionLocal
-from unittest.mock import patch
+from backend.routing import RoutingTable
+from backend.cache import ResponseCache
+from backend.coalescing import RequestCoalescer
+from backend.upstream import upstream_clients
+from backend.proxy import JavaScriptInjector, INJECTED_JS, stream_upstream
 from httpx import Response as HTTPXResponse
 
 @pytest.fixture(scope="module")
@@ -27,53 +34,64 @@ def client():
     with TestClient(app) as c:
         yield c
 
+@pytest.fixture()
+def upstream(monkeypatch, test_database):
+    """
+    Serve 'media', 'uploads', 'assets' (cached) and 'account' (cached, 300s
+    default TTL) ProxyServices from an isolated database and route their
+    upstream traffic to a handler set by the test (httpx.MockTransport).
+    """
+    SyncSession, AsyncSession = test_database
+    with SyncSession() as session:
+        session.add(ProxyService(name="media", base_url="http://media.local", enabled=True))
+        session.add(ProxyService(name="uploads", base_url="http://media.local", enabled=True, max_body_size=1024))
+        session.add(ProxyService(name="assets", base_url="http://media.local", enabled=True, cache_enabled=True))
+        session.add(ProxyService(name="account", base_url="http://media.local", enabled=True, cache_enabled=True, cache_ttl=300))
+        session.commit()
+
+    table = RoutingTable(session_factory=AsyncSession)
+    asyncio.run(table.refresh())
+    monkeypatch.setattr("backend.proxy.routing_table", table)
+    monkeypatch.setattr("backend.proxy.response_cache", ResponseCache())
+    monkeypatch.setattr("backend.proxy.request_coalescer", RequestCoalescer())
+
+    handler = {}
+    monkeypatch.setattr(
+        upstream_clients,
+        "_create_client",
+        lambda: httpx.AsyncClient(transport=httpx.MockTransport(lambda request: handler["fn"](request))),
+    )
+    for name in ("media", "uploads", "assets", "account"):
+        upstream_clients.discard(name)
+    yield handler
+    for name in ("media", "uploads", "assets", "account"):
+        upstream_clients.discard(name)
+
 def test_proxy_service_not_found(client):
     resp = client.get("/api/proxy/nonexistentservice/")
     assert resp.status_code == 404
     assert "not found" in resp.text.lower()
 
-@patch('backend.proxy.httpx.AsyncClient.request')
-def test_proxy_service_http_success(mock_request, client, db_session):
-    # Setup proxy service in DB
-    service = ProxyService(name="testservice", base_url="http://example.com", enabled=True)
-    db_session.add(service)
-    db_session.commit()
+def test_proxy_service_http_success(client, upstream):
+    page = b"<html><body>Test page</body></html>"
+    upstream["fn"] = lambda request: HTTPXResponse(200, content=stream_body(page), headers={"Content-Type": "text/html"})
 
-    # Mock httpx response
-    mock_resp = HTTPXResponse(
-        status_code=200,
-        content=b"<html><body>Test page</body></html>",
-        headers={"Content-Type": "text/html"}
-    )
-    mock_request.return_value = mock_resp
-
-    resp = client.get("/api/proxy/testservice/")
+    resp = client.get("/api/proxy/media/")
 
     assert resp.status_code == 200
     # Check injected JS script is present
-    assert b'<script src="/static/telecommande.js"></script>' in resp.content
+    assert INJECTED_JS.encode() in resp.content
     # Content length changed due to injection
-    assert len(resp.content) > len(mock_resp.content)
+    assert len(resp.content) > len(page)
 
-@patch('backend.proxy.httpx.AsyncClient.request')
-def test_proxy_service_location_header(mock_request, client, db_session):
-    service = ProxyService(name="redirservice", base_url="http://example.com", enabled=True)
-    db_session.add(service)
-    db_session.commit()
-    
-    headers = {"Location": "/login"}
-    mock_resp = HTTPXResponse(
-        status_code=302,
-        content=b"",
-        headers=headers
-    )
-    mock_request.return_value = mock_resp
+def test_proxy_service_location_header(client, upstream):
+    upstream["fn"] = lambda request: HTTPXResponse(302, content=stream_body(), headers={"Location": "/login"})
 
-    resp = client.get("/api/proxy/redirservice/somepath")
+    resp = client.get("/api/proxy/media/somepath", follow_redirects=False)
 
     assert resp.status_code == 302
     # The Location header should be rewritten to include proxy path prefix
-    expected_location = "/api/proxy/redirservice/login"
+    expected_location = "/api/proxy/media/login"
     assert resp.headers.get("location") == expected_location
 
 def test_proxy_websocket_connection(client, db_session):
@@ -88,4 +106,459 @@ def test_proxy_websocket_connection(client, db_session):
             data = websocket.receive_bytes(timeout=1)
         except:
             # Expected to timeout or error, so test only connection lifecycle
-            pass
\ No newline at end of file
+            pass
+
+async def stream_body(*chunks):
+    # Async bodies stay unread until the proxy streams them, like a real socket
+    for chunk in chunks:
+        yield chunk
+
+def test_proxy_streams_non_html_bodies(client, upstream):
+    chunks = [b"a" * 65536, b"b" * 65536, b"c" * 10]
+    upstream["fn"] = lambda request: HTTPXResponse(
+        200,
+        headers={"Content-Type": "audio/flac", "Content-Length": str(sum(map(len, chunks)))},
+        content=stream_body(*chunks),
+    )
+
+    with client.stream("GET", "/api/proxy/media/rest/download") as resp:
+        assert resp.status_code == 200
+        # Streamed bodies keep their length and are not rewritten
+        assert resp.headers["content-length"] == str(sum(map(len, chunks)))
+        assert b"".join(resp.iter_bytes()) == b"".join(chunks)
+
+def test_proxy_keeps_encoding_of_streamed_bodies(client, upstream):
+    import gzip
+    payload = gzip.compress(b'{"items": []}')
+    upstream["fn"] = lambda request: HTTPXResponse(
+        200,
+        headers={"Content-Type": "application/json", "Content-Encoding": "gzip"},
+        content=stream_body(payload),
+    )
+
+    resp = client.get("/api/proxy/media/Items")
+    assert resp.headers["content-encoding"] == "gzip"
+    assert resp.json() == {"items": []}
+
+def test_proxy_still_rewrites_html(client, upstream):
+    upstream["fn"] = lambda request: HTTPXResponse(
+        200,
+        headers=[("Content-Type", "text/html"), ("Set-Cookie", "a=1; Path=/"), ("Set-Cookie", "b=2")],
+        content=stream_body(b"<html><body>Home</body></html>"),
+    )
+
+    resp = client.get("/api/proxy/media/web/index.html")
+    assert resp.status_code == 200
+    assert b'<script src="/static/injection.js"></script></body>' in resp.content
+    assert resp.headers.get_list("set-cookie") == ["a=1;Path=/api/proxy/media", "b=2;Path=/api/proxy/media"]
+
+@pytest.mark.asyncio
+async def test_stream_upstream_closes_upstream_on_disconnect():
+    resp = HTTPXResponse(200, content=stream_body(b"first", b"second"))
+    body = stream_upstream(resp)
+    assert await body.__anext__() == b"first"
+
+    # Client went away: Starlette stops iterating the body
+    await body.aclose()
+    assert resp.is_closed
+
+def test_proxy_streams_request_body(client, upstream):
+    received = {}
+
+    def handler(request):
+        received["body"] = request.content
+        received["headers"] = request.headers
+        return HTTPXResponse(204, content=stream_body())
+    upstream["fn"] = handler
+
+    chunks = [b"x" * 4096] * 8
+    resp = client.post("/api/proxy/media/Items/1/Images", content=iter(chunks))
+    assert resp.status_code == 204
+    assert received["body"] == b"".join(chunks)
+    assert received["headers"]["transfer-encoding"] == "chunked"
+
+def test_proxy_get_without_body_is_not_chunked(client, upstream):
+    received = {}
+
+    def handler(request):
+        received["headers"] = request.headers
+        return HTTPXResponse(200, content=stream_body(b"ok"))
+    upstream["fn"] = handler
+
+    assert client.get("/api/proxy/media/System/Info").status_code == 200
+    assert "transfer-encoding" not in received["headers"]
+
+def test_proxy_rejects_oversized_body_early(client, upstream):
+    def handler(request):
+        raise AssertionError("upstream must not be contacted")
+    upstream["fn"] = handler
+
+    resp = client.post("/api/proxy/uploads/restore", content=b"x" * 2048)
+    assert resp.status_code == 413
+
+def test_proxy_rejects_oversized_chunked_body(client, upstream):
+    upstream["fn"] = lambda request: HTTPXResponse(204, content=stream_body())
+
+    resp = client.post("/api/proxy/uploads/restore", content=iter([b"x" * 1000, b"x" * 1000]))
+    assert resp.status_code == 413
+    assert client.post("/api/proxy/uploads/restore", content=iter([b"x" * 1000])).status_code == 204
+
+
+# --- Streaming JS injection ---
+
+def test_injector_finds_tag_split_across_chunks():
+    page = b"<html><head></head><BODY>" + b"x" * 100 + b"</BoDy></html>"
+    expected = page.replace(b"</BoDy>", INJECTED_JS.encode() + b"</BoDy>")
+    for split in range(1, len(page)):
+        for step in (1, 3, split):
+            injector = JavaScriptInjector()
+            chunks = [page[:split]] + [page[i:i + step] for i in range(split, len(page), step)]
+            out = b"".join(injector.feed(chunk) for chunk in chunks) + injector.flush()
+            assert out == expected
+
+def test_injector_holds_back_only_a_small_window():
+    injector = JavaScriptInjector()
+    assert injector.feed(b"a" * 10000) == b"a" * (10000 - JavaScriptInjector.CARRY_SIZE)
+    assert injector.flush() == b"a" * JavaScriptInjector.CARRY_SIZE
+
+def test_injector_without_body_tag_is_lossless():
+    injector = JavaScriptInjector()
+    out = injector.feed(b"<html>no") + injector.feed(b" body</bod") + injector.flush()
+    assert out == b"<html>no body</bod"
+    assert not injector.injected
+
+@pytest.mark.parametrize("encoding", ["gzip", "br"])
+def test_proxy_injects_into_compressed_html(client, upstream, encoding):
+    import gzip
+    import brotli
+    page = b"<html><body>" + b"<p>row</p>" * 5000 + b"</body></html>"
+    compressed = gzip.compress(page) if encoding == "gzip" else brotli.compress(page)
+    chunks = [compressed[i:i + 1000] for i in range(0, len(compressed), 1000)]
+    upstream["fn"] = lambda request: HTTPXResponse(
+        200,
+        headers={"Content-Type": "text/html; charset=utf-8", "Content-Encoding": encoding,
+                 "Content-Length": str(len(compressed))},
+        content=stream_body(*chunks),
+    )
+
+    resp = client.get("/api/proxy/media/web/index.html")
+    assert resp.status_code == 200
+    assert "content-encoding" not in resp.headers
+    assert resp.content == page.replace(b"</body>", INJECTED_JS.encode() + b"</body>")
+
+def test_proxy_passes_through_undecodable_html(client, upstream):
+    upstream["fn"] = lambda request: HTTPXResponse(
+        200,
+        headers={"Content-Type": "text/html", "Content-Encoding": "x-custom"},
+        content=stream_body(b"opaque"),
+    )
+
+    resp = client.get("/api/proxy/media/web/index.html")
+    assert resp.headers["content-encoding"] == "x-custom"
+    assert resp.content == b"opaque"
+
+
+# --- Response cache ---
+
+def test_proxy_serves_cacheable_responses_from_cache(client, upstream):
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.path)
+        return HTTPXResponse(
+            200,
+            headers={"Content-Type": "image/jpeg", "Cache-Control": "public, max-age=3600", "ETag": '"v1"'},
+            content=stream_body(b"poster", b"-bytes"),
+        )
+    upstream["fn"] = handler
+
+    first = client.get("/api/proxy/assets/Items/42/Images/Primary?tag=abc")
+    second = client.get("/api/proxy/assets/Items/42/Images/Primary?tag=abc")
+    other = client.get("/api/proxy/assets/Items/42/Images/Primary?tag=def")
+
+    assert first.headers["x-cache"] == "MISS"
+    assert second.headers["x-cache"] == "HIT"
+    assert second.content == b"poster-bytes"
+    assert second.headers["etag"] == '"v1"'
+    assert other.headers["x-cache"] == "MISS"
+    assert calls == ["/Items/42/Images/Primary", "/Items/42/Images/Primary"]
+
+def test_proxy_does_not_cache_private_or_credentialed_responses(client, upstream):
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.path)
+        cache_control = "private, max-age=60" if request.url.path == "/private" else "max-age=60"
+        return HTTPXResponse(200, headers={"Cache-Control": cache_control}, content=stream_body(b"data"))
+    upstream["fn"] = handler
+
+    for _ in range(2):
+        client.get("/api/proxy/assets/private")
+        client.get("/api/proxy/assets/Users/Me", headers={"X-Emby-Token": "secret"})
+    assert len(calls) == 4
+
+def test_proxy_does_not_share_cookie_authenticated_responses(client, upstream):
+    calls = []
+
+    def handler(request):
+        calls.append(request.headers["cookie"])
+        return HTTPXResponse(200, headers={"Content-Type": "application/json"}, content=stream_body(request.headers["cookie"].encode()))
+    upstream["fn"] = handler
+
+    # No Cache-Control: the service's default TTL must not apply to them
+    alice = client.get("/api/proxy/account/Users/Me", headers={"Cookie": "session=alice"})
+    bob = client.get("/api/proxy/account/Users/Me", headers={"Cookie": "session=bob"})
+    assert alice.content == b"session=alice"
+    assert bob.content == b"session=bob"
+    assert calls == ["session=alice", "session=bob"]
+
+def test_proxy_cache_is_disabled_per_service(client, upstream):
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.path)
+        return HTTPXResponse(200, headers={"Cache-Control": "max-age=60"}, content=stream_body(b"data"))
+    upstream["fn"] = handler
+
+    client.get("/api/proxy/media/logo.png")
+    resp = client.get("/api/proxy/media/logo.png")
+    assert "x-cache" not in resp.headers
+    assert len(calls) == 2
+
+
+def test_proxy_answers_conditional_requests_from_cache(client, upstream):
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.path)
+        return HTTPXResponse(
+            200,
+            headers={"Cache-Control": "max-age=3600", "ETag": '"v1"', "Content-Type": "image/jpeg"},
+            content=stream_body(b"poster"),
+        )
+    upstream["fn"] = handler
+
+    client.get("/api/proxy/assets/poster.jpg")
+    resp = client.get("/api/proxy/assets/poster.jpg", headers={"If-None-Match": '"v1"'})
+    assert resp.status_code == 304
+    assert resp.content == b""
+    assert resp.headers["etag"] == '"v1"'
+    assert resp.headers["x-cache"] == "HIT"
+    changed = client.get("/api/proxy/assets/poster.jpg", headers={"If-None-Match": '"v0"'})
+    assert changed.status_code == 200 and changed.content == b"poster"
+    assert len(calls) == 1
+
+def test_proxy_revalidates_stale_entries_with_its_own_validators(client, upstream):
+    seen = []
+
+    def handler(request):
+        seen.append(request.headers.get("if-none-match"))
+        if request.headers.get("if-none-match") == '"v1"':
+            return HTTPXResponse(304, headers={"Cache-Control": "max-age=3600", "ETag": '"v1"'})
+        return HTTPXResponse(
+            200, headers={"Cache-Control": "no-cache", "ETag": '"v1"'}, content=stream_body(b"bundle"),
+        )
+    upstream["fn"] = handler
+
+    first = client.get("/api/proxy/assets/main.js")
+    # Stale right away: revalidated with the stored ETag, not the client's
+    second = client.get("/api/proxy/assets/main.js", headers={"If-None-Match": '"other"'})
+    third = client.get("/api/proxy/assets/main.js")
+
+    assert first.headers["x-cache"] == "MISS"
+    assert second.status_code == 200 and second.content == b"bundle"
+    assert second.headers["x-cache"] == "REVALIDATED"
+    assert second.headers["cache-control"] == "max-age=3600"
+    assert third.headers["x-cache"] == "HIT"
+    assert seen == [None, '"v1"']
+
+def test_proxy_stops_revalidating_changed_resources_too_big_to_cache(client, upstream, monkeypatch):
+    produced = []
+
+    async def big_body():
+        for _ in range(64):
+            produced.append(1)
+            yield b"x" * 1024
+
+    calls = []
+
+    def handler(request):
+        calls.append(request.headers.get("if-none-match"))
+        if len(calls) == 1:
+            return HTTPXResponse(200, headers={"Cache-Control": "no-cache", "ETag": '"v1"'}, content=stream_body(b"small"))
+        # Changed since: the revalidation gets the new body
+        return HTTPXResponse(200, headers={"Cache-Control": "no-cache", "ETag": '"v2"'}, content=big_body())
+    upstream["fn"] = handler
+
+    client.get("/api/proxy/assets/video.bin")
+    monkeypatch.setattr(backend.proxy.response_cache, "max_entry_bytes", 4096)
+    produced.clear()
+    resp = client.get("/api/proxy/assets/video.bin")
+    assert len(resp.content) == 64 * 1024
+    assert calls == [None, '"v1"', None]
+    # The revalidation gave up after the limit, only the client's own
+    # request read the whole body
+    assert 64 < len(produced) <= 64 + 6
+
+
+# --- Request coalescing ---
+
+async def concurrent_gets(paths_and_headers):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://centralarr") as asgi_client:
+        return await asyncio.gather(*(
+            asgi_client.get(path, headers=headers) for path, headers in paths_and_headers
+        ))
+
+def gated_upstream(upstream, content_type="application/json", body=b'{"Items": []}'):
+    """
+    Upstream answering only once every concurrent request reached the proxy.
+    """
+    calls = []
+
+    async def handler(request):
+        calls.append(dict(request.headers))
+        await asyncio.sleep(0.05)
+        return HTTPXResponse(
+            200, headers={"Content-Type": content_type, "Content-Length": str(len(body))}, content=stream_body(body),
+        )
+    upstream["fn"] = handler
+    return calls
+
+def test_identical_concurrent_gets_share_one_upstream_request(upstream):
+    calls = gated_upstream(upstream)
+    token = {"X-Emby-Token": "alice"}
+    responses = asyncio.run(concurrent_gets([("/api/proxy/media/Users/1/Items?Limit=50", token)] * 10))
+
+    assert len(calls) == 1
+    assert all(r.status_code == 200 and r.content == b'{"Items": []}' for r in responses)
+    assert backend.proxy.request_coalescer.counters["coalesced"] == 9
+    assert backend.proxy.request_coalescer.stats()["in_flight"] == 0
+
+def test_coalescing_never_shares_between_users(upstream):
+    calls = gated_upstream(upstream)
+    asyncio.run(concurrent_gets([
+        ("/api/proxy/media/Users/Me", {"X-Emby-Token": "alice"}),
+        ("/api/proxy/media/Users/Me", {"X-Emby-Token": "bob"}),
+        ("/api/proxy/media/Users/Me", {"Cookie": "session=carol"}),
+    ]))
+    assert sorted(call.get("x-emby-token", call.get("cookie")) for call in calls) == ["alice", "bob", "session=carol"]
+
+def test_rewritten_html_is_not_shared(upstream):
+    calls = gated_upstream(upstream, "text/html", b"<html><body></body></html>")
+    responses = asyncio.run(concurrent_gets([("/api/proxy/media/web/index.html", {})] * 3))
+    assert len(calls) == 3
+    assert all(INJECTED_JS.encode() in r.content for r in responses)
+
+
+# --- Range / seek harness ---
+#
+# A fake media upstream serves a large virtual file (bytes are generated from
+# their offset) with Range support. Requests go straight through the ASGI app,
+# so time-to-first-byte is measured without the TestClient, which buffers
+# whole bodies.
+
+MEDIA_SIZE = 8 * 1024 ** 3  # 8 GiB
+MEDIA_CHUNK = 64 * 1024
+
+def media_bytes(start: int, length: int) -> bytes:
+    return bytes((start + i) % 251 for i in range(length))
+
+def fake_media_upstream(produced: list):
+    async def handler(request):
+        first, _, last = request.headers["range"].removeprefix("bytes=").partition("-")
+        first = int(first)
+        last = int(last) if last else MEDIA_SIZE - 1
+
+        async def body():
+            offset = first
+            while offset <= last:
+                length = min(MEDIA_CHUNK, last - offset + 1)
+                produced.append(length)
+                yield media_bytes(offset, length)
+                offset += length
+
+        return HTTPXResponse(
+            206,
+            headers={
+                "Content-Type": "video/mp4",
+                "Accept-Ranges": "bytes",
+                "Content-Range": f"bytes {first}-{last}/{MEDIA_SIZE}",
+                "Content-Length": str(last - first + 1),
+            },
+            content=body(),
+        )
+    return handler
+
+async def asgi_seek(path: str, byte_range: str, read_bytes: int):
+    """
+    Issue a GET through the app and hang up after read_bytes body bytes,
+    like a player seeking away. Returns (status, headers, body, ttfb).
+    """
+    loop = asyncio.get_running_loop()
+    disconnected = asyncio.Event()
+    result = {"body": b"", "ttfb": None}
+    scope = {
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.3"},
+        "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "root_path": "", "query_string": b"",
+        "headers": [(b"host", b"testserver"), (b"range", byte_range.encode())],
+        "client": ("127.0.0.1", 50000), "server": ("testserver", 80),
+    }
+
+    async def receive():
+        if not result.get("requested"):
+            result["requested"] = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        await asyncio.sleep(0)  # a real server yields while writing to the socket
+        if message["type"] == "http.response.start":
+            result["status"] = message["status"]
+            result["headers"] = {k.decode(): v.decode() for k, v in message["headers"]}
+        elif message["type"] == "http.response.body" and message.get("body"):
+            if result["ttfb"] is None:
+                result["ttfb"] = loop.time() - started
+            result["body"] += message["body"]
+            if len(result["body"]) >= read_bytes:
+                disconnected.set()
+
+    started = loop.time()
+    await asyncio.wait_for(app(scope, receive, send), timeout=10)
+    return result["status"], result["headers"], result["body"], result["ttfb"]
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("offset", [0, 1024 ** 3, 5 * 1024 ** 3 + 12345, MEDIA_SIZE - 4096])
+async def test_proxy_seek_streams_partial_content(upstream, offset):
+    produced = []
+    upstream["fn"] = fake_media_upstream(produced)
+
+    status, headers, body, ttfb = await asgi_seek(
+        "/api/proxy/media/Videos/1/stream", f"bytes={offset}-", read_bytes=4096
+    )
+    await upstream_clients.aclose()
+
+    assert status == 206
+    assert headers["content-range"] == f"bytes {offset}-{MEDIA_SIZE - 1}/{MEDIA_SIZE}"
+    assert headers["content-length"] == str(MEDIA_SIZE - offset)
+    assert headers["accept-ranges"] == "bytes"
+    assert body[:4096] == media_bytes(offset, 4096)
+    # Open-ended seeks are streamed: hanging up stops the upstream read after
+    # a few chunks instead of pulling gigabytes first
+    assert sum(produced) <= 4 * MEDIA_CHUNK
+    assert ttfb < 1.0
+
+def test_proxy_range_response_is_never_rewritten(client, upstream):
+    page = b"<html><body>partial</body></html>"
+    upstream["fn"] = lambda request: HTTPXResponse(
+        206,
+        headers={"Content-Type": "text/html", "Content-Range": f"bytes 0-{len(page) - 1}/100", "Content-Length": str(len(page))},
+        content=stream_body(page),
+    )
+
+    resp = client.get("/api/proxy/media/index.html", headers={"Range": f"bytes=0-{len(page) - 1}"})
+    assert resp.status_code == 206
+    assert resp.content == page
+    assert resp.headers["content-length"] == str(len(page))
@@ -0,0 +1,74 @@
+import logging
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from backend.querystats import QueryStats, normalize
+
+def test_statement_shapes():
+    sqlite = "SELECT users.id FROM users WHERE users.id IN (?, ?, ?) AND users.username = 'bob' LIMIT ? OFFSET 10"
+    postgres = "SELECT users.id\nFROM users WHERE users.id IN (%(id_1_1)s, %(id_1_2)s) AND users.username = %(username_1)s LIMIT %(param_1)s OFFSET %(param_2)s"
+    assert normalize(sqlite) == normalize(postgres) == "SELECT users.id FROM users WHERE users.id IN (?) AND users.username = ? LIMIT ? OFFSET ?"
+    assert normalize("INSERT INTO t (a, b) VALUES (?, ?), (?, ?), (?, ?)") == "INSERT INTO t (a, b) VALUES (?)"
+    assert normalize("SELECT anon_1.user_id_2 FROM anon_1") == "SELECT anon_1.user_id_2 FROM anon_1"
+
+def test_statements_are_counted_and_timed():
+    engine = create_engine("sqlite://")
+    stats = QueryStats(slow_query_ms=0, slow_query_samples=3, max_statements=2)
+    stats.instrument(engine)
+    with engine.connect() as connection:
+        connection.execute(text("CREATE TABLE t (a INTEGER)"))
+        for value in range(5):
+            connection.execute(text("INSERT INTO t (a) VALUES (:a)"), {"a": value})
+        connection.execute(text("SELECT a FROM t WHERE a IN (1, 2, 3)"))
+        with pytest.raises(OperationalError):
+            connection.execute(text("SELECT * FROM missing"))
+        connection.execute(text("SELECT 1"))
+        assert connection.info["query_started"] == []
+    snapshot = stats.snapshot()
+    assert (snapshot["queries"], snapshot["errors"]) == (8, 1)
+    counts = {statement["statement"]: statement["count"] for statement in snapshot["statements"]}
+    assert counts == {"CREATE TABLE t (a INTEGER)": 1, "INSERT INTO t (a) VALUES (?)": 5, "(other statements)": 2}
+    assert [sample["statement"] for sample in snapshot["slow_queries"]] == [
+        "INSERT INTO t (a) VALUES (?)", "SELECT a FROM t WHERE a IN (?)", "SELECT ?"
+    ]
+    stats.remove(engine)
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+    assert stats.queries == 8
+    stats.reset()
+    assert stats.snapshot()["statements"] == []
+
+@pytest.fixture()
+def stats(api, monkeypatch):
+    stats = QueryStats()
+    monkeypatch.setattr("backend.querystats.query_stats", stats)
+    monkeypatch.setattr("backend.metrics.query_stats", stats)
+    stats.instrument(Engine)  # the test engines too
+    yield stats
+    stats.remove(Engine)
+
+def test_queries_per_request(api, stats, monkeypatch, caplog):
+    client, _ = api
+    client.get("/api/crud/users")  # loads the principal of the admin
+    stats.reset()
+    for _ in range(3):
+        client.get("/api/crud/users", params={"include": "groups,permissions"})
+    client.get("/api/crud/proxy_cache")
+
+    monkeypatch.setattr("backend.querystats.DB_REQUEST_QUERY_WARN", 2)
+    with caplog.at_level(logging.WARNING, logger="backend.querystats"):
+        client.get("/api/crud/users/1")
+    assert caplog.messages == ["GET /api/crud/users/1: 3 queries, %.1f ms in the database" % (stats.snapshot()["routes"]["/api/crud/users/{user_id}"]["time_ms"])]
+
+    snapshot = client.get("/api/metrics/db").json()
+    users = snapshot["routes"]["/api/crud/users"]
+    assert (users["requests"], users["queries"], users["queries_per_request"], users["max_queries"]) == (3, 9, 3, 3)
+    assert snapshot["routes"]["/api/crud/proxy_cache"]["queries"] == 0
+    assert snapshot["queries"] >= 12
+    assert any(statement["statement"].startswith("SELECT users.id, users.username, users.email") for statement in snapshot["statements"])
+
+def test_metrics_are_for_admins(api, stats):
+    client, _ = api
+    del client.headers["Authorization"]
+    assert client.get("/api/metrics/db").status_code == 401
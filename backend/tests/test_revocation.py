@@ -0,0 +1,86 @@
+import time
+import pytest
+from jose import jwt
+from sqlalchemy import select
+from backend.invalidation import GenerationBus
+from backend.models import RevokedToken, TokenSession
+from backend.revocation import RevocationList
+
+@pytest.fixture()
+def bus(tmp_path):
+    return GenerationBus(str(tmp_path / "centralarr.generations"))
+
+@pytest.mark.asyncio
+async def test_revocations_reach_other_workers(test_database, bus):
+    _, AsyncSession = test_database
+    worker, other = RevocationList(AsyncSession, bus), RevocationList(AsyncSession, GenerationBus(bus.path))
+    await worker.ensure_fresh()
+    await other.ensure_fresh()
+    async with AsyncSession() as db:
+        await worker.revoke(db, "session-1", int(time.time()) + 60)
+    assert worker.is_revoked("jti", "session-1")
+    assert not worker._generation.changed()  # its own change, no reload
+    assert not other.is_revoked("session-1")
+    await other.ensure_fresh()
+    assert other.is_revoked(None, "session-1")
+    assert not other.is_revoked("session-2", None)
+
+@pytest.mark.asyncio
+async def test_expired_revocations_are_compacted(test_database, bus, monkeypatch):
+    SyncSession, AsyncSession = test_database
+    revocations = RevocationList(AsyncSession, bus)
+    async with AsyncSession() as db:
+        await revocations.revoke(db, "old", int(time.time()) + 1)
+        monkeypatch.setattr("backend.revocation.REVOCATION_COMPACT_INTERVAL", 0)
+        now = time.time()
+        monkeypatch.setattr("backend.revocation.time.time", lambda: now + 10)
+        assert not revocations.is_revoked("old")
+        await revocations.revoke(db, "new", int(now) + 60)
+    with SyncSession() as session:
+        assert session.scalars(select(RevokedToken.token_id)).all() == ["new"]
+
+def login(client):
+    tokens = client.post("/api/auth/token", data={"username": "admin", "password": "adminpass"}).json()
+    assert tokens["token_type"] == "bearer" and tokens["expires_in"] > 0
+    return tokens
+
+def me(client, access_token):
+    return client.get("/api/auth/me", headers={"Authorization": f"Bearer {access_token}"}).status_code
+
+def test_refresh_tokens_rotate(api):
+    client, _ = api
+    tokens = login(client)
+    renewed = client.post("/api/auth/refresh", json={"refresh_token": tokens["refresh_token"]})
+    assert renewed.status_code == 200
+    renewed = renewed.json()
+    assert renewed["refresh_token"] != tokens["refresh_token"]
+    assert me(client, renewed["access_token"]) == 200
+    assert client.post("/api/auth/refresh", json={"refresh_token": renewed["refresh_token"]}).status_code == 200
+
+def test_replayed_refresh_token_ends_the_session(api):
+    client, Session = api
+    tokens = login(client)
+    renewed = client.post("/api/auth/refresh", json={"refresh_token": tokens["refresh_token"]}).json()
+    assert client.post("/api/auth/refresh", json={"refresh_token": tokens["refresh_token"]}).status_code == 401
+    assert client.post("/api/auth/refresh", json={"refresh_token": renewed["refresh_token"]}).status_code == 401
+    assert me(client, renewed["access_token"]) == 401
+    assert me(client, login(client)["access_token"]) == 200  # other sessions go on
+
+def test_logout_revokes_the_session(api):
+    client, Session = api
+    tokens = login(client)
+    other = login(client)
+    assert client.post("/api/auth/logout", headers={"Authorization": f"Bearer {tokens['access_token']}"}).status_code == 200
+    assert me(client, tokens["access_token"]) == 401
+    assert client.post("/api/auth/refresh", json={"refresh_token": tokens["refresh_token"]}).status_code == 401
+    assert me(client, other["access_token"]) == 200
+    with Session() as session:
+        assert session.get(TokenSession, jwt.get_unverified_claims(tokens["access_token"])["sid"]) is None
+        assert session.get(TokenSession, jwt.get_unverified_claims(other["access_token"])["sid"]) is not None
+
+def test_token_types_are_not_interchangeable(api):
+    client, _ = api
+    tokens = login(client)
+    assert me(client, tokens["refresh_token"]) == 401
+    assert client.post("/api/auth/refresh", json={"refresh_token": tokens["access_token"]}).status_code == 401
+    assert client.post("/api/auth/refresh", json={}).status_code == 401
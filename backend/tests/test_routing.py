@@ -0,0 +1,74 @@
+import pytest
+from sqlalchemy import update, delete
+from backend.models import ProxyService
+from backend.routing import RoutingTable
+from backend.upstream import upstream_clients
+
+@pytest.fixture()
+def db_factory(test_database):
+    SyncSession, AsyncSession = test_database
+    with SyncSession() as session:
+        session.add_all([
+            ProxyService(name="jellyfin", base_url="https://jellyfin.lan", enabled=True),
+            ProxyService(name="sonarr", base_url="http://sonarr.lan:8989", enabled=False),
+        ])
+        session.commit()
+    return AsyncSession
+
+@pytest.mark.asyncio
+async def test_routes_are_precomputed(db_factory):
+    table = RoutingTable(session_factory=db_factory)
+    await table.refresh()
+
+    route = table.get("jellyfin")
+    assert route.base_url == "https://jellyfin.lan"
+    assert route.ws_url == "wss://jellyfin.lan"
+    assert route.proxy_prefix == "/api/proxy/jellyfin"
+
+@pytest.mark.asyncio
+async def test_disabled_and_unknown_services_are_hidden(db_factory):
+    table = RoutingTable(session_factory=db_factory)
+    await table.refresh()
+
+    assert table.get("sonarr") is None
+    assert table.get("missing") is None
+
+@pytest.mark.asyncio
+async def test_reload_picks_up_changes(db_factory):
+    table = RoutingTable(session_factory=db_factory)
+    async with db_factory() as db:
+        await table.load(db)
+        await db.execute(update(ProxyService).where(ProxyService.name == "sonarr").values(enabled=True))
+        await db.execute(delete(ProxyService).where(ProxyService.name == "jellyfin"))
+        await db.commit()
+        await table.load(db)
+
+    assert table.get("sonarr").ws_url == "ws://sonarr.lan:8989"
+    assert table.get("jellyfin") is None
+
+@pytest.mark.asyncio
+async def test_reload_drains_pool_of_changed_service(db_factory, monkeypatch):
+    discarded = []
+    monkeypatch.setattr(upstream_clients, "discard", discarded.append)
+    table = RoutingTable(session_factory=db_factory)
+    async with db_factory() as db:
+        await table.load(db)
+        await db.execute(update(ProxyService).where(ProxyService.name == "jellyfin").values(base_url="https://new.lan"))
+        await db.commit()
+        await table.load(db)
+
+    assert discarded == ["jellyfin"]
+
+@pytest.mark.asyncio
+async def test_ttl_marks_table_stale(db_factory, monkeypatch):
+    table = RoutingTable(ttl=30, session_factory=db_factory)
+    assert table.is_stale()
+    await table.refresh()
+    assert not table.is_stale()
+
+    monkeypatch.setattr("backend.routing.time.monotonic", lambda: table._loaded_at + 31)
+    assert table.is_stale()
+
+    # Without a TTL the table only changes through CRUD reloads
+    table.ttl = 0
+    assert not table.is_stale()
@@ -0,0 +1,153 @@
+import json
+import os
+import re
+import subprocess
+import sys
+import httpx
+import pytest
+from backend.models import ProxyService
+from backend.telemetry import Registry
+from backend.upstream import upstream_clients
+
+def sample(text: str, name: str, **labels) -> float:
+    """
+    Value of a sample in an exposition, 0 if absent.
+    """
+    wanted = ",".join(f'{key}="{value}"' for key, value in labels.items())
+    pattern = re.escape(name + (f"{{{wanted}}}" if labels else "")) + r" (\S+)$"
+    match = re.search(pattern, text, re.MULTILINE)
+    return float(match.group(1)) if match else 0.0
+
+def test_exposition_format(tmp_path):
+    registry = Registry(str(tmp_path))
+    requests = registry.counter("app_requests_total", "Requests", ("service", "code"))
+    duration = registry.histogram("app_duration_seconds", "Durations", ("service",), buckets=(0.1, 1))
+    registry.gauge("app_pool", "Pool", (), lambda: {(): 3})
+    requests.inc(("media", "200"))
+    requests.inc(("media", "200"))
+    requests.inc(('a "quoted"\nname', "502"))
+    for value in (0.05, 0.1, 0.5, 2):
+        duration.observe(("media",), value)
+
+    text = registry.render(registry.merged())
+    assert "# TYPE app_requests_total counter" in text
+    assert 'app_requests_total{service="media",code="200"} 2' in text
+    assert 'app_requests_total{service="a \\"quoted\\"\\nname",code="502"} 1' in text
+    assert "# TYPE app_duration_seconds histogram" in text
+    assert 'app_duration_seconds_bucket{service="media",le="0.1"} 2' in text
+    assert 'app_duration_seconds_bucket{service="media",le="1"} 3' in text
+    assert 'app_duration_seconds_bucket{service="media",le="+Inf"} 4' in text
+    assert 'app_duration_seconds_sum{service="media"} 2.65' in text
+    assert 'app_duration_seconds_count{service="media"} 4' in text
+    assert "app_pool 3" in text.splitlines()
+
+@pytest.mark.asyncio
+async def test_workers_are_summed(tmp_path):
+    def worker_registry():
+        registry = Registry(str(tmp_path))
+        registry.counter("app_requests_total", "Requests", ("code",))
+        registry.histogram("app_duration_seconds", "Durations", (), buckets=(1,))
+        registry.gauge("app_pool_size", "Pool size of each worker", (), lambda: {(): 10}, per_worker=True)
+        registry.derive("app_ok_ratio", "Share of 200s", (), lambda merged: {
+            (): merged["app_requests_total"][("200",)] / sum(merged["app_requests_total"].values())
+        })
+        return registry
+    this, other = worker_registry(), worker_registry()
+    this.metrics["app_requests_total"].inc(("200",), 3)
+    this.metrics["app_duration_seconds"].observe((), 0.5)
+    other.metrics["app_requests_total"].inc(("200",))
+    other.metrics["app_requests_total"].inc(("500",), 4)
+    other.metrics["app_duration_seconds"].observe((), 5)
+
+    # Another running worker (the parent process), and one that exited
+    running = tmp_path / f"{os.getppid()}.json"
+    running.write_text(json.dumps(other.snapshot()))
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+    gone = tmp_path / f"{exited.pid}.json"
+    gone.write_text(json.dumps(other.snapshot()))
+
+    text = await this.exposition()
+    assert 'app_requests_total{code="200"} 4' in text
+    assert 'app_requests_total{code="500"} 4' in text
+    assert 'app_duration_seconds_bucket{le="1"} 1' in text
+    assert 'app_duration_seconds_count 2' in text
+    assert "app_ok_ratio 0.5" in text
+    assert "app_pool_size 10" in text.splitlines()  # a setting, not summed
+    assert running.exists() and not gone.exists()
+
+    await this.flush()
+    assert json.loads((tmp_path / f"{os.getpid()}.json").read_text())["app_requests_total"] == [[["200"], 3]]
+    await this.stop()
+    assert not (tmp_path / f"{os.getpid()}.json").exists()
+
+@pytest.fixture()
+def media(api, monkeypatch):
+    """
+    A 'media' service answering "0123456789" to every request.
+    """
+    client, Session = api
+    with Session() as session:
+        session.add(ProxyService(name="media", base_url="http://media.local", enabled=True))
+        session.commit()
+
+    async def body():
+        yield b"01234"
+        yield b"56789"
+
+    def handler(request):
+        if request.url.path == "/down":
+            raise httpx.ConnectError("refused")
+        return httpx.Response(200, content=body())
+    monkeypatch.setattr(upstream_clients, "_create_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    upstream_clients.discard("media")
+    yield client, Session
+    upstream_clients.discard("media")
+
+def test_proxy_metrics(media):
+    client, _ = media
+    before = client.get("/api/metrics").text
+
+    assert client.get("/api/proxy/media/a").content == b"0123456789"
+    assert client.post("/api/proxy/media/upload", content=b"x" * 300).status_code == 200
+    assert client.get("/api/proxy/media/down").status_code == 502
+
+    response = client.get("/api/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "text/plain; version=0.0.4; charset=utf-8"
+    text = response.text
+
+    def delta(name, **labels):
+        return sample(text, name, **labels) - sample(before, name, **labels)
+    assert delta("centralarr_proxy_requests_total", service="media", code="200") == 2
+    assert delta("centralarr_proxy_requests_total", service="media", code="502") == 1
+    assert delta("centralarr_proxy_bytes_total", service="media", direction="out") == 20
+    assert delta("centralarr_proxy_bytes_total", service="media", direction="in") == 300
+    assert delta("centralarr_proxy_time_to_first_byte_seconds_count", service="media") == 2
+    assert delta("centralarr_proxy_duration_seconds_count", service="media") == 2
+    assert "# TYPE centralarr_response_cache_hit_ratio gauge" in text
+    assert "# TYPE centralarr_db_queries_total counter" in text
+    # One worker here: its own pool size, not a sum
+    assert "centralarr_upstream_max_connections 100" in text.splitlines()
+    assert "centralarr_workers 1" in text.splitlines()
+    assert "# TYPE centralarr_upstream_pool_utilization gauge" in text
+
+def test_metrics_need_the_scrape_token_or_an_admin(media, monkeypatch):
+    client, _ = media
+    assert client.get("/api/metrics", headers={"Authorization": ""}).status_code == 401
+    assert client.get("/api/metrics", headers={"Authorization": "Bearer scraper-secret"}).status_code == 401
+    monkeypatch.setattr("backend.metrics.METRICS_TOKEN", "scraper-secret")
+    assert client.get("/api/metrics", headers={"Authorization": "Bearer scraper-secret"}).status_code == 200
+
+    assert client.post("/api/auth/register", json={"username": "bob", "email": "bob@example.com", "password": "pw"}).status_code == 200
+    token = client.post("/api/auth/token", data={"username": "bob", "password": "pw"}).json()["access_token"]
+    assert client.get("/api/metrics", headers={"Authorization": f"Bearer {token}"}).status_code == 403
+
+def test_pool_utilization_is_over_the_pools_of_every_worker():
+    from backend.metrics import pool_utilization
+    merged = {
+        "centralarr_upstream_max_connections": {(): 100},
+        "centralarr_workers": {(): 4},
+        "centralarr_upstream_connections": {("media", "active"): 40, ("media", "idle"): 12},
+    }
+    assert pool_utilization(merged) == {("media",): 0.1}
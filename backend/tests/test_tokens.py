@@ -0,0 +1,74 @@
+import time
+from datetime import timedelta
+import pytest
+from jose import jwt
+from backend.tokens import Keyring, TokenService, write_key
+
+@pytest.fixture()
+def keys_dir(tmp_path):
+    return str(tmp_path / "jwt-keys")
+
+def test_hs256_roundtrip_and_tampering():
+    tokens = TokenService(Keyring.from_secret("secret"))
+    token = tokens.issue({"sub": "alice"}, timedelta(minutes=5))
+    assert tokens.verify(token)["sub"] == "alice"
+    assert TokenService(Keyring.from_secret("other")).verify(token) is None
+    assert tokens.verify(token[:-2] + ("AA" if token[-2:] != "AA" else "BB")) is None
+    assert tokens.verify("not a token") is None
+
+def test_clock_skew_is_tolerated_within_the_leeway():
+    tokens = TokenService(Keyring.from_secret("secret"), leeway=30, cache_size=0)
+    assert tokens.verify(tokens.issue({"sub": "alice"}, timedelta(seconds=-10)))["sub"] == "alice"
+    assert tokens.verify(tokens.issue({"sub": "alice"}, timedelta(seconds=-60))) is None
+
+def test_es256_keys_are_created_and_rotated(keys_dir, monkeypatch):
+    monkeypatch.setattr("backend.tokens.JWT_KEYS_RELOAD_INTERVAL", 0)
+    old = TokenService(Keyring.from_directory(keys_dir, ""))
+    old_token = old.issue({"sub": "alice"}, timedelta(minutes=5))
+    assert jwt.get_unverified_header(old_token)["alg"] == "ES256"
+
+    write_key(keys_dir, "99999999T999999999999Z")  # newest kid
+    new = TokenService(Keyring.from_directory(keys_dir, ""))
+    new_token = new.issue({"sub": "bob"}, timedelta(minutes=5))
+    assert jwt.get_unverified_header(new_token)["kid"] == "99999999T999999999999Z"
+
+    # Workers started before the rotation pick up the new key when they meet it
+    assert old.verify(new_token)["sub"] == "bob"
+    assert new.verify(old_token)["sub"] == "alice"
+    assert old.issue({"sub": "alice"}, timedelta(minutes=5))  # still signs with its key
+
+def test_tokens_of_unknown_or_other_keys_are_rejected(keys_dir, tmp_path):
+    tokens = TokenService(Keyring.from_directory(keys_dir, ""))
+    foreign = TokenService(Keyring.from_directory(str(tmp_path / "elsewhere"), ""))
+    assert tokens.verify(foreign.issue({"sub": "alice"}, timedelta(minutes=5))) is None
+    hs256 = TokenService(Keyring.from_secret("secret")).issue({"sub": "alice"}, timedelta(minutes=5))
+    assert tokens.verify(hs256) is None
+
+def test_keys_are_prepared_once(keys_dir, monkeypatch):
+    tokens = TokenService(Keyring.from_directory(keys_dir, ""), cache_size=0)
+    def construct(*args, **kwargs):
+        raise AssertionError("key built on the request path")
+    monkeypatch.setattr("jose.jwk.construct", construct)
+    token = tokens.issue({"sub": "alice"}, timedelta(minutes=5))
+    assert tokens.verify(token)["sub"] == "alice"
+
+def test_recent_verifications_are_memoized(monkeypatch):
+    tokens = TokenService(Keyring.from_secret("secret"), cache_size=2, cache_ttl=5)
+    first, second, third = (tokens.issue({"sub": name}, timedelta(minutes=5)) for name in ("a", "b", "c"))
+    for token in (first, first, second, third, first):
+        assert tokens.verify(token)
+    # first was evicted by third, then verified again
+    assert tokens.counters["verified"] == 4
+    assert tokens.counters["cache_hits"] == 1
+
+    now = time.time()
+    monkeypatch.setattr("backend.tokens.time.time", lambda: now + 6)
+    assert tokens.verify(third)
+    assert tokens.counters["verified"] == 5
+
+def test_api_runs_on_es256(api, keys_dir, monkeypatch):
+    client, _ = api
+    monkeypatch.setattr("backend.auth.token_service", TokenService(Keyring.from_directory(keys_dir, "")))
+    token = client.post("/api/auth/token", data={"username": "admin", "password": "adminpass"}).json()["access_token"]
+    assert jwt.get_unverified_header(token)["alg"] == "ES256"
+    assert client.get("/api/auth/me", headers={"Authorization": f"Bearer {token}"}).json()["username"] == "admin"
@@ -0,0 +1,94 @@
+import asyncio
+import httpx
+import pytest
+from backend.upstream import InFlightTransport, UpstreamClients
+
+
+@pytest.mark.asyncio
+async def test_client_is_reused_per_service():
+    clients = UpstreamClients()
+    first = clients.get("jellyfin", "http://localhost:8096")
+    second = clients.get("jellyfin", "http://localhost:8096")
+    other = clients.get("sonarr", "http://localhost:8989")
+
+    assert first is second
+    assert first is not other
+    await clients.aclose()
+
+@pytest.mark.asyncio
+async def test_base_url_change_replaces_pool():
+    clients = UpstreamClients()
+    old = clients.get("jellyfin", "http://localhost:8096")
+    new = clients.get("jellyfin", "http://10.0.0.2:8096")
+
+    assert new is not old
+    await clients.aclose()
+    assert old.is_closed
+
+@pytest.mark.asyncio
+async def test_discard_drains_pool():
+    clients = UpstreamClients()
+    old = clients.get("jellyfin", "http://localhost:8096")
+    clients.discard("jellyfin")
+    new = clients.get("jellyfin", "http://localhost:8096")
+
+    assert new is not old
+    await clients.aclose()
+    assert old.is_closed and new.is_closed
+
+@pytest.mark.asyncio
+async def test_retired_pool_is_closed_once_its_requests_are_done():
+    async def body():
+        yield b"part"
+        yield b"rest"
+
+    clients = UpstreamClients()
+    transport = InFlightTransport(httpx.MockTransport(lambda request: httpx.Response(200, content=body())))
+    old = httpx.AsyncClient(transport=transport)
+    clients._transports[old] = transport
+    clients._clients["jellyfin"] = old
+    clients._base_urls["jellyfin"] = "http://localhost:8096"
+
+    response = await old.send(old.build_request("GET", "http://localhost:8096/stream"), stream=True)
+    assert clients.in_flight() == {"jellyfin": 1}
+    clients.discard("jellyfin")
+    clients.get("jellyfin", "http://localhost:8096")
+    await asyncio.sleep(0)
+    # Still streaming through the replaced pool
+    assert not old.is_closed
+    assert [chunk async for chunk in response.aiter_raw()] == [b"part", b"rest"]
+    await response.aclose()
+    await asyncio.sleep(0)
+    assert old.is_closed
+    await clients.aclose()
+
+@pytest.mark.asyncio
+async def test_shutdown_waits_for_requests_at_most_drain_timeout():
+    async def body():
+        yield b"ok"
+
+    clients = UpstreamClients()
+    transport = InFlightTransport(httpx.MockTransport(lambda request: httpx.Response(200, content=body())))
+    client = httpx.AsyncClient(transport=transport)
+    clients._transports[client] = transport
+    clients._clients["jellyfin"] = client
+    response = await client.send(client.build_request("GET", "http://localhost:8096/"), stream=True)
+
+    await clients.aclose(drain_timeout=0.01)
+    assert client.is_closed
+    await response.aclose()
+    assert transport.active == 0
+
+@pytest.mark.asyncio
+async def test_pool_stats():
+    clients = UpstreamClients()
+    clients.get("jellyfin", "http://localhost:8096")
+    assert clients.pool_stats() == {"jellyfin": {"active": 0, "idle": 0, "queued": 0}}
+    assert clients.in_flight() == {"jellyfin": 0}
+    await clients.aclose()
+
+def test_pool_limits_are_configurable():
+    clients = UpstreamClients(max_connections=8, max_keepalive_connections=4, keepalive_expiry=5)
+    assert clients.limits.max_connections == 8
+    assert clients.limits.max_keepalive_connections == 4
+    assert clients.limits.keepalive_expiry == 5
@@ -0,0 +1,120 @@
+import asyncio
+import threading
+import time
+import pytest
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+from websockets.exceptions import ConnectionClosed
+from websockets.sync.server import serve
+from backend.main import app
+from backend.models import ProxyService
+from backend.routing import RoutingTable
+from backend.wsrelay import sendable_close_code, upstream_headers
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(app) as c:
+        yield c
+
+@pytest.fixture()
+def echo_upstream(monkeypatch, test_database):
+    """
+    Local websocket echo server proxied as the 'live' service. Records
+    each handshake and the close code the relay sent.
+    """
+    seen = {"handshakes": [], "close_codes": []}
+
+    def echo(connection):
+        seen["handshakes"].append((connection.request.path, connection.request.headers, connection.subprotocol))
+        try:
+            for message in connection:
+                if message == "close 4001":
+                    connection.close(4001, "bye")
+                    return
+                connection.send(message)
+        except ConnectionClosed:
+            pass
+        seen["close_codes"].append(connection.close_code)
+
+    server = serve(echo, "127.0.0.1", 0, subprotocols=["graphql-ws"], select_subprotocol=lambda conn, offered: (offered or [None])[0])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    port = server.socket.getsockname()[1]
+
+    SyncSession, AsyncSession = test_database
+    with SyncSession() as session:
+        session.add(ProxyService(name="live", base_url=f"http://127.0.0.1:{port}", enabled=True))
+        session.add(ProxyService(name="down", base_url="http://127.0.0.1:1", enabled=True))
+        session.commit()
+
+    table = RoutingTable(session_factory=AsyncSession)
+    asyncio.run(table.refresh())
+    monkeypatch.setattr("backend.proxy.routing_table", table)
+    yield seen
+    server.shutdown()
+    thread.join()
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def test_close_codes_that_cannot_be_sent_are_mapped():
+    assert sendable_close_code(None) == 1000
+    assert sendable_close_code(1005) == 1000
+    assert sendable_close_code(1006) == 1011
+    assert sendable_close_code(4001) == 4001
+
+def test_handshake_headers_are_not_forwarded():
+    headers = upstream_headers({"host": "centralarr", "sec-websocket-key": "x", "cookie": "a=1", "x-emby-token": "t"})
+    assert headers == [("cookie", "a=1"), ("x-emby-token", "t")]
+
+def test_relay_preserves_frame_types(client, echo_upstream):
+    with client.websocket_connect("/api/proxy/live/socket") as websocket:
+        websocket.send_text('{"MessageType":"KeepAlive"}')
+        assert websocket.receive() == {"type": "websocket.send", "text": '{"MessageType":"KeepAlive"}'}
+        websocket.send_bytes(b"\x00\xff")
+        assert websocket.receive() == {"type": "websocket.send", "bytes": b"\x00\xff"}
+
+def test_relay_forwards_query_headers_and_subprotocol(client, echo_upstream):
+    with client.websocket_connect(
+        "/api/proxy/live/socket?api_key=abc",
+        headers={"X-Emby-Token": "secret"},
+        subprotocols=["graphql-ws"],
+    ) as websocket:
+        assert websocket.accepted_subprotocol == "graphql-ws"
+        websocket.send_text("ping")
+        websocket.receive_text()
+    path, headers, subprotocol = echo_upstream["handshakes"][0]
+    assert path == "/socket?api_key=abc"
+    assert headers["x-emby-token"] == "secret"
+    assert subprotocol == "graphql-ws"
+
+def test_upstream_close_code_reaches_client(client, echo_upstream):
+    with client.websocket_connect("/api/proxy/live/socket") as websocket:
+        websocket.send_text("close 4001")
+        message = websocket.receive()
+    assert message["type"] == "websocket.close"
+    assert message["code"] == 4001
+
+def test_client_close_code_reaches_upstream(client, echo_upstream):
+    with client.websocket_connect("/api/proxy/live/socket") as websocket:
+        websocket.send_text("hello")
+        websocket.receive_text()
+        websocket.close(code=4002)
+    assert wait_for(lambda: echo_upstream["close_codes"] == [4002])
+
+def test_oversized_client_message_closes_both_sides(client, echo_upstream, monkeypatch):
+    monkeypatch.setattr("backend.wsrelay.WS_MAX_MESSAGE_SIZE", 8)
+    with client.websocket_connect("/api/proxy/live/socket") as websocket:
+        websocket.send_bytes(b"x" * 9)
+        message = websocket.receive()
+    assert message == {"type": "websocket.close", "code": 1009, "reason": ""}
+    assert wait_for(lambda: echo_upstream["close_codes"] == [1009])
+
+def test_unreachable_upstream_closes_with_internal_error(client, echo_upstream):
+    with client.websocket_connect("/api/proxy/down/socket") as websocket:
+        with pytest.raises(WebSocketDisconnect) as closed:
+            websocket.receive_text()
+    assert closed.value.code == 1011
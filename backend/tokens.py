@@ -0,0 +1,230 @@
+"""
+Access token signing and verification.
+
+HS256 signs with SECRET_KEY. With JWT_ALGORITHM=ES256, tokens are signed
+with EC P-256 keys kept as PEM files in JWT_KEYS_DIR, named after their
+"kid"; the newest key (or JWT_ACTIVE_KID) signs, all of them verify. To
+rotate, add a key and restart the workers (they accept tokens of the new key
+as soon as they see one), then delete the old key once the tokens it signed
+have expired:
+
+    python -m backend.tokens rotate
+"""
+import fcntl
+import glob
+import os
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from jose import jwk, jwt
+from jose.backends.base import Key
+from jose.exceptions import JOSEError
+
+SECRET_KEY = os.environ.get("SECRET_KEY", "supersecretkey")
+# HS256 or ES256
+JWT_ALGORITHM = os.environ.get("JWT_ALGORITHM", "HS256")
+# ES256 keys, e.g. /opt/centralarr/db/jwt-keys (created with a first key if empty)
+JWT_KEYS_DIR = os.environ.get("JWT_KEYS_DIR", "./jwt-keys")
+JWT_ACTIVE_KID = os.environ.get("JWT_ACTIVE_KID", "")
+# Seconds of clock difference tolerated on exp/nbf/iat between nodes
+JWT_LEEWAY = int(os.environ.get("JWT_LEEWAY", "30"))
+# Successful verifications remembered per worker, and for how many seconds
+TOKEN_VERIFY_CACHE_SIZE = int(os.environ.get("TOKEN_VERIFY_CACHE_SIZE", "4096"))
+TOKEN_VERIFY_CACHE_TTL = float(os.environ.get("TOKEN_VERIFY_CACHE_TTL", "5"))
+# Minimum seconds between two reloads of JWT_KEYS_DIR for an unknown kid
+JWT_KEYS_RELOAD_INTERVAL = float(os.environ.get("JWT_KEYS_RELOAD_INTERVAL", "10"))
+
+
+def new_kid() -> str:
+    # Sorts chronologically: the newest key is the last one
+    return datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+
+def write_key(keys_dir: str, kid: Optional[str] = None) -> str:
+    """
+    Generate an ES256 private key in keys_dir and return its kid.
+    """
+    kid = kid or new_kid()
+    pem = ec.generate_private_key(ec.SECP256R1()).private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    path = os.path.join(keys_dir, f"{kid}.pem")
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(pem)
+    return kid
+
+
+def read_keys(paths) -> Dict[str, Key]:
+    keys = {}
+    for path in paths:
+        with open(path, "rb") as f:
+            keys[os.path.basename(path)[:-len(".pem")]] = jwk.construct(f.read(), "ES256")
+    return keys
+
+
+class Keyring:
+    """
+    Prepared jose keys by kid: PEM parsing and key setup happen once, not
+    on every signature or verification.
+    """
+
+    def __init__(
+        self,
+        algorithm: str,
+        signing_key: Key,
+        verification_keys: Dict[Optional[str], Key],
+        active_kid: Optional[str],
+        keys_dir: Optional[str] = None,
+    ):
+        self.algorithm = algorithm
+        self.signing_key = signing_key
+        self.verification_keys = verification_keys
+        self.active_kid = active_kid
+        self.keys_dir = keys_dir
+
+    @classmethod
+    def from_secret(cls, secret: str = SECRET_KEY) -> "Keyring":
+        key = jwk.construct(secret, "HS256")
+        return cls("HS256", key, {None: key}, None)
+
+    @classmethod
+    def from_directory(cls, keys_dir: str = JWT_KEYS_DIR, active_kid: str = JWT_ACTIVE_KID) -> "Keyring":
+        """
+        Load the ES256 keys of keys_dir, creating a first one if there is
+        none (workers starting together agree through a lock file).
+        """
+        os.makedirs(keys_dir, mode=0o700, exist_ok=True)
+        with open(os.path.join(keys_dir, ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                paths = sorted(glob.glob(os.path.join(keys_dir, "*.pem")))
+                if not paths:
+                    paths = [os.path.join(keys_dir, f"{write_key(keys_dir)}.pem")]
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        private_keys = read_keys(paths)
+        active = active_kid if active_kid in private_keys else max(private_keys)
+        public_keys = {kid: key.public_key() for kid, key in private_keys.items()}
+        return cls("ES256", private_keys[active], public_keys, active, keys_dir)
+
+    def verification_key(self, kid: Optional[str]) -> Optional[Key]:
+        return self.verification_keys.get(kid)
+
+    def reload_verification_keys(self):
+        """
+        Pick up keys added to (or removed from) the directory since loading.
+        The signing key stays the same until the worker restarts.
+        """
+        if self.keys_dir is None:
+            return
+        private_keys = read_keys(sorted(glob.glob(os.path.join(self.keys_dir, "*.pem"))))
+        public_keys = {kid: key.public_key() for kid, key in private_keys.items()}
+        public_keys.setdefault(self.active_kid, self.signing_key.public_key())
+        self.verification_keys = public_keys
+
+
+def load_keyring(algorithm: str = JWT_ALGORITHM) -> Keyring:
+    if algorithm == "HS256":
+        return Keyring.from_secret()
+    if algorithm == "ES256":
+        return Keyring.from_directory()
+    raise ValueError(f"Unsupported JWT algorithm: {algorithm}")
+
+
+class TokenService:
+    """
+    Issues and verifies access tokens, without the database. Successful
+    verifications are memoized for a few seconds in a bounded LRU, as
+    clients send the same token with every request.
+    """
+
+    def __init__(
+        self,
+        keyring: Optional[Keyring] = None,
+        leeway: int = JWT_LEEWAY,
+        cache_size: int = TOKEN_VERIFY_CACHE_SIZE,
+        cache_ttl: float = TOKEN_VERIFY_CACHE_TTL,
+    ):
+        self._keyring = keyring
+        self.leeway = leeway
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._verified: "OrderedDict[str, tuple]" = OrderedDict()
+        self._reloaded_at = 0.0
+        self.counters = {"issued": 0, "verified": 0, "cache_hits": 0, "rejected": 0}
+
+    @property
+    def keyring(self) -> Keyring:
+        # Loaded on first use: ES256 may have to create the key directory
+        if self._keyring is None:
+            self._keyring = load_keyring()
+        return self._keyring
+
+    def issue(self, claims: dict, expires_in: timedelta) -> str:
+        now = datetime.now(timezone.utc)
+        keyring = self.keyring
+        headers = {"kid": keyring.active_kid} if keyring.active_kid else None
+        self.counters["issued"] += 1
+        return jwt.encode(
+            {**claims, "iat": now, "exp": now + expires_in},
+            keyring.signing_key,
+            algorithm=keyring.algorithm,
+            headers=headers,
+        )
+
+    def _key_for(self, kid: Optional[str]) -> Optional[Key]:
+        key = self.keyring.verification_key(kid)
+        if key is None and kid and self.keyring.keys_dir is not None:
+            # Maybe a key added by a rotation since this worker loaded them
+            if time.monotonic() - self._reloaded_at > JWT_KEYS_RELOAD_INTERVAL:
+                self._reloaded_at = time.monotonic()
+                self.keyring.reload_verification_keys()
+                key = self.keyring.verification_key(kid)
+        return key
+
+    def verify(self, token: str) -> Optional[dict]:
+        """
+        Claims of a valid token, or None. The claims may be shared between
+        callers: don't modify them.
+        """
+        cached = self._verified.get(token)
+        if cached is not None:
+            if time.time() < cached[0]:
+                self._verified.move_to_end(token)
+                self.counters["cache_hits"] += 1
+                return cached[1]
+            del self._verified[token]
+        try:
+            key = self._key_for(jwt.get_unverified_header(token).get("kid"))
+            if key is None:
+                raise JOSEError("Unknown key")
+            claims = jwt.decode(token, key, algorithms=[self.keyring.algorithm], options={"leeway": self.leeway})
+        except JOSEError:
+            self.counters["rejected"] += 1
+            return None
+        self.counters["verified"] += 1
+        if self.cache_size and self.cache_ttl:
+            expires = claims.get("exp", float("inf")) + self.leeway
+            self._verified[token] = (min(time.time() + self.cache_ttl, expires), claims)
+            while len(self._verified) > self.cache_size:
+                self._verified.popitem(last=False)
+        return claims
+
+    def forget(self):
+        self._verified.clear()
+
+
+token_service = TokenService()
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rotate"]:
+        sys.exit(__doc__)
+    os.makedirs(JWT_KEYS_DIR, mode=0o700, exist_ok=True)
+    print(write_key(JWT_KEYS_DIR))
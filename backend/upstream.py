@@ -0,0 +1,220 @@
+import asyncio
+import os
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from typing import Callable, Dict, List, Optional, Set
+
+import httpx
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx when installed)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Pool tuning, shared by every upstream client
+PROXY_MAX_CONNECTIONS = int(os.environ.get("PROXY_MAX_CONNECTIONS", "100"))
+PROXY_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("PROXY_MAX_KEEPALIVE_CONNECTIONS", "20"))
+PROXY_KEEPALIVE_EXPIRY = float(os.environ.get("PROXY_KEEPALIVE_EXPIRY", "30"))
+PROXY_HTTP2 = os.environ.get("PROXY_HTTP2", "true").lower() in ("1", "true", "yes")
+# Seconds the requests still using a replaced pool get to finish at shutdown
+PROXY_DRAIN_TIMEOUT = float(os.environ.get("PROXY_DRAIN_TIMEOUT", "10"))
+
+
+class InFlightStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, done: Callable[[], None]):
+        self.stream = stream
+        self.done: Optional[Callable[[], None]] = done
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if self.done is not None:
+                done, self.done = self.done, None
+                done()
+
+
+class InFlightTransport(httpx.AsyncBaseTransport):
+    """
+    Transport counting the requests whose response isn't closed yet, so a
+    replaced pool is only closed once they are done.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self.transport = transport
+        self.active = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def _done(self):
+        self.active -= 1
+        if not self.active:
+            self.idle.set()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.active += 1
+        self.idle.clear()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            self._done()
+            raise
+        if response.is_closed:
+            self._done()  # body already read (not an HTTP transport)
+        else:
+            response.stream = InFlightStream(response.stream, self._done)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+def pool_connections(transport: httpx.AsyncBaseTransport) -> Optional[Dict[str, int]]:
+    """
+    Connections of an httpx transport's pool: in use (active), kept alive
+    (idle), and requests waiting for one (queued). Read from httpcore's
+    internals, so None if they aren't there.
+    """
+    try:
+        pool = transport._pool
+        idle = sum(1 for connection in pool.connections if connection.is_idle())
+        return {
+            "active": len(pool.connections) - idle,
+            "idle": idle,
+            "queued": sum(1 for request in pool._requests if request.is_queued()),
+        }
+    except AttributeError:
+        return None
+
+
+class UpstreamClients:
+    """
+    Registry of pooled httpx clients, one per ProxyService.
+
+    Each service gets its own connection pool, so the limits below apply per
+    upstream host. Clients are created lazily on first use and replaced when
+    the service's base_url changes.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = PROXY_MAX_CONNECTIONS,
+        max_keepalive_connections: int = PROXY_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry: float = PROXY_KEEPALIVE_EXPIRY,
+        http2: bool = PROXY_HTTP2,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._base_urls: Dict[str, str] = {}
+        self._retired: List[httpx.AsyncClient] = []
+        # In-flight counts of the clients created here, and the tasks
+        # closing retired clients once drained
+        self._transports: Dict[httpx.AsyncClient, InFlightTransport] = {}
+        self._closing: Set["asyncio.Task[None]"] = set()
+
+    def _create_client(self) -> httpx.AsyncClient:
+        # Clients are shared between users: never keep upstream cookies in the
+        # client jar, the browser's Cookie header is forwarded as-is instead.
+        no_cookies = CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+        transport = InFlightTransport(httpx.AsyncHTTPTransport(limits=self.limits, http2=self.http2))
+        client = httpx.AsyncClient(
+            cookies=httpx.Cookies(no_cookies),
+            timeout=None,
+            follow_redirects=False,
+            limits=self.limits,
+            http2=self.http2,
+            transport=transport,
+        )
+        self._transports[client] = transport
+        return client
+
+    def get(self, service_name: str, base_url: str) -> httpx.AsyncClient:
+        """
+        Return the pooled client for a service, creating it if needed.
+        Must be called from the event loop.
+        """
+        if self._retired:
+            self._close_retired()
+        client = self._clients.get(service_name)
+        if client is not None and self._base_urls.get(service_name) == base_url:
+            return client
+        if client is not None:
+            self._retired.append(client)
+            self._close_retired()
+        client = self._create_client()
+        self._clients[service_name] = client
+        self._base_urls[service_name] = base_url
+        return client
+
+    def discard(self, service_name: Optional[str]):
+        """
+        Drop the client of a service so the next request gets a fresh pool.
+        The old client is closed once its requests are done, starting from
+        the next get().
+        """
+        client = self._clients.pop(service_name, None)
+        self._base_urls.pop(service_name, None)
+        if client is not None:
+            self._retired.append(client)
+
+    def in_flight(self) -> Dict[str, int]:
+        """
+        Requests of each service waiting for or reading a response.
+        """
+        return {
+            service_name: self._transports[client].active
+            for service_name, client in self._clients.items()
+            if client in self._transports
+        }
+
+    def pool_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        pool_connections() of each service's pool, when available.
+        """
+        stats = {}
+        for service_name, client in self._clients.items():
+            transport = self._transports.get(client)
+            connections = pool_connections(transport.transport) if transport is not None else None
+            if connections is not None:
+                stats[service_name] = connections
+        return stats
+
+    async def _drain(self, client: httpx.AsyncClient):
+        transport = self._transports.pop(client, None)
+        try:
+            if transport is not None:
+                await transport.idle.wait()
+        finally:
+            await client.aclose()
+
+    def _close_retired(self):
+        while self._retired:
+            task = asyncio.get_running_loop().create_task(self._drain(self._retired.pop()))
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+
+    async def aclose(self, drain_timeout: float = PROXY_DRAIN_TIMEOUT):
+        """
+        Close every pooled connection (app shutdown), once their requests
+        are done or after drain_timeout seconds.
+        """
+        self._retired.extend(self._clients.values())
+        self._clients.clear()
+        self._base_urls.clear()
+        self._close_retired()
+        if self._closing:
+            _, pending = await asyncio.wait(set(self._closing), timeout=drain_timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+upstream_clients = UpstreamClients()
@@ -0,0 +1,136 @@
+import asyncio
+import os
+from typing import List, Optional, Tuple
+
+from fastapi import WebSocket, WebSocketDisconnect
+from websockets.asyncio.client import ClientConnection, connect
+from websockets.exceptions import ConnectionClosed
+
+# Largest message relayed in either direction, and upstream messages
+# buffered before reading pauses: bounds memory per socket
+WS_MAX_MESSAGE_SIZE = int(os.environ.get("WS_MAX_MESSAGE_SIZE", str(1024 * 1024)))
+WS_MAX_QUEUE = int(os.environ.get("WS_MAX_QUEUE", "16"))
+# Bytes waiting to be written upstream before sending blocks
+WS_WRITE_LIMIT = int(os.environ.get("WS_WRITE_LIMIT", str(32 * 1024)))
+# Upstream keep-alive pings (0 = disabled); clients are pinged by uvicorn
+# (--ws-ping-interval / --ws-ping-timeout)
+WS_PING_INTERVAL = float(os.environ.get("WS_PING_INTERVAL", "20"))
+WS_PING_TIMEOUT = float(os.environ.get("WS_PING_TIMEOUT", "20"))
+WS_OPEN_TIMEOUT = float(os.environ.get("WS_OPEN_TIMEOUT", "10"))
+
+# Handshake headers: set by the websockets client for the upstream connection
+HANDSHAKE_HEADERS = {
+    "host",
+    "connection",
+    "upgrade",
+    "user-agent",
+    "sec-websocket-key",
+    "sec-websocket-version",
+    "sec-websocket-extensions",
+    "sec-websocket-protocol",
+}
+
+# Close codes that only report a state and can't be sent in a close frame
+NO_STATUS_RECEIVED = 1005
+ABNORMAL_CLOSURE = 1006
+TLS_HANDSHAKE = 1015
+MESSAGE_TOO_BIG = 1009
+
+
+def sendable_close_code(code: Optional[int]) -> int:
+    """
+    Close code to pass on to the other side.
+    """
+    if code is None or code == NO_STATUS_RECEIVED:
+        return 1000
+    if code in (ABNORMAL_CLOSURE, TLS_HANDSHAKE):
+        return 1011
+    return code
+
+def upstream_headers(client_headers) -> List[Tuple[str, str]]:
+    # Cookies, tokens and the like go upstream as with plain HTTP requests
+    return [(k, v) for k, v in client_headers.items() if k.lower() not in HANDSHAKE_HEADERS]
+
+async def connect_upstream(url: str, client_headers) -> ClientConnection:
+    """
+    Open the upstream socket with the client's headers and subprotocols.
+    Compression is off: upstreams are on the LAN, and a deflate context
+    costs far more memory per socket than the relay itself.
+    """
+    subprotocols = [
+        protocol.strip()
+        for protocol in client_headers.get("sec-websocket-protocol", "").split(",")
+        if protocol.strip()
+    ]
+    return await connect(
+        url,
+        additional_headers=upstream_headers(client_headers),
+        user_agent_header=client_headers.get("user-agent"),
+        subprotocols=subprotocols or None,
+        compression=None,
+        open_timeout=WS_OPEN_TIMEOUT,
+        ping_interval=WS_PING_INTERVAL or None,
+        ping_timeout=WS_PING_TIMEOUT or None,
+        max_size=WS_MAX_MESSAGE_SIZE,
+        max_queue=WS_MAX_QUEUE,
+        write_limit=WS_WRITE_LIMIT,
+    )
+
+async def client_to_upstream(websocket: WebSocket, upstream: ClientConnection):
+    """
+    Relay client messages as they are (text stays text), until the client
+    disconnects; its close code is passed on. upstream.send() waits while
+    the upstream write buffer is full, which stops reading the client.
+    """
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            await upstream.close(sendable_close_code(message.get("code")), message.get("reason") or "")
+            return
+        data = message.get("text")
+        if data is None:
+            data = message.get("bytes") or b""
+        if len(data) > WS_MAX_MESSAGE_SIZE:
+            await upstream.close(MESSAGE_TOO_BIG)
+            await websocket.close(code=MESSAGE_TOO_BIG)
+            return
+        try:
+            await upstream.send(data)
+        except ConnectionClosed:
+            return
+
+async def upstream_to_client(websocket: WebSocket, upstream: ClientConnection):
+    """
+    Relay upstream messages with their type until the upstream closes,
+    then close the client with the upstream's code.
+    """
+    try:
+        async for data in upstream:
+            if isinstance(data, str):
+                await websocket.send_text(data)
+            else:
+                await websocket.send_bytes(data)
+    except ConnectionClosed:
+        pass
+    except WebSocketDisconnect:
+        return
+    try:
+        await websocket.close(code=sendable_close_code(upstream.close_code), reason=upstream.close_reason or None)
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+
+async def relay(websocket: WebSocket, upstream: ClientConnection):
+    """
+    Relay both directions until one side ends, then stop the other one.
+    """
+    tasks = [
+        asyncio.ensure_future(client_to_upstream(websocket, upstream)),
+        asyncio.ensure_future(upstream_to_client(websocket, upstream)),
+    ]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await upstream.close()